@@ -0,0 +1,71 @@
+"""
+Parquet storage profiles on a real year: write time, read time & size of every processed file of the
+year, per profile (see nse_pv.pv_store.STORAGE_PROFILES)
+Usage: [year] [profile ...]
+"""
+''' --------------------------------------------------------------------------------------- '''
+
+from fin_data.env import *
+import os
+import sys
+import time
+import tempfile
+import datetime
+import pandas as pd
+import pyarrow.parquet as pq
+import fin_data.nse_pv.pv_store as pv_store
+from fin_data.nse_pv.process_dr import year_files
+
+FILES = ['cm_bhavcopy_all', 'index_bhavcopy_all', 'etf_bhavcopy_all',
+         'fo_bhavcopy_IDF', 'fo_bhavcopy_IDO', 'fo_bhavcopy_STF', 'fo_bhavcopy_STO']
+
+''' besides the named profiles: the default codec with larger row groups & sorted, without dictionaries '''
+EXTRA_PROFILES = {
+    'zstd_rg_1m_sorted': {'row_group_size': 1000000, 'sorting_columns': ['Symbol', 'Series', 'Date']},
+    'zstd_no_dict': {'use_dictionary': False},
+}
+
+''' --------------------------------------------------------------------------------------- '''
+def best_of(f, n):
+    """ shortest of n runs of f, in seconds """
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+def benchmark(year, profiles=None, n_runs=3, verbose=True):
+    profiles = list(pv_store.STORAGE_PROFILES.keys()) + list(EXTRA_PROFILES.keys()) \
+        if profiles is None else profiles
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in FILES:
+            files = year_files(year, name)
+            if len(files) == 0:
+                continue
+            df = pv_store.read_pv_parquet(files)
+            current_size = sum(os.path.getsize(f) for f in files)
+            for profile in profiles:
+                p = EXTRA_PROFILES.get(profile, profile)
+                out_file = os.path.join(tmp_dir, f'{name}.{profile}.parquet')
+                write_time = best_of(lambda: pv_store.write_pv_parquet(df, out_file, profile=p), n_runs)
+                read_time = best_of(lambda: pv_store.read_pv_parquet(out_file), n_runs)
+                results.append({'file': name, 'profile': profile, 'rows': df.shape[0],
+                                'row_groups': pq.ParquetFile(out_file).metadata.num_row_groups,
+                                'write (sec)': round(write_time, 3), 'read (sec)': round(read_time, 3),
+                                'size (MB)': round(os.path.getsize(out_file) / 2 ** 20, 2),
+                                'current (MB)': round(current_size / 2 ** 20, 2)})
+                if verbose:
+                    print(results[-1])
+    return pd.DataFrame(results)
+
+''' --------------------------------------------------------------------------------------- '''
+if __name__ == '__main__':
+    year = datetime.date.today().year - 1 if len(sys.argv) == 1 else int(sys.argv[1])
+    profiles = None if len(sys.argv) <= 2 else sys.argv[2:]
+    df = benchmark(year, profiles=profiles, verbose=False)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(df)
+    print('\ntotals per profile:')
+    print(df.groupby('profile')[['write (sec)', 'read (sec)', 'size (MB)']].sum().sort_values(by='read (sec)'))
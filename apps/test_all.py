@@ -6,13 +6,20 @@ test all: nse_symbols, nse_spot
 from fin_data.env import *
 import os
 import random
+import tempfile
+import xml.etree.ElementTree as ElementTree
+from io import BytesIO
+from zipfile import ZipFile
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import fin_data.nse_pv.nse_spot as nse_spot
-from fin_data.common import nse_config, nse_symbols, nse_cf_ca
-from fin_data.nse_pv import get_hpv, get_dr, process_dr, nse_spot
-from fin_data.ind_cf import base_utils
+from fin_data.common import nse_config, nse_symbols, nse_cf_ca, http_pool
+from fin_data.nse_pv import get_hpv, get_dr, process_dr, nse_spot, trading_calendar, nse_fo, pv_store
+from fin_data.ind_cf import base_utils, fact_store, download_fr
 from pygeneric.datetime_utils import elapsed_time, remove_timers
+from pygeneric.archiver import Archiver
 
 ''' --------------------------------------------------------------------------------------- '''
 def test_nse_spot(verbose=False):
@@ -105,6 +112,19 @@ def test_nse_spot(verbose=False):
     assert pv_data.shape[0] == 54 and pv_data.shape[1] == 17, pv_data.shape
     print('OK')
 
+    ''' ----------------------------------------------------------------------------------- '''
+    print('NseSpotPVData (lazy=True):', end=' ')
+    lazy_obj = nse_spot.NseSpotPVData(lazy=True)
+    for s in [symbols[0], symbols[0:5]]:
+        df1 = nse_spot_obj.get_pv_data(s, from_to=['2022-01-01', latest_date])
+        df2 = lazy_obj.get_pv_data(s, from_to=['2022-01-01', latest_date])
+        assert df1.equals(df2), 'lazy get_pv_data Not OK: %s' % s
+    df1 = nse_spot_obj.get_index_pv_data(['NIFTY 50', 'NIFTY IT'], ['2023-04-01', '2023-05-02'])
+    assert df1.equals(lazy_obj.get_index_pv_data(['NIFTY 50', 'NIFTY IT'], ['2023-04-01', '2023-05-02']))
+    df1 = lazy_obj.get_pv_data(symbols[0], from_to=['2023-04-01', None], columns=['Close'])
+    assert list(df1.columns) == ['Date', 'Symbol', 'Series', 'Close'], list(df1.columns)
+    print('OK')
+
     ''' ----------------------------------------------------------------------------------- '''
     print('NseSpotPVData.get_spot_quote:', end=' ')
     keys  = ['Symbol', 'Series', 'Date', 'epoch', 'Open', 'High', 'Low', 'Close',
@@ -152,12 +172,416 @@ def test_nse_spot(verbose=False):
     assert abs(res[2] - 2784.44) < 0.1, 'ERROR! %s Unexpected average value' % res
     print('OK')
 
+    print('NseSpotPVData.get_latest_closing_prices:', end=' ')
+    res = nse_spot_obj.get_latest_closing_prices(['ASIANPAINT', 'BRITANNIA'])
+    if res.shape[0] > 0:
+        df = nse_spot_obj.get_pv_data(['ASIANPAINT', 'BRITANNIA'],
+                                      from_to=[res['Date'].max().strftime('%Y-%m-%d')] * 2)
+        assert list(res['Close']) == list(df['Close']), 'ERROR! %s / %s' % (list(res['Close']), list(df['Close']))
+    print('OK')
+
+    print('NseSpotPVData.get_avg_closing_prices:', end=' ')
+    res = nse_spot_obj.get_avg_closing_prices(pd.DataFrame({'Symbol': ['ASIANPAINT'] * 3,
+                                                            'mid_point': ['2021-12-31', '2022-12-31', '2023-03-31']}))
+    assert (abs(res['Avg Close'] - [3425.62, 3057.05, 2784.44]) < 0.1).all(), \
+        'ERROR! %s Unexpected average values' % list(res['Avg Close'])
+    print('OK')
+
     t = elapsed_time('test_nse_spot_0')
     print('\nNseSpotPVData tests total time: %.2f' % t)
     print(70 * '-')
 
     return True, t
 
+def reference_pv_frame():
+    """
+    offline cm bhavcopy rows, 2023-01-02 to 2024-06-28, with 4 holidays & a suspension gap (BBB):
+    AAA (EQ) face value split 10 -> 2 on 2023-09-15, BBB (EQ & BE) bonus 1:1 on 2024-02-01, OLDC renamed
+    to NEWC on 2023-11-01 & NEWC bonus 1:2 on 2024-03-01. Returns the raw rows (OLDC rows named OLDC),
+    the symbol changes & the corporate actions (as NseCorporateActions.get_all_cf_ca_multipliers)
+    """
+    rng = np.random.default_rng(7)
+    holidays = pd.to_datetime(['2023-01-26', '2023-03-07', '2023-08-15', '2024-04-17'])
+    dates = pd.bdate_range('2023-01-02', '2024-06-28')
+    dates = dates[~dates.isin(holidays)]
+    cfca = pd.DataFrame({'Symbol': ['AAA', 'BBB', 'NEWC'], 'Ex Date': ['2023-09-15', '2024-02-01', '2024-03-01'],
+                         'MULT': [5.0, 2.0, 1.5]})
+    dfs = []
+    for symbol, series, price in [('AAA', 'EQ', 500.0), ('BBB', 'EQ', 120.0), ('BBB', 'BE', 118.0), ('NEWC', 'EQ', 80.0)]:
+        df = pd.DataFrame({'Date': dates, 'Symbol': symbol, 'Series': series})
+        close = np.round(price * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates)))), 2)
+        for ex_date, mult in zip(cfca.loc[cfca['Symbol'] == symbol, 'Ex Date'], cfca.loc[cfca['Symbol'] == symbol, 'MULT']):
+            close = np.where(dates >= ex_date, np.round(close / mult, 2), close)
+        df['Close'] = close
+        df['Prev Close'] = np.append(close[0], close[:-1])
+        df['Open'] = np.round(close * (1 + rng.normal(0, 0.005, len(dates))), 2)
+        df['High'] = np.round(np.maximum(df['Open'], close) * (1 + rng.random(len(dates)) / 100), 2)
+        df['Low'] = np.round(np.minimum(df['Open'], close) * (1 - rng.random(len(dates)) / 100), 2)
+        df['Volume'] = rng.integers(1000, 100000, len(dates))
+        if symbol == 'NEWC':
+            df.loc[df['Date'] < '2023-11-01', 'Symbol'] = 'OLDC'
+        if symbol == 'BBB':
+            df = df.loc[(df['Date'] < '2023-06-01') | (df['Date'] > '2023-06-20')]
+        dfs.append(df)
+    symbol_changes = pd.DataFrame({'Date of Change': ['2023-11-01'], 'Old Symbol': ['OLDC'], 'New Symbol': ['NEWC']})
+    return pd.concat(dfs, axis=0).reset_index(drop=True), symbol_changes, cfca
+
+def test_offline_references(verbose=False):
+    """ optimized code paths against the slow implementations they replaced (kept here as references) """
+    print('\nfin_data.apps.test_all.test_offline_references:')
+    print(70 * '-')
+    elapsed_time('test_offline_references_0')
+
+    raw_df, symbol_changes, cfca = reference_pv_frame()
+    saved_path = nse_symbols.PATH_1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        nse_symbols.PATH_1 = tmp_dir
+        try:
+            symbol_changes.to_csv(os.path.join(tmp_dir, 'symbolchange.csv'), index=False)
+            df = nse_symbols.apply_symbol_changes(raw_df.copy())
+        finally:
+            nse_symbols.PATH_1 = saved_path
+    assert sorted(df['Symbol'].unique()) == ['AAA', 'BBB', 'NEWC']
+
+    ''' ----------------------------------------------------------------------------------- '''
+    print('get_52week_high_low (grouped rolling):', end=' ')
+
+    def old_52week_high_low(df):
+        """ NseSpotPVData.get_52week_high_low before, for one (Symbol, Series). 1yago by DateOffset (the
+            old datetime(x.year - 1, x.month, x.day) fails on 29 Feb) """
+        df['1yago'] = df['Date'] - pd.DateOffset(years=1)
+
+        def min_max(dates):
+            df_1y = df.loc[(df['Date'] >= dates[0]) & (df['Date'] <= dates[1])]
+            id_min = df_1y['Low'].idxmin()
+            id_max = df_1y['High'].idxmax()
+            return [df_1y.at[id_min, 'Low'], df_1y.at[id_min, 'Date'],
+                    df_1y.at[id_max, 'High'], df_1y.at[id_max, 'Date']]
+
+        df['min_max'] = df.apply(lambda x: min_max([x['1yago'], x['Date']]), axis=1)
+        df['52wk_low'] = df['min_max'].apply(lambda x: x[0])
+        df['52wk_low_date'] = df['min_max'].apply(lambda x: x[1])
+        df['52wk_high'] = df['min_max'].apply(lambda x: x[2])
+        df['52wk_high_date'] = df['min_max'].apply(lambda x: x[3])
+        return df.drop(columns=['min_max', '1yago'])
+
+    x = nse_spot.get_52week_high_low(df.sample(frac=1, random_state=1))
+    y = pd.concat([old_52week_high_low(g.sort_values(by='Date').reset_index(drop=True))
+                   for _, g in df.groupby(['Symbol', 'Series'])], axis=0).reset_index(drop=True)
+    pd.testing.assert_frame_equal(x[y.columns], y, check_dtype=False)
+    print('OK')
+
+    ''' ----------------------------------------------------------------------------------- '''
+    print('adjust_for_corporate_actions_all (vectorized):', end=' ')
+
+    def old_adjust_for_corporate_actions(symbol, df_raw, cols1):
+        """ NseSpotPVData.adjust_for_corporate_actions before, one symbol at a time """
+        symbol_cfca = cfca.loc[cfca['Symbol'] == symbol]
+        for idx, cfca_row in symbol_cfca.iterrows():
+            for col in cols1:
+                df_raw.loc[df_raw['Date'] < cfca_row['Ex Date'], col] = \
+                    round(df_raw.loc[df_raw['Date'] < cfca_row['Ex Date'], col] / cfca_row['MULT'], 2)
+        return df_raw
+
+    x = nse_spot.adjust_for_corporate_actions_all(df.copy(), cfca, nse_spot.CA_PRICE_COLS)
+    y = pd.concat([old_adjust_for_corporate_actions(symbol, df.loc[df['Symbol'] == symbol].copy(), nse_spot.CA_PRICE_COLS)
+                   for symbol in df['Symbol'].unique()], axis=0)
+    pd.testing.assert_frame_equal(x, y.loc[x.index])
+    for symbol, ex_date in zip(cfca['Symbol'], cfca['Ex Date']):
+        close = x.loc[(x['Symbol'] == symbol) & (x['Series'] == 'EQ')].set_index('Date')['Close']
+        jump = close.loc[ex_date:].iloc[0] / close.loc[:ex_date].iloc[-2]
+        assert 0.8 < jump < 1.2, 'ERROR! %s adjusted close jumps %.2f on %s' % (symbol, jump, ex_date)
+    # CA Asof (process_cm_enriched / get_enriched_pv_data): rows up to the as of date adjusted for the
+    # actions up to then, the later actions applied on read
+    ca_asof = pd.Timestamp('2023-12-29')
+    z = nse_spot.adjust_for_corporate_actions_all(df.loc[df['Date'] <= ca_asof].copy(),
+                                                  cfca.loc[cfca['Ex Date'] <= '2023-12-29'], nse_spot.CA_PRICE_COLS)
+    z['CA Asof'] = ca_asof
+    z = nse_spot.adjust_for_corporate_actions_all(z, cfca.loc[pd.to_datetime(cfca['Ex Date']) > ca_asof],
+                                                  nse_spot.CA_PRICE_COLS, date_col='CA Asof')
+    pd.testing.assert_frame_equal(z.drop(columns='CA Asof'), x.loc[z.index])
+    print('OK')
+
+    ''' ----------------------------------------------------------------------------------- '''
+    print('process_dr.parse_members (pyarrow, process pool):', end=' ')
+    v02_df = raw_df.loc[raw_df['Date'] < '2023-04-01'].rename(columns={
+        'Date': 'TradDt', 'Symbol': 'TckrSymb', 'Series': 'SctySrs', 'Open': 'OpnPric', 'High': 'HghPric',
+        'Low': 'LwPric', 'Close': 'ClsPric', 'Prev Close': 'PrvsClsgPric', 'Volume': 'TtlTradgVol'})
+    v02_df['ISIN'] = v02_df['TckrSymb'].map({'AAA': 'INE000A01010', 'BBB': '', 'OLDC': 'NA'})
+    v02_df['TtlTrfVal'] = np.round(v02_df['ClsPric'] * v02_df['TtlTradgVol'] / 100000, 2)
+
+    def old_read_cm_bhavcopy_files(archive_file):
+        """ process_cm_reports before: pandas, one member at a time """
+        archive = Archiver(archive_file, mode='r', compression='zip')
+        return pd.concat([pd.read_csv(BytesIO(archive.get(f)), compression={'method': 'zip'},
+                                      keep_default_na=False, engine='pyarrow')
+                          for f in archive.keys()])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_files = []
+        for month, month_df in v02_df.groupby(v02_df['TradDt'].dt.month):
+            archive_files.append(os.path.join(tmp_dir, '%02d_cm_bhavcopy_v02.zip' % month))
+            with ZipFile(archive_files[-1], 'w') as archive:
+                for d, day_df in month_df.groupby('TradDt'):
+                    zipped = BytesIO()
+                    with ZipFile(zipped, 'w') as z:
+                        z.writestr('bhavcopy.csv', day_df.assign(TradDt=d.strftime('%Y-%m-%d')).to_csv(index=False))
+                    archive.writestr('BhavCopy_NSE_CM_0_0_0_%s_F_0000.csv.zip' % d.strftime('%Y%m%d'),
+                                     zipped.getvalue())
+        y = pd.concat([old_read_cm_bhavcopy_files(f) for f in archive_files], axis=0).reset_index(drop=True)
+        for workers in [1, 2]:
+            archives = [Archiver(f, mode='r', compression='zip') for f in archive_files]
+            x = process_dr.parse_members(process_dr.parse_bhavcopy, [(a, a.keys()) for a in archives], workers)
+            pd.testing.assert_frame_equal(x, y)
+    assert set(x['ISIN']) == {'INE000A01010', '', 'NA'}
+    print('OK')
+
+    ''' ----------------------------------------------------------------------------------- '''
+    print('NseSpotPVData compact dtypes & row-range index:', end=' ')
+    x = pv_store.compact_dtypes(df)
+    assert x['Close'].dtype == np.float32 and x['Volume'].dtype == np.int32 and x['Symbol'].dtype == 'category'
+    pd.testing.assert_frame_equal(pv_store.standard_dtypes(x), df)
+
+    def old_get_pv_data(pv_data, symbols, series='EQ', from_to=None):
+        """ NseSpotPVData.get_pv_data(adjust_for_ca=False) before: boolean masks over all rows """
+        if type(symbols) == str:
+            df = pv_data.loc[pv_data['Symbol'] == symbols]
+        else:
+            df = pv_data.loc[pv_data['Symbol'].isin(symbols)]
+        if series is not None:
+            df = df.loc[df['Series'] == series]
+        if from_to[1] is None:
+            df = df.loc[df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')]
+        else:
+            df = df.loc[(df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')) &
+                        (df['Date'] <= datetime.strptime(from_to[1], '%Y-%m-%d'))]
+        df = df.sort_values(by=['Date', 'Series', 'Symbol'])
+        return df.reset_index(drop=True)
+
+    def old_get_avg_closing_price(pv_obj, symbol, mid_point, band=5):
+        """ NseSpotPVData.get_avg_closing_price before: the symbol's own rows within 3 * band days """
+        date1 = (datetime.strptime(mid_point, '%Y-%m-%d') - timedelta(days=3*band))
+        date2 = (datetime.strptime(mid_point, '%Y-%m-%d') + timedelta(days=3*band))
+        pv_df = pv_obj.get_pv_data(symbol, from_to=[date1.strftime('%Y-%m-%d'), date2.strftime('%Y-%m-%d')],
+                                   adjust_for_ca=False)[['Date', 'Close']]
+        pv_df['DD'] = abs(pd.to_datetime(mid_point) - pv_df['Date'])
+        actual_mid_point = pv_df.sort_values(by='DD').reset_index(drop=True).loc[0, 'Date']
+        mid_point_idx = pv_df.loc[pv_df['Date'] == actual_mid_point].index[0]
+        pv_df = pv_df[mid_point_idx - (band - 1):mid_point_idx + (band + 1)]
+        return [pv_df['Date'].dt.strftime('%Y-%m-%d').values[0], pv_df['Date'].dt.strftime('%Y-%m-%d').values[-1],
+                round(pv_df['Close'].mean(), 2)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ''' 2023 compact, 2024 not, index & etf files, a trading calendar (indices_close) of 2023 only '''
+        index_df = df.loc[(df['Symbol'] == 'AAA')].drop(columns=['Symbol', 'Series']).assign(**{'Index Name': 'Nifty 50'})
+        etf_df = df.loc[(df['Symbol'] == 'BBB') & (df['Series'] == 'EQ')].assign(
+            Symbol='NIFTYBEES', UNDERLYING='NIFTY 50', SECURITY='NIPPON INDIA ETF NIFTY BEES')
+        for year in [2023, 2024]:
+            os.makedirs(os.path.join(tmp_dir, f'processed/{year}'))
+            for name, x in [('cm', df), ('index', index_df), ('etf', etf_df)]:
+                pv_store.write_pv_parquet(x.loc[x['Date'].dt.year == year],
+                                          os.path.join(tmp_dir, f'processed/{year}/{name}_bhavcopy_all.csv.parquet'),
+                                          compact=year == 2023)
+        for d in df.loc[df['Date'].dt.year == 2023, 'Date'].unique():
+            os.makedirs(os.path.join(tmp_dir, d.strftime('%Y/%m')), exist_ok=True)
+            with ZipFile(os.path.join(tmp_dir, d.strftime('%Y/%m/indices_close.zip')), 'a') as z:
+                z.writestr(d.strftime('ind_close_all_%d%m%Y.csv'), '')
+
+        pv_objs = [nse_spot.NseSpotPVData(compact=compact, data_path=tmp_dir) for compact in [False, True]]
+        assert pv_objs[1].pv_data['Close'].dtype == np.float32 and pv_objs[1].pv_data['Symbol'].dtype == 'category'
+        pd.testing.assert_frame_equal(pv_objs[0].pv_data, df.sort_values(by=['Symbol', 'Series', 'Date'], ignore_index=True))
+        for symbols, series, from_to in [
+                ('AAA', 'EQ', ['2023-01-02', None]), (['NEWC', 'BBB'], 'EQ', ['2023-10-20', '2023-11-10']),
+                (['BBB', 'AAA'], None, ['2023-05-25', '2023-06-25']), ('BBB', 'BE', ['2023-06-02', '2023-06-19']),
+                (['ZZZ', 'OLDC'], None, ['2023-01-01', None]), ('AAA', 'EQ', ['2023-08-15', '2023-08-15']),
+                ('NEWC', 'EQ', ['2023-12-20', '2024-01-10'])]:
+            y = old_get_pv_data(df, symbols, series=series, from_to=from_to)
+            for pv_obj in pv_objs:
+                x = pv_obj.get_pv_data(symbols, series=series, from_to=from_to, adjust_for_ca=False)
+                pd.testing.assert_frame_equal(x, y)
+        x = pv_objs[1].get_index_pv_data('NIFTY 50', ['2023-12-01', '2024-01-31'])
+        assert list(x['Close']) == list(index_df.loc[index_df['Date'].between('2023-12-01', '2024-01-31'), 'Close'])
+        x = pv_objs[1].get_etf_pv_data('NIFTYBEES', ['2023-06-01', '2023-06-20'])
+        assert x.shape[0] == 0, 'suspended'
+        print('OK')
+
+        ''' ------------------------------------------------------------------------------- '''
+        print('NseSpotPVData.get_avg_closing_prices (batch, trading calendar):', end=' ')
+        pv_obj = pv_objs[1]
+        assert pv_obj.calendar.covers('2023-06-15') and not pv_obj.calendar.covers('2024-02-15')
+        mid_points = ['2023-01-26', '2023-03-04', '2023-06-10', '2023-06-21', '2023-09-15', '2023-11-01',
+                      '2024-02-01', '2024-02-29', '2024-03-02', '2024-04-17', '2024-05-15']
+        requests = pd.DataFrame([(symbol, mid_point, band) for symbol in ['AAA', 'BBB', 'NEWC']
+                                 for mid_point in mid_points for band in [1, 5]], columns=['Symbol', 'mid_point', 'band'])
+        x = pv_obj.get_avg_closing_prices(requests, adjust_for_ca=False)
+        for symbol, mid_point, band, date_from, date_to, avg_close in \
+                zip(*[x[c] for c in ['Symbol', 'mid_point', 'band', 'From', 'To', 'Avg Close']]):
+            try:
+                y = pv_obj.get_avg_closing_price(symbol, mid_point, band=band, adjust_for_ca=False)
+            except ValueError:
+                assert date_from is None, 'ERROR! %s %s %d' % (symbol, mid_point, band)
+                continue
+            assert [date_from, date_to, avg_close] == y, 'ERROR! %s %s %d: %s' % (symbol, mid_point, band, y)
+            ''' same as before where the calendar does not cover the window, or the symbol trades every day '''
+            if symbol != 'BBB' or not pv_obj.calendar.covers(mid_point):
+                z = old_get_avg_closing_price(pv_objs[0], symbol, mid_point, band=band)
+                assert y == z, 'ERROR! %s %s %d: %s, before %s' % (symbol, mid_point, band, y, z)
+        assert x.loc[(x['Symbol'] == 'BBB') & (x['mid_point'] == '2023-06-10'), 'From'].isna().all(), 'suspended'
+    print('OK')
+
+    ''' ----------------------------------------------------------------------------------- '''
+    print('process_dr.process_fo_reports (streaming, compact):', end=' ')
+    fo_dfs = []
+    for instr, symbol, strikes in [('STF', 'AAA', [None]), ('STF', 'BBB', [None]), ('STF', 'OLDC', [None]),
+                                   ('STO', 'AAA', [450.0, 500.0]), ('IDF', 'AAA', [None])]:
+        x = raw_df.loc[(raw_df['Symbol'] == symbol) & (raw_df['Series'] == 'EQ') & (raw_df['Date'] < '2023-04-01')]
+        for i, expiry in enumerate(['2023-03-30', '2023-04-27']):
+            for strike in strikes:
+                for option_type in ([''] if strike is None else ['CE', 'PE']):
+                    intrinsic = x['Close'].values - strike if option_type == 'CE' else \
+                        strike - x['Close'].values if option_type == 'PE' else 0
+                    close = x['Close'].values + i if strike is None else np.round(np.maximum(intrinsic, 0) + 1 + i, 2)
+                    fo_dfs.append(pd.DataFrame({
+                        'TradDt': x['Date'].values, 'FinInstrmTp': instr, 'TckrSymb': 'NIFTY' if instr == 'IDF' else symbol,
+                        'ISIN': '', 'XpryDt': expiry, 'StrkPric': '' if strike is None else strike, 'OptnTp': option_type,
+                        'OpnPric': close, 'HghPric': close, 'LwPric': close, 'ClsPric': close, 'SttlmPric': close,
+                        'OpnIntrst': x['Volume'].values * 10, 'ChngInOpnIntrst': 100,
+                        'TtlTradgVol': x['Volume'].values // 10,
+                        'TtlTrfVal': np.round(close * x['Volume'].values, 2), 'TtlNbOfTxsExctd': 5}))
+    fo_df = pd.concat(fo_dfs, axis=0)
+    ''' March: OI beyond int32, compact files started in int32 are widened '''
+    fo_df.loc[(fo_df['TckrSymb'] == 'OLDC') & (fo_df['TradDt'] >= '2023-03-01'), 'OpnIntrst'] *= 100000
+
+    def old_process_fo_reports(archive_files):
+        """ process_fo_reports before: all the year's members at once, (renames as now) sorted by instr type """
+        df = pd.concat([pd.concat([pd.read_csv(BytesIO(a.get(f)), compression={'method': 'zip'},
+                                               keep_default_na=False, engine='pyarrow') for f in a.keys()])
+                        for a in [Archiver(f, mode='r', compression='zip') for f in archive_files]], axis=0)
+        df.rename(columns={
+            'TradDt': 'date', 'FinInstrmTp': 'instr_type', 'TckrSymb': 'symbol', 'XpryDt': 'expiry_date',
+            'StrkPric': 'strike_price', 'OptnTp': 'option_type',
+            'OpnPric': 'open', 'HghPric': 'high', 'LwPric': 'low', 'ClsPric': 'close', 'SttlmPric': 'settlement_price',
+            'OpnIntrst': 'open_interest', 'ChngInOpnIntrst': 'change_in_oi',
+            'TtlTradgVol': 'trading_volume', 'TtlTrfVal': 'trading_value'}, inplace=True)
+        df = df[process_dr.FO_COLUMNS].reset_index(drop=True)
+        df['date'] = pd.to_datetime(df['date'])
+        df['expiry_date'] = pd.to_datetime(df['expiry_date'])
+        df['strike_price'] = df['strike_price'].replace('', np.nan).astype(float)
+        df = nse_symbols.apply_symbol_changes(df, column='symbol')
+        return {instr: df.loc[df['instr_type'] == instr].sort_values(by=['date', 'symbol', 'expiry_date'], kind='stable')
+                for instr in ['IDF', 'STF', 'STO']}
+
+    saved = process_dr.PATH_1, process_dr.PATH_2, nse_symbols.PATH_1, process_dr.FO_FUTURES_ROW_GROUP_ROWS
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        process_dr.PATH_1, process_dr.PATH_2 = tmp_dir, os.path.join(tmp_dir, 'processed')
+        nse_symbols.PATH_1 = tmp_dir
+        process_dr.FO_FUTURES_ROW_GROUP_ROWS = 50
+        try:
+            symbol_changes.to_csv(os.path.join(tmp_dir, 'symbolchange.csv'), index=False)
+            os.makedirs(os.path.join(tmp_dir, 'processed/2023'))
+            archive_files = []
+            for month, month_df in fo_df.groupby(fo_df['TradDt'].dt.month):
+                archive_files.append(os.path.join(tmp_dir, '2023/%02d/fo_bhavcopy_v02.zip' % month))
+                os.makedirs(os.path.dirname(archive_files[-1]))
+                with ZipFile(archive_files[-1], 'w') as archive:
+                    for d, day_df in month_df.groupby('TradDt'):
+                        zipped = BytesIO()
+                        with ZipFile(zipped, 'w') as z:
+                            z.writestr('fo.csv', day_df.assign(TradDt=d.strftime('%Y-%m-%d')).to_csv(index=False))
+                        archive.writestr('BhavCopy_NSE_FO_0_0_0_%s_F_0000.csv.zip' % d.strftime('%Y%m%d'),
+                                         zipped.getvalue())
+            y = old_process_fo_reports(archive_files)
+            for compact in [False, True]:
+                process_dr.process_fo_reports(2023, compact=compact, verify=True)
+                for instr in ['IDF', 'STF', 'STO']:
+                    fo_file = os.path.join(tmp_dir, 'processed/2023/fo_bhavcopy_%s.csv.parquet' % instr)
+                    x = pv_store.read_pv_parquet(fo_file)
+                    pd.testing.assert_frame_equal(x, y[instr].reset_index(drop=True), check_dtype=False)
+                    ''' whole days per row group: one for options, up to 50 rows for futures (every day has as many rows) '''
+                    pf = pq.ParquetFile(fo_file)
+                    n_days = [len(set(pf.read_row_group(rg, columns=['date']).column('date').to_pylist()))
+                              for rg in range(pf.metadata.num_row_groups)]
+                    assert sum(n_days) == len(set(x['date'])), 'ERROR! %s: a day in 2 row groups' % instr
+                    per_group = 1 if instr == 'STO' else 50 // (x.shape[0] // sum(n_days))
+                    expected = [per_group] * (sum(n_days) // per_group) + [sum(n_days) % per_group]
+                    assert n_days == [n for n in expected if n > 0], 'ERROR! %s: days per row group %s' % (instr, n_days)
+                schema = pq.read_schema(os.path.join(tmp_dir, 'processed/2023/fo_bhavcopy_STF.csv.parquet'))
+                types = [str(schema.field(c).type) for c in ['date', 'close', 'trading_volume', 'open_interest']]
+                assert types == (['timestamp[ns]', 'double', 'int64', 'int64'] if not compact else
+                                 ['date32[day]', 'float', 'int32', 'int64']), 'ERROR! STF types %s' % types
+            x = nse_fo.NseFOData(data_path=tmp_dir).get_futures_curve('NEWC', '2023-03-15')
+            z = y['STF'].loc[(y['STF']['symbol'] == 'NEWC') & (y['STF']['date'] == '2023-03-15')]
+            assert list(x['close']) == list(z['close']) and len(z) == 2
+        finally:
+            process_dr.PATH_1, process_dr.PATH_2, nse_symbols.PATH_1, process_dr.FO_FUTURES_ROW_GROUP_ROWS = saved
+    print('OK')
+
+    ''' ----------------------------------------------------------------------------------- '''
+    print('base_utils.parse_xbrl_data (facts dict):', end=' ')
+
+    def old_parse_xbrl_facts(xbrl_data, corrections=None):
+        """ parse_xbrl_data before: the facts table grown a row at a time & the header lookups on it """
+        df = pd.DataFrame(columns=['tag', 'context'])
+        root = ElementTree.fromstring(xbrl_data)
+        for item in root:
+            if item.tag.startswith('{http://www.bseindia.com/xbrl/fin/'):
+                tag = item.tag.split('}')[1]
+                context = item.attrib['contextRef']
+                if tag.find('Disclosure') != -1: continue
+                if not ((df['tag'] == tag) & (df['context'] == context)).any():
+                    df.loc[len(df.index)] = {'tag': tag, 'context': context}
+                idx = df[(df['tag'] == tag) & (df['context'] == context)].index[0]
+                df.at[idx, 'value'] = item.text
+        df1 = df.copy()
+        for corr in ([] if corrections is None else corrections):
+            df.loc[(df['tag'] == corr['tag']) & (df['context'] == corr['context']), 'value'] = corr['value']
+
+        def get_value(tag_value, value_if_not_found='not-found'):
+            return df.loc[df['tag'] == tag_value, 'value'].values[0] \
+                if df['tag'].str.contains(tag_value).any() else value_if_not_found
+
+        header = {'NSE Symbol': get_value('Symbol'), 'BSE Code': get_value('ScripCode'), 'ISIN': get_value('ISIN'),
+                  'period_start': get_value('DateOfStartOfReportingPeriod'),
+                  'period_end': get_value('DateOfEndOfReportingPeriod'),
+                  'result_type': get_value('NatureOfReportStandaloneConsolidated'),
+                  'reporting_qtr': df.loc[df['tag'] == 'ReportingQuarter', 'value'].values[0],
+                  'audited': df.loc[df['tag'] == 'WhetherResultsAreAuditedOrUnaudited', 'value'].values[0],
+                  'company_name': df.loc[df['tag'].str.startswith('NameOf'), 'value'].values[0]}
+        return df1, df, header
+
+    rng = random.Random(21)
+    ns = 'http://www.bseindia.com/xbrl/fin/2020-03-31/in-bse-fin'
+    for bank in [False, True]:
+        header_facts = {'ISIN': 'INE000A01010', 'Symbol': 'NEWC', 'ScripCode': '500001',
+                        'DateOfStartOfReportingPeriod': '2023-10-01', 'DateOfEndOfReportingPeriod': '2023-12-31',
+                        'NatureOfReportStandaloneConsolidated': 'Standalone', 'ReportingQuarter': 'Third quarter',
+                        'WhetherResultsAreAuditedOrUnaudited': 'Unaudited', 'NameOfTheCompany': 'NEWC Ltd',
+                        'ResultType': 'Banking Format' if bank else 'Main Format', 'DisclosureOfNotes': 'x'}
+        facts = [(t, 'OneD', v) for t, v in header_facts.items()] + \
+            [('Assets', 'OneI', '100'), ('Equity', 'OneI', '50'), ('Liabilities', 'OneI', '50')]
+        ''' repeated (tag, context) facts: the last value wins, at the first one's position '''
+        facts += [('Tag%d' % rng.randrange(100), rng.choice(['OneD', 'FourD', 'OneI']), str(rng.random()))
+                  for _ in range(300)]
+        rng.shuffle(facts)
+        xbrl_data = ('<?xml version="1.0" encoding="UTF-8"?><xbrli:xbrl xmlns:xbrli="http://www.xbrl.org/2003/instance" '
+                     'xmlns:in-bse-fin="%s"><xbrli:context id="OneD"/>%s</xbrli:xbrl>' %
+                     (ns, ''.join('<in-bse-fin:%s contextRef="%s">%s</in-bse-fin:%s>' % (t, c, v, t)
+                                  for t, c, v in facts))).encode()
+        corrections = [{'tag': 'Assets', 'context': 'OneI', 'value': '7'}]
+        x = base_utils.parse_xbrl_data(xbrl_data, corrections=corrections)
+        xbrl_df, parsed_df, header = old_parse_xbrl_facts(xbrl_data, corrections=corrections)
+        assert x['xbrl_df'].equals(xbrl_df) and x['parsed_df'].equals(parsed_df)
+        assert {k: x[k] for k in header.keys()} == header, '%s != %s' % ({k: x[k] for k in header.keys()}, header)
+        assert x['result_format'] == ('banking' if bank else 'default')
+        y = base_utils.parse_xbrl_data(None, xbrl_df=x['xbrl_df'], corrections=corrections)
+        assert y['parsed_df'].equals(parsed_df) and {k: y[k] for k in header.keys()} == header
+    print('OK')
+
+    t = elapsed_time('test_offline_references_0')
+    print('\noffline reference tests total time: %.2f' % t)
+    print(70 * '-')
+    return True, t
+
 def test_perf_nse_pv(verbose=False):
     print('\nfin_data.apps.test_me.test_perf_nse_pv:')
     print(70 * '-')
@@ -206,6 +630,10 @@ def test_perf_nse_pv(verbose=False):
             print('\n    %s: ERROR: %s' % (s, e))
     print('time: %.2f sec' % elapsed_time('tpnp_1'))
 
+    print('Step5: Same 50 in one get_avg_closing_prices:', end=' ')
+    _ = nse_spot_obj.get_avg_closing_prices(pd.DataFrame({'Symbol': select_symbols, 'mid_point': '2024-01-15'}))
+    print('time: %.2f sec' % elapsed_time('tpnp_1'))
+
     t = elapsed_time('tpnp_0')
     print('test_nse_spot: total time taken: %.2f' % t)
     print(70 * '-')
@@ -217,9 +645,17 @@ def test_me():
     test_outcomes = {}
     test_outcomes['nse_symbols.test_me'] = nse_symbols.test_me()
     test_outcomes['nse_cf_ca.test_me']   = nse_cf_ca.test_me()
+    test_outcomes['http_pool.test_me']   = http_pool.test_me()
+    test_outcomes['get_dr.test_me']      = get_dr.test_me()
+    test_outcomes['process_dr.test_me']  = process_dr.test_me()
+    test_outcomes['trading_calendar.test_me'] = trading_calendar.test_me()
+    test_outcomes['test_offline_references'] = test_offline_references()
+    test_outcomes['nse_fo.test_me'] = nse_fo.test_me()
     test_outcomes['test_nse_spot']       = test_nse_spot()
     test_outcomes['test_perf_nse_pv']    = test_perf_nse_pv()
     test_outcomes['base_utils.test_me']  = base_utils.test_me()
+    test_outcomes['fact_store.test_me']  = fact_store.test_me()
+    test_outcomes['download_fr.test_me'] = download_fr.test_me()
 
     outcome_str = '\nSUMMARY:fin_data.apps.test_all outcome summary:\n%s' % (70 * '-')
     for k in test_outcomes.keys():
@@ -0,0 +1,167 @@
+"""
+Pooled HTTP downloads: one keep-alive requests.Session shared by a bounded thread pool, with a per
+host rate limit & retry / backoff on connection errors, 429 & 5xx. Also a local HTTP server (test
+fixture) to test downloaders offline
+"""
+''' --------------------------------------------------------------------------------------- '''
+
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from pygeneric.datetime_utils import elapsed_time
+
+''' --------------------------------------------------------------------------------------- '''
+class RateLimiter:
+    """ at most rate requests per second to any one host (rate=None: no limit), thread safe """
+    def __init__(self, rate=None):
+        self.interval = 0.0 if rate is None else 1.0 / rate
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+        return
+
+class HttpPool:
+    """
+    max_workers concurrent requests over one requests.Session (connections are reused), rate requests
+    per second per host, max_tries attempts per url with backoff * 2 ** (try - 1) seconds in between
+    """
+    def __init__(self, max_workers=8, rate=10, max_tries=4, backoff=0.5, timeout=30, headers=None):
+        self.max_workers = max_workers
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers is not None:
+            self.session.headers.update(headers)
+
+    def fetch(self, url):
+        """
+        (status, content) of url: content is None if not found (4xx other than 429) or still failing
+        after max_tries, status is the last HTTP status (None: connection error)
+        """
+        host = urlsplit(url).netloc
+        status = None
+        for attempt in range(self.max_tries):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.rate_limiter.wait(host)
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException:
+                status = None
+                continue
+            status = r.status_code
+            if r.ok:
+                return status, r.content
+            if status != 429 and status < 500:
+                return status, None
+        return status, None
+
+    def get(self, url):
+        """ content of url, None if not found or still failing after max_tries """
+        return self.fetch(url)[1]
+
+    def fetch_many(self, urls):
+        """ fetch for all urls, max_workers at a time. (status, content) in the order of urls """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.fetch, urls))
+
+    def get_many(self, urls):
+        """ contents (or None) of urls, in their order, see fetch_many """
+        return [content for _, content in self.fetch_many(urls)]
+
+    def close(self):
+        self.session.close()
+
+''' local HTTP server (test fixture) ------------------------------------------------------- '''
+class LocalHttpServer:
+    """
+    serves routes {path: content} on 127.0.0.1 from a background thread, 404 for any other path.
+    content: bytes, or a list of HTTP status codes to fail with first, then the bytes. Keeps the
+    request times per path & the client connections seen. Use as a context manager
+    """
+    def __init__(self, routes):
+        self.routes = {p: (list(c[:-1]), c[-1]) if type(c) == list else ([], c) for p, c in routes.items()}
+        self.requests = {}
+        self.connections = set()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests.setdefault(self.path, []).append(time.monotonic())
+                    server.connections.add(self.client_address)
+                    failures, content = server.routes.get(self.path, ([404], None))
+                    status = failures.pop(0) if len(failures) > 0 and content is not None else \
+                        (404 if content is None else 200)
+                body = content if status == 200 else b''
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+''' --------------------------------------------------------------------------------------- '''
+def test_me():
+    print('fin_data.common.http_pool.test_me:', end=' ')
+    elapsed_time('fin_data.common.http_pool.test_me')
+
+    routes = {'/f%02d.csv' % i: b'file %d' % i for i in range(20)}
+    routes['/flaky.csv'] = [503, 429, b'flaky']
+    routes['/down.csv'] = [503] * 10 + [b'never']
+    urls = sorted(routes.keys()) + ['/missing.csv']
+    with LocalHttpServer(routes) as server:
+        pool = HttpPool(max_workers=4, rate=None, max_tries=3, backoff=0.01)
+        contents = pool.get_many([server.base_url + u for u in urls])
+        expected = [None if u in ['/down.csv', '/missing.csv'] else
+                    (b'flaky' if u == '/flaky.csv' else routes[u]) for u in urls]
+        assert contents == expected, 'ERROR! contents %s' % contents
+        assert pool.fetch(server.base_url + '/missing.csv') == (404, None), 'ERROR! fetch'
+        pool.close()
+        assert len(server.requests['/flaky.csv']) == 3 and len(server.requests['/down.csv']) == 3 and \
+            len(server.requests['/missing.csv']) == 2, 'ERROR! retries'
+        assert len(server.connections) <= 4, 'ERROR! %d connections' % len(server.connections)
+
+    with LocalHttpServer({'/x%d' % i: b'x' for i in range(6)}) as server:
+        pool = HttpPool(max_workers=4, rate=20)
+        pool.get_many([server.base_url + '/x%d' % i for i in range(6)])
+        pool.close()
+        times = sorted(t for ts in server.requests.values() for t in ts)
+        assert times[-1] - times[0] >= 5 / 20 * 0.9, 'ERROR! rate limit %.3f' % (times[-1] - times[0])
+
+    print('OK')
+    return True, elapsed_time('fin_data.common.http_pool.test_me')
+
+''' --------------------------------------------------------------------------------------- '''
+if __name__ == '__main__':
+    test_me()
@@ -5,25 +5,33 @@ Corporate Actions (bonus & split) history for NSE Symbols
 
 from fin_data.env import *
 import glob
+import hashlib
+import json
 import os
 import sys
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
 from pygeneric.datetime_utils import elapsed_time
 
 PATH_1 = os.path.join(DATA_ROOT, '00_common/03_nse_cf_ca')
+MULT_TABLE_FILE = os.path.join(PATH_1, 'CF_CA_MULT.parquet')
+MULT_COLUMNS = ['Symbol', 'Ex Date', 'MULT', 'CUM_MULT', 'Purpose', 'source', 'source_row']
+CF_CA_COLUMNS = ['Symbol', 'Series', 'Face Value', 'Ex Date', 'Record Date', 'Purpose']
 
 ''' --------------------------------------------------------------------------------------- '''
 class NseCorporateActions:
     def __init__(self, verbose=False):
         self.verbose = verbose
         ca_files = glob.glob(os.path.join(PATH_1, 'CF_CA_*.csv'))
-        df = pd.concat([pd.read_csv(f) for f in ca_files], axis=0)
-        df = pd.concat([pd.read_csv(f) for f in ca_files], axis=0)
+        df = pd.concat([pd.read_csv(f) for f in ca_files], axis=0) if len(ca_files) > 0 else \
+            pd.DataFrame(columns=CF_CA_COLUMNS)
         df['Ex Date'] = pd.to_datetime(pd.to_datetime(df['Ex Date']), '%Y-%m-%d')
         self.cf_data = df.reset_index(drop=True)
         if self.verbose:
             print('NseCorporateActions: cf_data', self.cf_data.shape)
+        self.cf_mult = build_cf_ca_mult_table(verbose=verbose)
         self.cf_mult_cache = {}
         self.__status__ = True
 
@@ -47,54 +55,116 @@ class NseCorporateActions:
             return xx
 
     def get_cf_ca_multipliers(self, symbol, cutoff_date='2018-01-01', cache=True):
+        """ lookup in the persisted multipliers table (see build_cf_ca_mult_table) """
         cache_key = '%s-%s' % (symbol, cutoff_date)
         if cache and cache_key in self.cf_mult_cache.keys():
             return self.cf_mult_cache[cache_key]
 
-        ca_df = self.get_history(symbol, cutoff_date=cutoff_date)
-        ca_df = ca_df.loc[ca_df['Purpose'].str.contains('^Bonus') |\
-                          ca_df['Purpose'].str.contains('^Face Value Split')]
-
-        ca_df['Ex Date'] = pd.to_datetime(ca_df['Ex Date'])
-        ca_df['Ex Date'] = ca_df['Ex Date'].apply(lambda x: x.strftime('%Y-%m-%d'))
-        ca_df = ca_df.sort_values(by='Ex Date', ascending=True).reset_index(drop=True)
-        ca_df = ca_df[['Symbol', 'Purpose', 'Ex Date']].reset_index(drop=True)
-
-        ca_df['MULT'] = 1.0
-
-        for idx, row in ca_df.iterrows():
-            purpose = row['Purpose'].strip()
-            purpose = purpose.replace('/', ' / ').replace('Rs', ' Rs ').replace('Re', ' Re ')
-            mult    = row['MULT']
-            if purpose[0:16] == 'Face Value Split':
-                tok = re.split('Rs | Re ', purpose)
-                # if symbol == 'NESTLEIND': print('tok:::', tok)
-                try:
-                    mult *= float(tok[1].split(' / -')[0].strip()) / \
-                            float(tok[2].split(' / -')[0].strip())
-                except:
-                    try:
-                        mult *= float(tok[1].split('Per')[0].strip()) / \
-                                float(tok[2].split('Per')[0].strip())
-                    except:
-                        assert False, '[%s] [%s] [%s]' % (row['Symbol'], row['Ex Date'], purpose)
-            elif purpose[0:5] == 'Bonus':
-                try:
-                    tok = purpose.split()[1].split(':')
-                    mult *= (float(tok[0].strip()) + float(tok[1].strip())) / float(tok[1].strip())
-                except:
-                    try:
-                        x = purpose.split(' ')
-                        tok = x[-1].split(':')
-                        mult *= (float(tok[0].strip()) + float(tok[1].strip())) / float(tok[1].strip())
-                    except:
-                        assert False, '[%s] [%s] [%s]' % (row['Symbol'], row['Ex Date'], purpose)
-            else:
-                assert 1 == 0
-            ca_df.loc[idx, 'MULT'] = mult
+        ca_df = self.cf_mult.loc[(self.cf_mult['Symbol'] == symbol) & (self.cf_mult['Ex Date'] >= cutoff_date)]
+        assert ca_df['MULT'].notnull().all(), 'Unparsed Purpose %s' % ca_df.loc[ca_df['MULT'].isnull()].values
+        ca_df = ca_df[['Symbol', 'Ex Date', 'MULT', 'Purpose']].reset_index(drop=True)
         if cache:
-            self.cf_mult_cache[cache_key] = ca_df[['Symbol', 'Ex Date', 'MULT', 'Purpose']]
-        return ca_df[['Symbol', 'Ex Date', 'MULT', 'Purpose']]
+            self.cf_mult_cache[cache_key] = ca_df
+        return ca_df
+
+    def get_all_cf_ca_multipliers(self, cutoff_date='2018-01-01', symbols=None):
+        """ get_cf_ca_multipliers for all (or given) symbols at once, sorted by Symbol / Ex Date """
+        ca_df = self.cf_mult.loc[self.cf_mult['Ex Date'] >= cutoff_date]
+        if symbols is not None:
+            ca_df = ca_df.loc[ca_df['Symbol'].isin(symbols)]
+        assert ca_df['MULT'].notnull().all(), 'Unparsed Purpose %s' % ca_df.loc[ca_df['MULT'].isnull()].values
+        return ca_df[['Symbol', 'Ex Date', 'MULT', 'Purpose']].reset_index(drop=True)
+
+def build_cf_ca_mult_table(verbose=False):
+    """
+    Bonus & face value split multipliers for all EQ symbols, persisted to CF_CA_MULT.parquet (next to
+    the CF_CA_*.csv files). Columns: MULT_COLUMNS, CUM_MULT: product of MULT of the symbol's actions
+    through the Ex Date (in Ex Date order, recomputed for all rows on every rebuild). md5 of every CF_CA file is kept in the parquet
+    metadata & only new or changed CF_CA files are parsed again. The file is replaced, never written
+    in place, so readers see the old or the new table
+    """
+    sources = {os.path.basename(f): hashlib.md5(open(f, 'rb').read()).hexdigest()
+               for f in sorted(glob.glob(os.path.join(PATH_1, 'CF_CA_*.csv')))}
+    if len(sources) == 0:
+        print('build_cf_ca_mult_table: WARNING! no CF_CA files in %s' % PATH_1)
+        return pd.DataFrame(columns=MULT_COLUMNS)
+    if os.path.exists(MULT_TABLE_FILE):
+        table = pq.read_table(MULT_TABLE_FILE)
+        built_from = json.loads(table.schema.metadata[b'cf_ca_sources'])
+        mult_df = table.to_pandas()
+    else:
+        built_from, mult_df = {}, None
+
+    to_parse = [f for f in sources.keys() if built_from.get(f) != sources[f]]
+    if len(to_parse) == 0 and built_from.keys() == sources.keys() and list(mult_df.columns) == MULT_COLUMNS:
+        return mult_df
+
+    unchanged = [f for f in sources.keys() if f not in to_parse]
+    dfs = [] if mult_df is None else [mult_df.loc[mult_df['source'].isin(unchanged)]]
+    for f in to_parse:
+        df = pd.read_csv(os.path.join(PATH_1, f))
+        df = df.loc[df['Series'] == 'EQ', ['Symbol', 'Purpose', 'Ex Date']]
+        df['Purpose'] = df['Purpose'].str.strip()
+        df = df.loc[df['Purpose'].str.contains('^Bonus', na=False) |
+                    df['Purpose'].str.contains('^Face Value Split', na=False)]
+        df['Ex Date'] = pd.to_datetime(df['Ex Date']).dt.strftime('%Y-%m-%d')
+
+        def multiplier(symbol, ex_date, purpose):
+            try:
+                return get_multiplier(symbol, ex_date, purpose)
+            except AssertionError:
+                print('build_cf_ca_mult_table: WARNING! cannot parse [%s] [%s] [%s]' % (symbol, ex_date, purpose))
+                return None
+        df['MULT'] = pd.Series([multiplier(r[0], r[1], r[2])
+                                for r in zip(df['Symbol'], df['Ex Date'], df['Purpose'])],
+                               index=df.index, dtype=float)
+        df['source'] = f
+        df['source_row'] = range(df.shape[0])
+        dfs.append(df)
+
+    mult_df = pd.concat(dfs).sort_values(by=['Symbol', 'Ex Date', 'source', 'source_row']).reset_index(drop=True)
+    mult_df['CUM_MULT'] = mult_df.groupby('Symbol')['MULT'].cumprod()
+    mult_df = mult_df[MULT_COLUMNS]
+
+    table = pa.Table.from_pandas(mult_df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'cf_ca_sources': json.dumps(sources)})
+    tmp_file = '%s.%d.tmp' % (MULT_TABLE_FILE, os.getpid())
+    pq.write_table(table, tmp_file)
+    os.replace(tmp_file, MULT_TABLE_FILE)
+    if verbose:
+        print('build_cf_ca_mult_table: parsed %s, %d rows' % (to_parse, mult_df.shape[0]))
+
+    return mult_df
+
+def get_multiplier(symbol, ex_date, purpose):
+    purpose = purpose.strip()
+    purpose = purpose.replace('/', ' / ').replace('Rs', ' Rs ').replace('Re', ' Re ')
+    mult    = 1.0
+    if purpose[0:16] == 'Face Value Split':
+        tok = re.split('Rs | Re ', purpose)
+        try:
+            mult *= float(tok[1].split(' / -')[0].strip()) / \
+                    float(tok[2].split(' / -')[0].strip())
+        except:
+            try:
+                mult *= float(tok[1].split('Per')[0].strip()) / \
+                        float(tok[2].split('Per')[0].strip())
+            except:
+                assert False, '[%s] [%s] [%s]' % (symbol, ex_date, purpose)
+    elif purpose[0:5] == 'Bonus':
+        try:
+            tok = purpose.split()[1].split(':')
+            mult *= (float(tok[0].strip()) + float(tok[1].strip())) / float(tok[1].strip())
+        except:
+            try:
+                x = purpose.split(' ')
+                tok = x[-1].split(':')
+                mult *= (float(tok[0].strip()) + float(tok[1].strip())) / float(tok[1].strip())
+            except:
+                assert False, '[%s] [%s] [%s]' % (symbol, ex_date, purpose)
+    else:
+        assert 1 == 0
+    return mult
 
 def test_me():
     print('fin_data.common.nse_cf_ca.test_me:', end=' ')
@@ -118,6 +188,18 @@ def test_me():
         x2 = {'Ex Date':list(x1['Ex Date']), 'MULT':list(x1['MULT'])}
         assert x2 == test_data[symbol], 'ERROR! cf_ca_multpliers not matching, %s/%s' \
                                         % (x2, test_data[symbol])
+    all_mults = nse_ca_obj.get_all_cf_ca_multipliers(cutoff_date=test_dates[0])
+    for symbol in test_data.keys():
+        x1 = all_mults.loc[(all_mults['Symbol'] == symbol) & (all_mults['Ex Date'] <= test_dates[1])]
+        assert list(x1['MULT']) == test_data[symbol]['MULT'], 'ERROR! all_cf_ca_multpliers: %s' % symbol
+    mult_df = build_cf_ca_mult_table()
+    for symbol, x1 in mult_df.groupby('Symbol'):
+        cum_mult, x2 = 1.0, []
+        for mult in x1.sort_values(by='Ex Date', kind='stable')['MULT']:
+            cum_mult = cum_mult if pd.isna(mult) else cum_mult * mult
+            x2.append(None if pd.isna(mult) else cum_mult)
+        assert list(x1['CUM_MULT'].fillna(-1.0)) == list(pd.Series(x2, dtype=float).fillna(-1.0)), \
+            'ERROR! CUM_MULT: %s' % symbol
     print('OK')
     return True, elapsed_time('fin_data.common.nse_cf_ca.test_me')
 
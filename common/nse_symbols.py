@@ -7,6 +7,9 @@ from fin_data.env import *
 import os
 import sys
 import glob
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 from pygeneric.datetime_utils import elapsed_time
 
@@ -42,6 +45,33 @@ def get_symbol_changes(cutoff_date='2018-01-01'):
     df = df.sort_values(by='Date of Change').reset_index(drop=True)
     return df[['Date of Change', 'Old Symbol', 'New Symbol']]
 
+def get_symbol_map(cutoff_date='2018-01-01'):
+    """
+    {old symbol: current symbol}, chained changes resolved (A -> B & later B -> C give A: C, B: C).
+    Same result as applying get_symbol_changes one at a time, in date order
+    """
+    sc_df = get_symbol_changes(cutoff_date)
+    symbol_map = {}
+    for old, new in zip(sc_df['Old Symbol'], sc_df['New Symbol']):
+        for k in [k for k, v in symbol_map.items() if v == old]:
+            symbol_map[k] = new
+        if old not in symbol_map.keys():
+            symbol_map[old] = new
+    return {k: v for k, v in symbol_map.items() if k != v}
+
+def symbol_changes_signature(cutoff_date='2018-01-01'):
+    """ hash of the symbol changes apply_symbol_changes applies (get_symbol_map) """
+    symbol_map = sorted(get_symbol_map(cutoff_date).items())
+    return hashlib.sha1(json.dumps(symbol_map).encode()).hexdigest()
+
+def apply_symbol_changes(df, column='Symbol', cutoff_date='2018-01-01'):
+    """ old symbols in df[column] renamed to current ones (get_symbol_map), mapped once per distinct symbol """
+    symbol_map = get_symbol_map(cutoff_date)
+    codes, uniques = pd.factorize(df[column])
+    new_uniques = np.array([symbol_map.get(s, s) for s in uniques] + [np.nan], dtype=object)
+    df[column] = new_uniques[codes]  # code -1 (missing) picks the trailing nan
+    return df
+
 def get_older_symbols(symbol):
     df = get_symbol_changes()
     df = df.loc[df['New Symbol'] == symbol].reset_index(drop=True)
@@ -90,6 +120,10 @@ def test_me():
     assert get_older_symbols('ZYDUSLIFE') == ['CADILAHC']
     assert get_older_symbols('LTIM') == ['LTI']
 
+    assert get_symbol_map()['CADILAHC'] == 'ZYDUSLIFE'
+    x = apply_symbol_changes(pd.DataFrame({'Symbol': ['LTI', 'ASIANPAINT', 'CADILAHC', None, 'LTI']}))
+    assert list(x['Symbol'].fillna('-')) == ['LTIM', 'ASIANPAINT', 'ZYDUSLIFE', '-', 'LTIM']
+
     assert get_isin('ZYDUSLIFE') == 'INE010B01027'
     print('OK')
 
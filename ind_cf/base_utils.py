@@ -27,23 +27,24 @@ def prepare_json_key(row):
            '&industry=%s&frOldNewFlag=%s' % (industry, oldNewFlag) + \
            '&ind=%s&format=%s' % (reInd, format_x)
 
-def parse_xbrl_data(xbrl_data, xbrl_df=None, corrections=None):
-    if xbrl_data is not None:  # xbrl_data has primacy
-        df = pd.DataFrame(columns=['tag', 'context'])
-        root = ElementTree.fromstring(xbrl_data)
-        for item in root:
-            if item.tag.startswith('{http://www.bseindia.com/xbrl/fin/'):
-                tag = item.tag.split('}')[1]
-                '''print(child.attrib['contextRef'])'''
-                context = item.attrib['contextRef']  # this should always be there
+def xbrl_facts(xbrl_data):
+    """ {(tag, context): value} of the facts, in order of first appearance (repeated fact: last value) """
+    facts = {}
+    root = ElementTree.fromstring(xbrl_data)
+    for item in root:
+        if item.tag.startswith('{http://www.bseindia.com/xbrl/fin/'):
+            tag = item.tag.split('}')[1]
+            context = item.attrib['contextRef']  # this should always be there
 
-                if tag.find('Disclosure') != -1: continue
+            if tag.find('Disclosure') != -1: continue
 
-                if not ((df['tag'] == tag) & (df['context'] == context)).any():  # add not already
-                    df.loc[len(df.index)] = {'tag': tag, 'context': context}
+            facts[(tag, context)] = item.text
+    return facts
 
-                idx = df[(df['tag'] == tag) & (df['context'] == context)].index[0]
-                df.at[idx, 'value'] = item.text
+def parse_xbrl_data(xbrl_data, xbrl_df=None, corrections=None):
+    if xbrl_data is not None:  # xbrl_data has primacy
+        df = pd.DataFrame([(tag, context, value) for (tag, context), value in xbrl_facts(xbrl_data).items()],
+                          columns=['tag', 'context', 'value'])
         df1 = df.copy()
     elif xbrl_data is None and xbrl_df is not None:
         df = xbrl_df.copy()
@@ -56,9 +57,16 @@ def parse_xbrl_data(xbrl_data, xbrl_df=None, corrections=None):
             df.loc[(df['tag'] == corr['tag']) & (df['context'] == corr['context']),
                    'value'] = corr['value']
 
+    ''' tag -> value (of its first row), for the header lookups '''
+    tag_values = {}
+    for tag, value in zip(df['tag'].values, df['value'].values):
+        tag_values.setdefault(tag, value)
+
+    def has_tag(tag_part):
+        return any(tag_part in tag for tag in tag_values.keys())
+
     def get_value(tag_value, value_if_not_found='not-found'):
-        return df.loc[df['tag'] == tag_value, 'value'].values[0] \
-            if df['tag'].str.contains(tag_value).any() else value_if_not_found
+        return tag_values[tag_value] if has_tag(tag_value) else value_if_not_found
 
     ISIN         = get_value('ISIN')
     nse_symbol   = get_value('Symbol')
@@ -67,19 +75,19 @@ def parse_xbrl_data(xbrl_data, xbrl_df=None, corrections=None):
     period_end   = get_value('DateOfEndOfReportingPeriod')
     result_type  = get_value('NatureOfReportStandaloneConsolidated')
 
-    if df['tag'].str.contains('ResultType').any():
-        result_format = df.loc[df['tag'] == 'ResultType', 'value'].values[0]
+    if has_tag('ResultType'):
+        result_format = tag_values['ResultType']
         if result_format == 'Banking Format':
             result_format = 'banking'
         elif result_format == 'Main Format':
             result_format = 'default'
-    elif df['tag'].str.contains('NameOfBank').any(): # dirty
+    elif has_tag('NameOfBank'): # dirty
         result_format = 'banking'
     else:
         result_format = 'default'
 
-    if df['tag'].str.contains('NameOf').any():
-        company_name = df.loc[df['tag'].str.startswith('NameOf'), 'value'].values[0]
+    if has_tag('NameOf'):
+        company_name = next(value for tag, value in tag_values.items() if tag.startswith('NameOf'))
     else:
         company_name = nse_symbol
 
@@ -101,10 +109,10 @@ def parse_xbrl_data(xbrl_data, xbrl_df=None, corrections=None):
         'period_start': period_start,
         'period_end': period_end,
         'fy_and_qtr': ind_fy_and_qtr(period_end),
-        'reporting_qtr': df.loc[df['tag'] == 'ReportingQuarter', 'value'].values[0],
+        'reporting_qtr': tag_values['ReportingQuarter'],
         'result_type': result_type,
         'result_format': result_format,
-        'audited':df.loc[df['tag'] == 'WhetherResultsAreAuditedOrUnaudited', 'value'].values[0],
+        'audited': tag_values['WhetherResultsAreAuditedOrUnaudited'],
         'balance_sheet':balance_sheet,
         'company_name': company_name,
         'outcome': True,  # for now, later work on this
@@ -7,28 +7,40 @@ from fin_data.env import *
 import os
 import sys
 import glob
+import json
+import tempfile
 from pathlib import Path
 from datetime import datetime
 import traceback
 import pandas as pd
 import pygeneric.misc as pyg_misc
 from pygeneric import archiver, http_utils, datetime_utils
+from fin_data.common import http_pool
 from fin_data.ind_cf import base_utils
 
 PATH_1 = os.path.join(DATA_ROOT, '02_ind_cf/01_nse_fr_filings')
 PATH_2 = os.path.join(DATA_ROOT, '02_ind_cf/02_nse_fr_archive')
 
 ''' --------------------------------------------------------------------------------------- '''
+def fetched_content(fetched, url):
+    """ content of a (status, content) of http_pool.HttpPool.fetch, raises (as http_obj does) if there is none """
+    status, content = fetched
+    if content is None:
+        raise IOError('HTTP status %s: %s' % (status, url))
+    return content
+
 class DownloadManagerNSE:
-    def __init__(self, year, verbose=False):
+    def __init__(self, year, verbose=False, filings_path=PATH_1, archive_path=PATH_2):
         self.verbose = verbose
         self.year = year
         self.checkpoint_interval = 200
         self.session_errors = 0
         self.http_obj = None
+        self.filings_path = filings_path
+        self.archive_path = archive_path
 
-        self.dl_md_filename_json = os.path.join(PATH_2, f'dl_md/download_metadata_json_{year}.csv')
-        self.dl_md_filename_xbrl = os.path.join(PATH_2, f'dl_md/download_metadata_xbrl_{year}.csv')
+        self.dl_md_filename_json = os.path.join(archive_path, f'dl_md/download_metadata_json_{year}.csv')
+        self.dl_md_filename_xbrl = os.path.join(archive_path, f'dl_md/download_metadata_xbrl_{year}.csv')
         self.json_data_archives = {}
         self.xbrl_data_archives = {}
         self.dl_md_json = {}
@@ -41,12 +53,23 @@ class DownloadManagerNSE:
 
         return
 
-    def download(self, max_downloads=1000):
-        self.__download__('json', max_downloads)
-        self.__download__('xbrl', max_downloads)
+    def download(self, max_downloads=1000, workers=1, downloader=None):
+        """
+        workers > 1: checkpoint_interval filings at a time are fetched concurrently by an http_pool.HttpPool
+        (workers threads, rate limited, retries with backoff; downloader: one to use instead), then added
+        to the archives & metadata one by one in this thread, so archive writes & checkpoints are as before
+        """
+        pool = None
+        if workers > 1:
+            pool = http_pool.HttpPool(max_workers=workers, headers=http_utils.HttpDownloads().request_header) \
+                if downloader is None else downloader
+        self.__download__('json', max_downloads, pool)
+        self.__download__('xbrl', max_downloads, pool)
+        if pool is not None and downloader is None:
+            pool.close()
         return
 
-    def __download__(self, mode, max_downloads):
+    def __download__(self, mode, max_downloads, pool=None):
         assert mode in ['json', 'xbrl']
         print(f'\nStarting __download__ ({mode}): \n%s' % (90 * '-'))
         to_download = self.__what_to_download__(mode)
@@ -57,32 +80,35 @@ class DownloadManagerNSE:
 
         print('\nTo download (%s): %d (max_downloads: %d)' % (mode, to_download.shape[0], max_downloads))
 
-        if self.http_obj is None:
+        if self.http_obj is None and pool is None:
             self.http_obj = http_utils.HttpDownloads(max_tries=10, timeout=30)
         t = datetime_utils.elapsed_time('DownloadManagerNSE.__download__')
         n_downloaded, self.session_errors = 0, 0
 
-        for idx in to_download.index:
-            pyg_misc.print_progress_str(idx + 1, to_download.shape[0])
-
-            cf_fr_row = to_download.loc[idx].to_dict()
-            if self.__download_one__(mode, cf_fr_row):
-                n_downloaded += 1
-                if n_downloaded > 0 and n_downloaded % self.checkpoint_interval == 0:
-                    self.__flush__(mode)
-                    md_file = self.dl_md_filename_json if mode == 'json' else self.dl_md_filename_xbrl
-                    md_len  = len(self.dl_md_json) if mode == 'json' else len(self.dl_md_xbrl)
-                    print('\n    --> flush: %s size: %d, n_downloaded/session_errors: %d/%d'
-                          % (os.path.basename(md_file), md_len, n_downloaded, self.session_errors))
-                if n_downloaded >= max_downloads:
-                    break
+        idx = 0
+        while idx < to_download.shape[0] and n_downloaded < max_downloads:
+            ''' with a pool: the next filings (no more than can still be downloaded) are fetched at once '''
+            n = 1 if pool is None else min(self.checkpoint_interval, max_downloads - n_downloaded)
+            cf_fr_rows = to_download.iloc[idx:idx + n].to_dict('records')
+            fetched = [None] * len(cf_fr_rows) if pool is None else self.__fetch_many__(mode, cf_fr_rows, pool)
+            for cf_fr_row, fetched_one in zip(cf_fr_rows, fetched):
+                idx += 1
+                pyg_misc.print_progress_str(idx, to_download.shape[0])
+                if self.__download_one__(mode, cf_fr_row, fetched_one):
+                    n_downloaded += 1
+                    if n_downloaded > 0 and n_downloaded % self.checkpoint_interval == 0:
+                        self.__flush__(mode)
+                        md_file = self.dl_md_filename_json if mode == 'json' else self.dl_md_filename_xbrl
+                        md_len  = len(self.dl_md_json) if mode == 'json' else len(self.dl_md_xbrl)
+                        print('\n    --> flush: %s size: %d, n_downloaded/session_errors: %d/%d'
+                              % (os.path.basename(md_file), md_len, n_downloaded, self.session_errors))
         self.__flush__(mode)
         t = datetime_utils.elapsed_time('DownloadManagerNSE.__download__')
         print(f'\n\nDownloads ({mode}) completed. Summary:')
 
         print('  n_downloaded/session_errors: %d/%d' % (n_downloaded, self.session_errors))
         print('  time taken: %.2f seconds for %d downloads' % (t, n_downloaded))
-        print('  --> %.3f seconds/record' % (t / n_downloaded))
+        print('  --> %.3f seconds/record' % (t / max(n_downloaded, 1)))
 
         md_file = self.dl_md_filename_json if mode == 'json' else self.dl_md_filename_xbrl
         outcome_column = 'json_outcome' if mode == 'json' else 'xbrl_outcome'
@@ -93,12 +119,20 @@ class DownloadManagerNSE:
 
         return
 
-    def __download_one__(self, mode, cf_fr_row):
+    def __fetch_many__(self, mode, cf_fr_rows, pool):
+        """ (status, content) for every row, None for rows without a link (see __download_one_xbrl__) """
+        urls = [self.base_url_json + r['json_key'] if mode == 'json' else r['xbrl'] for r in cf_fr_rows]
+        fetch = [mode == 'json' or os.path.basename(url) != '-' for url in urls]
+        fetched = iter(pool.fetch_many([url for url, f in zip(urls, fetch) if f]))
+        return [next(fetched) if f else None for f in fetch]
+
+    def __download_one__(self, mode, cf_fr_row, fetched=None):
+        """ fetched: the (status, content) of the row's link, if already fetched (see download) """
         assert mode in ['json', 'xbrl']
-        return self.__download_one_json__(cf_fr_row) if mode == 'json' \
-            else self.__download_one_xbrl__(cf_fr_row)
+        return self.__download_one_json__(cf_fr_row, fetched) if mode == 'json' \
+            else self.__download_one_xbrl__(cf_fr_row, fetched)
 
-    def __download_one_json__(self, cf_fr_row):
+    def __download_one_json__(self, cf_fr_row, fetched=None):
         ''' just download & no pre-processibg. All error checks are done during pre-processing '''
         json_key = cf_fr_row['json_key']
         period_end = datetime.strptime(cf_fr_row['toDate'], '%d-%b-%Y').strftime('%Y-%m-%d')
@@ -108,10 +142,14 @@ class DownloadManagerNSE:
             'json_outcome': False, 'json_size': 0, 'json_archive_path': None, 'json_error': ''
         }
         try:
-            json_data, raw_data = self.http_obj.http_get_both(json_link)
+            if fetched is None:
+                json_data, raw_data = self.http_obj.http_get_both(json_link)
+            else:
+                raw_data = fetched_content(fetched, json_link)
+                json_data = json.loads(raw_data)
             json_archive_path = '%d/json_data_period_end_%s' % (int(period_end[0:4]), period_end)
             if period_end not in self.json_data_archives.keys():
-                f = os.path.join(PATH_2, json_archive_path)
+                f = os.path.join(self.archive_path, json_archive_path)
                 update = os.path.exists(f)
                 self.json_data_archives[period_end] = archiver.Archiver(f, mode='w', update=update)
             self.json_data_archives[period_end].add(json_key, raw_data)
@@ -137,7 +175,7 @@ class DownloadManagerNSE:
 
         return  json_download_outcome['json_outcome']
 
-    def __download_one_xbrl__(self, cf_fr_row):
+    def __download_one_xbrl__(self, cf_fr_row, fetched=None):
         ''' just download & no pre-processibg. All error checks are done during pre-processing '''
         xbrl_link = cf_fr_row['xbrl']
         xbrl_key = os.path.basename(xbrl_link)
@@ -150,13 +188,14 @@ class DownloadManagerNSE:
             xbrl_download_outcome['xbrl_error'] = 'invalid xbrl_link: [%s]' % xbrl_link
         else:
             try:
-                xbrl_data = self.http_obj.http_get(xbrl_link)
+                xbrl_data = self.http_obj.http_get(xbrl_link) if fetched is None else \
+                    fetched_content(fetched, xbrl_link)
                 if len(xbrl_data) == 0:
                     xbrl_download_outcome['xbrl_error'] = 'empty xbrl_data'
                 else:
                     xbrl_archive_path = '%d/xbrl_data_period_end_%s' % (int(period_end[0:4]), period_end)
                     if period_end not in self.xbrl_data_archives.keys():
-                        f = os.path.join(PATH_2, xbrl_archive_path)
+                        f = os.path.join(self.archive_path, xbrl_archive_path)
                         update = os.path.exists(f)
                         self.xbrl_data_archives[period_end] = archiver.Archiver(f, mode='w', update=update)
                     self.xbrl_data_archives[period_end].add(xbrl_key, xbrl_data)
@@ -206,7 +245,7 @@ class DownloadManagerNSE:
         return True
 
     def __what_to_download__(self, mode):
-        f = os.path.join(PATH_1, 'CF_FR_%d.csv' % self.year)
+        f = os.path.join(self.filings_path, 'CF_FR_%d.csv' % self.year)
         if not os.path.exists(f):
             return pd.DataFrame()
         to_download = pd.read_csv(f)
@@ -230,6 +269,58 @@ class DownloadManagerNSE:
         to_download.reset_index(drop=True, inplace=True)
         return to_download
 
+''' --------------------------------------------------------------------------------------- '''
+def test_me():
+    """ offline: concurrent downloads of a year of filings from http_pool.LocalHttpServer """
+    print('fin_data.ind_cf.download_fr.test_me:', end=' ')
+    datetime_utils.elapsed_time('fin_data.ind_cf.download_fr.test_me')
+    filings = pd.DataFrame({'symbol': ['ABC', 'XYZ', 'M&M', 'PQR', 'DEF'],
+                            'params': ['ABC&EQ', 'XYZ&EQ', 'M&M&EQ', 'PQR&EQ', 'DEF&EQ'],
+                            'seqNumber': [1, 2, 3, 4, 5], 'industry': ['', 'Bank', '', '', ''],
+                            'oldNewFlag': ['N', 'N', 'N', 'N', 'N'], 'reInd': ['C', 'S', 'C', 'C', 'S'],
+                            'format': ['New', 'New', 'New', 'New', 'New'],
+                            'toDate': ['31-Mar-2030', '31-Mar-2030', '30-Jun-2030', '30-Jun-2030', '30-Jun-2030'],
+                            'xbrl': ['ABC.xml', 'XYZ.xml', 'MM.xml', '-', 'DEF.xml']})
+    json_keys = filings.apply(lambda x: base_utils.prepare_json_key(x), axis=1)
+    routes = {'/api/fr?' + k: b'{"seq": %d}' % i for i, k in enumerate(json_keys)}
+    routes['/api/fr?' + json_keys[1]] = [503, 429, b'{"seq": 1}']
+    routes['/api/fr?' + json_keys[4]] = b'not json'
+    routes.update({'/xbrl/ABC.xml': b'<abc/>', '/xbrl/XYZ.xml': [500, b'<xyz/>'], '/xbrl/MM.xml': b'<mm/>'})  # DEF: 404
+
+    with tempfile.TemporaryDirectory() as tmp_dir, http_pool.LocalHttpServer(routes) as server:
+        filings['xbrl'] = [x if x == '-' else server.base_url + '/xbrl/' + x for x in filings['xbrl']]
+        filings.to_csv(os.path.join(tmp_dir, 'CF_FR_2030.csv'), index=False)
+        pool = http_pool.HttpPool(max_workers=4, rate=None, backoff=0.01)
+        mgr = DownloadManagerNSE(2030, filings_path=tmp_dir, archive_path=tmp_dir)
+        mgr.base_url_json = server.base_url + '/api/fr?'
+        mgr.checkpoint_interval = 2
+        mgr.download(max_downloads=4, workers=4, downloader=pool)
+
+        df = pd.read_csv(mgr.dl_md_filename_json)
+        assert df.shape[0] == 4 and list(df['json_outcome']) == [True] * 4, 'ERROR! json max_downloads'
+        archive = archiver.Archiver(os.path.join(tmp_dir, '2030/json_data_period_end_2030-03-31'), 'r')
+        assert sorted(archive.keys()) == sorted(json_keys[0:2]) and archive.get(json_keys[1]) == b'{"seq": 1}'
+        df = pd.read_csv(mgr.dl_md_filename_xbrl).set_index('xbrl_key')
+        assert list(df['xbrl_outcome']) == [True, True, True, False, False], 'ERROR! xbrl outcomes'
+        assert df.loc['DEF.xml', 'xbrl_error'].find('HTTP status 404') != -1
+        archive = archiver.Archiver(os.path.join(tmp_dir, '2030/xbrl_data_period_end_2030-06-30'), 'r')
+        assert archive.keys() == ['MM.xml'] and archive.get('MM.xml') == b'<mm/>'
+        assert '-' not in [os.path.basename(p) for p in server.requests.keys()]
+
+        ''' again: only the last json is requested, it is not json '''
+        n_requests = sum(len(t) for t in server.requests.values())
+        mgr = DownloadManagerNSE(2030, filings_path=tmp_dir, archive_path=tmp_dir)
+        mgr.base_url_json = server.base_url + '/api/fr?'
+        mgr.download(max_downloads=4, workers=4, downloader=pool)
+        pool.close()
+        assert sum(len(t) for t in server.requests.values()) == n_requests + 1, 'ERROR! downloaded again'
+        df = pd.read_csv(mgr.dl_md_filename_json).set_index('json_key')
+        assert df.shape[0] == 5 and not df.loc[json_keys[4], 'json_outcome'] and mgr.session_errors == 1
+        assert pd.read_csv(mgr.dl_md_filename_xbrl).shape[0] == 5
+
+    print('OK')
+    return True, datetime_utils.elapsed_time('fin_data.ind_cf.download_fr.test_me')
+
 ''' --------------------------------------------------------------------------------------- '''
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -237,6 +328,7 @@ if __name__ == '__main__':
     arg_parser.add_argument("-y", help='calendar year')
     arg_parser.add_argument("-sy", nargs='+', help="list of nse symbols")
     arg_parser.add_argument("-md", type=int, default=1000, help="max downloads")
+    arg_parser.add_argument("-w", type=int, default=1, help="concurrent downloads (default 1)")
     arg_parser.add_argument('-v', action='store_true', help="Verbose")
     args = arg_parser.parse_args()
 
@@ -245,4 +337,4 @@ if __name__ == '__main__':
 
     year = datetime.today().year if args.y is None else int(args.y)
     mgr = DownloadManagerNSE(year=year, verbose=args.v)
-    mgr.download(max_downloads=args.md)
\ No newline at end of file
+    mgr.download(max_downloads=args.md, workers=args.w)
\ No newline at end of file
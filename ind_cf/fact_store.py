@@ -0,0 +1,142 @@
+"""
+Columnar store of the numeric facts of parsed XBRL financial results (see process_fr)
+Layout: 02_nse_fr_archive/fact_store/year=YYYY/{name}.parquet, YYYY the year of period_end.
+        every file is sorted by tag / symbol / period_end, so tag & symbol statistics prune row groups
+Files are only ever added: a filing processed again (or revised) has its facts in a newer file, and
+read_facts keeps the latest facts of a filing period
+"""
+''' --------------------------------------------------------------------------------------- '''
+
+from fin_data.env import *
+import os
+import shutil
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import fin_data.nse_pv.pv_store as pv_store
+
+FACT_STORE_PATH = os.path.join(DATA_ROOT, '02_ind_cf/02_nse_fr_archive/fact_store')
+FACT_SCHEMA = pa.schema([('symbol', pa.string()), ('period_end', pa.date32()), ('consolidated', pa.string()),
+                         ('period', pa.string()), ('tag', pa.string()), ('context', pa.string()),
+                         ('value', pa.float64()), ('filing_date', pa.timestamp('ns')), ('json_key', pa.string())])
+FACT_KEY = ['symbol', 'period_end', 'consolidated', 'tag', 'context']
+FACT_PROFILE = {'row_group_size': 100000, 'sorting_columns': ['tag', 'symbol', 'period_end']}
+
+''' --------------------------------------------------------------------------------------- '''
+def filing_facts(parsed_df, row_dict, period_end):
+    """
+    the numeric facts of one filing: parsed_df of base_utils.parse_xbrl_data & the filing's row. None if
+    the period end is not a date
+    """
+    period_end = pd.to_datetime(period_end, errors='coerce')
+    if pd.isna(period_end):
+        return None
+    values = pd.to_numeric(parsed_df['value'], errors='coerce')
+    df = pd.DataFrame({'tag': parsed_df['tag'].values, 'context': parsed_df['context'].values,
+                       'value': values.values}).dropna(subset=['value'])
+    df.insert(0, 'symbol', row_dict['symbol'])
+    df.insert(1, 'period_end', period_end)
+    df.insert(2, 'consolidated', row_dict['consolidated'])
+    df.insert(3, 'period', row_dict['period'])
+    df['filing_date'] = pd.to_datetime(row_dict['filingDate'])
+    df['json_key'] = row_dict['json_key']
+    return df
+
+def write_facts(df, name, store_path=FACT_STORE_PATH):
+    """ df (filing_facts of any number of filings) as a new file of every year partition it has """
+    years = pd.to_datetime(df['period_end']).dt.year
+    for year in sorted(years.unique()):
+        os.makedirs(os.path.join(store_path, f'year={year}'), exist_ok=True)
+        table = pa.Table.from_pandas(df.loc[years == year], schema=FACT_SCHEMA, preserve_index=False)
+        pv_store.write_parquet_table(table, os.path.join(store_path, f'year={year}', f'{name}.parquet'),
+                                     profile=FACT_PROFILE)
+    return
+
+def read_facts(tags, symbols=None, period_from=None, period_to=None, consolidated=None, contexts=None,
+               latest=True, store_path=FACT_STORE_PATH):
+    """
+    facts of tags (for symbols, period_end in [period_from, period_to], consolidated / contexts: a value
+    or a list, None: all). latest: only the last filed facts of every symbol / period / tag / context
+    """
+    if not os.path.exists(store_path):
+        return pd.DataFrame(columns=FACT_SCHEMA.names)
+    dataset = ds.dataset(store_path, format='parquet', partitioning='hive')
+
+    def as_list(x):
+        return x if type(x) == list else [x]
+
+    filters = pc.field('tag').isin(as_list(tags))
+    if symbols is not None:
+        filters = filters & pc.field('symbol').isin(as_list(symbols))
+    if consolidated is not None:
+        filters = filters & pc.field('consolidated').isin(as_list(consolidated))
+    if contexts is not None:
+        filters = filters & pc.field('context').isin(as_list(contexts))
+    if period_from is not None:
+        period_from = pd.Timestamp(period_from)
+        filters = filters & (pc.field('year') >= period_from.year) & \
+            (pc.field('period_end') >= pa.scalar(period_from.date(), type=pa.date32()))
+    if period_to is not None:
+        period_to = pd.Timestamp(period_to)
+        filters = filters & (pc.field('year') <= period_to.year) & \
+            (pc.field('period_end') <= pa.scalar(period_to.date(), type=pa.date32()))
+
+    df = pv_store.table_to_pandas(dataset.to_table(columns=FACT_SCHEMA.names, filter=filters))
+    if latest:
+        df = df.sort_values(by=FACT_KEY + ['filing_date'], kind='stable')
+        df = df.drop_duplicates(subset=FACT_KEY, keep='last')
+    return df.sort_values(by=['tag', 'symbol', 'period_end', 'consolidated', 'context']).reset_index(drop=True)
+
+def get_fact_panel(tag, symbols=None, period_from=None, period_to=None, consolidated='Consolidated',
+                   context='OneD', store_path=FACT_STORE_PATH):
+    """ one tag as a period_end x symbol frame, e.g. revenue of 500 symbols over 20 quarters """
+    df = read_facts(tag, symbols=symbols, period_from=period_from, period_to=period_to,
+                    consolidated=consolidated, contexts=context, store_path=store_path)
+    return df.pivot(index='period_end', columns='symbol', values='value')
+
+''' --------------------------------------------------------------------------------------- '''
+def test_me():
+    from pygeneric.datetime_utils import elapsed_time
+    print('fin_data.ind_cf.fact_store.test_me:', end=' ')
+    elapsed_time('fin_data.ind_cf.fact_store.test_me')
+
+    parsed_df = pd.DataFrame({'tag': ['RevenueFromOperations', 'ProfitLoss', 'Symbol', 'RevenueFromOperations'],
+                              'context': ['OneD', 'OneD', 'OneD', 'FourD'],
+                              'value': ['1000', '-25.5', 'ABC', '3000']})
+    filings = [({'symbol': s, 'consolidated': c, 'period': 'Quarterly', 'filingDate': f,
+                 'json_key': f'{s}_{p}_{c}'}, p)
+               for s in ['ABC', 'XYZ'] for c in ['Consolidated', 'Non-Consolidated']
+               for p, f in [('2022-12-31', '2023-02-10'), ('2023-03-31', '2023-05-20')]]
+    dfs = [filing_facts(parsed_df, row, period_end) for row, period_end in filings]
+    revised = parsed_df.assign(value=['1100', '-25.5', 'ABC', '3100'])
+    row, period_end = filings[1]
+    revision = filing_facts(revised, {**row, 'filingDate': '2023-06-01', 'json_key': 'revised'}, period_end)
+
+    store_path = tempfile.mkdtemp()
+    try:
+        write_facts(pd.concat(dfs), 'facts_1', store_path=store_path)
+        write_facts(revision, 'facts_2', store_path=store_path)
+        assert sorted(os.listdir(store_path)) == ['year=2022', 'year=2023']
+
+        df = read_facts('RevenueFromOperations', store_path=store_path)
+        assert df.shape[0] == 16 and df['value'].dtype == float and 'Symbol' not in df['tag'].values
+        df = read_facts(['RevenueFromOperations', 'ProfitLoss'], symbols='ABC', period_from='2023-01-01',
+                        consolidated='Consolidated', contexts='OneD', store_path=store_path)
+        assert df.shape[0] == 2 and list(df['value']) == [-25.5, 1100.0], df
+        assert read_facts('ProfitLoss', latest=False, store_path=store_path).shape[0] == 9
+
+        panel = get_fact_panel('RevenueFromOperations', store_path=store_path)
+        assert list(panel.columns) == ['ABC', 'XYZ'] and panel.shape == (2, 2)
+        assert panel.loc[pd.Timestamp('2023-03-31'), 'ABC'] == 1100
+        assert panel.loc[pd.Timestamp('2022-12-31'), 'XYZ'] == 1000
+    finally:
+        shutil.rmtree(store_path)
+
+    print('OK')
+    return True, elapsed_time('fin_data.ind_cf.fact_store.test_me')
+
+''' --------------------------------------------------------------------------------------- '''
+if __name__ == '__main__':
+    test_me()
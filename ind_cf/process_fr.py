@@ -9,12 +9,121 @@ from datetime import datetime
 import pandas as pd
 import json
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from pygeneric import archiver_cache, misc, datetime_utils
+from pygeneric.archiver import Archiver
 import fin_data.ind_cf.base_utils as base_utils
+import fin_data.ind_cf.fact_store as fact_store
 
 PATH_1 = os.path.join(DATA_ROOT, '02_ind_cf/01_nse_fr_filings')
 PATH_2 = os.path.join(DATA_ROOT, '02_ind_cf/02_nse_fr_archive')
 
+''' --------------------------------------------------------------------------------------- '''
+def process_fr(row_dict, json_data, xbrl_data, timestamp, with_facts=False):
+    """ (final metadata record, None or with_facts: the numeric XBRL facts, see fact_store) of one filing """
+    result_format = 'not-found'
+    if json_data is not None:
+        try:
+            result_format = json_data['resultFormat']
+            # Might need to do some sanity checks here (fe, symbol, isin, etc.)
+        except Exception as e:
+            row_dict['json_outcome'] = False
+            row_dict['json_error'] = 'corrputed json_data (%s):\n%s\n%s' % (
+                json_data, e, traceback.format_exc())
+    else:
+        row_dict['json_outcome'] = False
+        row_dict['json_error'] = 'json_data not found'
+
+    xbrl_balance_sheet, parsed_results = False, None
+    if xbrl_data is not None:
+        try:
+            parsed_results = base_utils.parse_xbrl_data(xbrl_data)
+            xbrl_balance_sheet = parsed_results['balance_sheet']
+            # Might need to do some sanity checks here (fe, symbol, isin, etc.)
+        except Exception as e:
+            row_dict['xbrl_outcome'] = False
+            row_dict['xbrl_error'] = 'parse_xbrl_data failed (1):\n%s\n%s' % (e, traceback.format_exc())
+
+    record = {
+        'symbol': row_dict['symbol'],
+        'isin': row_dict['isin'],
+        'consolidated': row_dict['consolidated'],
+        'cumulative': row_dict['cumulative'],
+        'period': row_dict['period'],
+        'fromDate': row_dict['fromDate'],
+        'toDate': row_dict['toDate'],
+        'relatingTo': row_dict['relatingTo'],
+        'seqNumber': row_dict['seqNumber'],
+        'resultFormat': result_format,
+        'indAs':row_dict['indAs'],
+        'bank': row_dict['bank'],
+        'audited': row_dict['audited'],
+        'oldNewFlag': row_dict['oldNewFlag'],
+        'filingDate': row_dict['filingDate'],
+        'json_key': row_dict['json_key'],
+        'json_outcome': row_dict['json_outcome'],
+        'json_size': row_dict['json_size'],
+        'json_archive_path': row_dict['json_archive_path'],
+        'json_error': row_dict['json_error'],
+        'xbrl_key': row_dict['xbrl_key'],
+        'xbrl_outcome': row_dict['xbrl_outcome'],
+        'xbrl_balance_sheet': xbrl_balance_sheet,
+        'xbrl_size': row_dict['xbrl_size'],
+        'xbrl_archive_path': row_dict['xbrl_archive_path'],
+        'xbrl_error': row_dict['xbrl_error'],
+        'processing_timestamp': timestamp,
+        'json_link': row_dict['json_link'],
+        'xbrl_link': row_dict['xbrl_link'],
+    }
+    facts = fact_store.filing_facts(parsed_results['parsed_df'], row_dict, parsed_results['period_end']) \
+        if with_facts and parsed_results is not None else None
+    return record, facts
+
+def process_archived_fr(row_dict, json_value, xbrl_value, timestamp, with_facts=False):
+    """
+    process_fr of a filing, its data read by json_value(json_key) / xbrl_value(xbrl_key). A filing that
+    fails (archive not readable, ...) is a json error record, it does not stop the others
+    """
+    try:
+        json_data = json.loads(json_value(row_dict['json_key'])) \
+            if row_dict['json_outcome'] and row_dict['json_size'] > 0 else None
+        xbrl_data = xbrl_value(row_dict['xbrl_key']) \
+            if row_dict['xbrl_outcome'] and row_dict['xbrl_size'] > 0 else None
+        return process_fr(row_dict, json_data, xbrl_data, timestamp, with_facts)
+    except Exception as e:
+        record, _ = process_fr(row_dict, None, None, timestamp)
+        record['json_error'] = 'process_fr failed:\n%s\n%s' % (e, traceback.format_exc())
+        return record, None
+
+def archive_paths(dl_md, key_col, path_col):
+    """ {key: full archive path} of download metadata: first row of a key, rows without a path left out """
+    dl_md = dl_md.dropna(subset=[path_col]).drop_duplicates(subset=key_col, keep='first')
+    return dict(zip(dl_md[key_col], [os.path.join(PATH_2, p) for p in dl_md[path_col]]))
+
+''' worker processes (see ProcessCFFRs.process): the last few archives read stay open, so with
+    batches in archive order an archive is opened about once per worker '''
+__archives__ = {}
+
+def read_archive_value(archive_path, key):
+    """ archive_path: full path (see archive_paths), None: not archived """
+    if archive_path is None:
+        return None
+    if archive_path not in __archives__.keys():
+        if len(__archives__) >= 8:
+            __archives__.pop(next(iter(__archives__)))
+        __archives__[archive_path] = Archiver(archive_path, mode='r')
+    return __archives__[archive_path].get(key)
+
+def process_fr_batch(rows, timestamp, with_facts=False, json_paths=None, xbrl_paths=None):
+    """ process_archived_fr of rows (frs_to_process rows, as dicts), json / xbrl_paths: see archive_paths """
+    def json_value(json_key):
+        return read_archive_value(json_paths.get(json_key), json_key)
+
+    def xbrl_value(xbrl_key):
+        return read_archive_value(xbrl_paths.get(xbrl_key), xbrl_key)
+
+    return [process_archived_fr(row_dict, json_value, xbrl_value, timestamp, with_facts) for row_dict in rows]
+
 ''' --------------------------------------------------------------------------------------- '''
 class ProcessCFFRs:
     def __init__(self, year, verbose=False):
@@ -24,11 +133,14 @@ class ProcessCFFRs:
 
         self.final_metadata_filename = os.path.join(PATH_2, 'metadata_%d.csv' % self.year)
         self.final_metadata = {}
+        self.facts = []  # facts not in the fact store yet, see __save_facts__
 
         self.dl_md_filename_json = os.path.join(PATH_2, f'dl_md/download_metadata_json_{year}.csv')
         self.dl_md_filename_xbrl = os.path.join(PATH_2, f'dl_md/download_metadata_xbrl_{year}.csv')
         self.dl_md_json = {}
         self.dl_md_xbrl = {}
+        self.json_archive_paths = {}  # json_key -> archive path, see archive_paths
+        self.xbrl_archive_paths = {}
 
         self.cf_fr_filename = os.path.join(PATH_1, 'CF_FR_%d.csv' % self.year)
         self.frs_to_process = None
@@ -36,20 +148,28 @@ class ProcessCFFRs:
         self.timestamp = datetime.today().strftime('%Y-%m-%d-%H-%M')
 
         def json_archive_path_func(json_key):
-            _xx = self.dl_md_json.loc[self.dl_md_json['json_key'] == json_key, 'json_archive_path']
-            return None if _xx.shape[0] == 0 else os.path.join(PATH_2, _xx.values[0])
+            return self.json_archive_paths.get(json_key)
         self.ac_json = archiver_cache.ArchiverCache(json_archive_path_func, cache_size=5)
         assert self.ac_json.all_ok(), 'ERROR! Corrupted ArchiverCache'
 
         def xbrl_archive_path_func(xbrl_key):
-            _xx = self.dl_md_xbrl.loc[self.dl_md_xbrl['xbrl_key'] == xbrl_key, 'xbrl_archive_path']
-            return None if _xx.shape[0] == 0 else os.path.join(PATH_2, _xx.values[0])
+            return self.xbrl_archive_paths.get(xbrl_key)
         self.ac_xbrl = archiver_cache.ArchiverCache(xbrl_archive_path_func, cache_size=5)
         assert self.ac_xbrl.all_ok(), 'ERROR! Corrupted ArchiverCache'
 
         return
 
-    def process(self, max_to_process=None):
+    def process(self, max_to_process=None, workers=1, batch_size=50, order='filingDate', facts=False):
+        """
+        order: 'filingDate' or 'archive' (by JSON & XBRL archive, then filingDate). Both archives of a
+               filing are of its period end (see download_fr), so in archive order every archive is
+               opened once a run
+        workers > 1: filings are sharded by XBRL archive & parsed in a process pool, batch_size filings
+        a task (see process_fr_batch). Checkpoints & resume (metadata_{year}.csv) are the same either way
+        facts: the numeric facts of the filings are added to the fact store (see fact_store), at every
+               checkpoint, before metadata_{year}.csv
+        """
+        assert order in ['archive', 'filingDate'], 'Invalid order %s' % order
         print('\nStarting process:\n%s' % (90 * '-'))
         self.frs_to_process = self.__what_to_process__()
 
@@ -60,90 +180,35 @@ class ProcessCFFRs:
         if max_to_process is None: max_to_process = self.frs_to_process.shape[0]
         print('\nTo process: %d (max_to_process: %d)' % (self.frs_to_process.shape[0], max_to_process))
         t = datetime_utils.elapsed_time('ProcessCFFRs.process')
+        frs = self.frs_to_process if order == 'filingDate' else self.__archive_order__(self.frs_to_process)
+        frs = frs.iloc[:max_to_process]
+        records = self.__process_serial__(frs, facts) if workers <= 1 else \
+            self.__process_parallel__(frs, workers, batch_size, facts)
         n_processed = 0
-        for idx in self.frs_to_process.index:
-            misc.print_progress_str(idx + 1, self.frs_to_process.shape[0])
-            row_dict = self.frs_to_process.loc[idx].to_dict()
-            json_data, xbrl_data = self.__get_archive_data__(row_dict)
-
-            result_format = 'not-found'
-            if json_data is not None:
-                try:
-                    result_format = json_data['resultFormat']
-                    # Might need to do some sanity checks here (fe, symbol, isin, etc.)
-                except Exception as e:
-                    row_dict['json_outcome'] = False
-                    row_dict['json_error'] = 'corrputed json_data (%s):\n%s\n%s' % (
-                        json_data, e, traceback.format_exc())
-            else:
-                row_dict['json_outcome'] = False
-                row_dict['json_error'] = 'corrputed json_data (%s):\n%s\n%s' % (
-                    json_data, e, traceback.format_exc())
-
-            xbrl_balance_sheet = False
-            if xbrl_data is not None:
-                try:
-                    parsed_results = base_utils.parse_xbrl_data(xbrl_data)
-                    xbrl_balance_sheet = parsed_results['balance_sheet']
-                    # Might need to do some sanity checks here (fe, symbol, isin, etc.)
-                except Exception as e:
-                    row_dict['xbrl_outcome'] = False
-                    row_dict['xbrl_error'] = 'parse_xbrl_data failed (1):\n%s\n%s' % (e, traceback.format_exc())
-
+        for record, record_facts in records:
             # Not clear/TO DO/TO THINK: Use json_key or just add to list?
-            self.final_metadata[row_dict['json_key']] = {
-                'symbol': row_dict['symbol'],
-                'isin': row_dict['isin'],
-                'consolidated': row_dict['consolidated'],
-                'cumulative': row_dict['cumulative'],
-                'period': row_dict['period'],
-                'fromDate': row_dict['fromDate'],
-                'toDate': row_dict['toDate'],
-                'relatingTo': row_dict['relatingTo'],
-                'seqNumber': row_dict['seqNumber'],
-                'resultFormat': result_format,
-                'indAs':row_dict['indAs'],
-                'bank': row_dict['bank'],
-                'audited': row_dict['audited'],
-                'oldNewFlag': row_dict['oldNewFlag'],
-                'filingDate': row_dict['filingDate'],
-                'json_key': row_dict['json_key'],
-                'json_outcome': row_dict['json_outcome'],
-                'json_size': row_dict['json_size'],
-                'json_archive_path': row_dict['json_archive_path'],
-                'json_error': row_dict['json_error'],
-                'xbrl_key': row_dict['xbrl_key'],
-                'xbrl_outcome': row_dict['xbrl_outcome'],
-                'xbrl_balance_sheet': xbrl_balance_sheet,
-                'xbrl_size': row_dict['xbrl_size'],
-                'xbrl_archive_path': row_dict['xbrl_archive_path'],
-                'xbrl_error': row_dict['xbrl_error'],
-                'processing_timestamp': self.timestamp,
-                'json_link': row_dict['json_link'],
-                'xbrl_link': row_dict['xbrl_link'],
-            }
+            self.final_metadata[record['json_key']] = record
+            if record_facts is not None:
+                self.facts.append(record_facts)
             n_processed += 1
-            if n_processed >= max_to_process:
-                break
+            misc.print_progress_str(n_processed, frs.shape[0])
 
             ''' save metadata (checkpoint) '''
-            if n_processed % self.checkpoint_interval == 0:
-                df = pd.DataFrame(list(self.final_metadata.values()))
-                df.sort_values(by='processing_timestamp', inplace=True)
-                df.to_csv(self.final_metadata_filename, index=False)
+            if n_processed % self.checkpoint_interval == 0 and n_processed < frs.shape[0]:
+                self.__save_facts__()
+                df = self.__save_metadata__()
                 je, xe = df.loc[~df['json_outcome']].shape[0], df.loc[df['xbrl_outcome'] != True].shape[0]
                 md_file = os.path.basename(self.final_metadata_filename)
                 print('\n    --> %s: %d rows, %d json errors, %d xbrl errors' % (md_file, df.shape[0], je, xe))
 
         ''' save metadata (final)'''
-        df = pd.DataFrame(list(self.final_metadata.values()))
-        df.sort_values(by='processing_timestamp', inplace=True)
-        df.to_csv(self.final_metadata_filename, index=False)
+        self.__save_facts__()
+        df = self.__save_metadata__()
         t = datetime_utils.elapsed_time('ProcessCFFRs.process')
 
         print('\nProcessing completed. Summary:')
         print('   n_processed: %d, metadata_%d.csv shape: %s' % (n_processed, self.year, df.shape))
-        print('   time taken: %.2f seconds, %.3f seconds/record' % (t, t / n_processed))
+        print('   time taken: %.2f seconds, %.3f seconds/record' % (t, t / max(n_processed, 1)))
         je, xe = df.loc[~df['json_outcome']].shape[0], df.loc[df['xbrl_outcome'] != True].shape[0]
         md_file = os.path.basename(self.final_metadata_filename)
         print('   final %s: %d rows, %d json errors, %d xbrl errors' % (md_file, df.shape[0], je, xe))
@@ -151,12 +216,54 @@ class ProcessCFFRs:
 
         return
 
-    def __get_archive_data__(self, row_dict):
-        json_data = json.loads(self.ac_json.get_value(row_dict['json_key'])) \
-            if row_dict['json_outcome'] and row_dict['json_size'] > 0 else None
-        xbrl_data = self.ac_xbrl.get_value(row_dict['xbrl_key']) \
-            if row_dict['xbrl_outcome'] and row_dict['xbrl_size'] > 0 else None
-        return json_data, xbrl_data
+    def __archive_order__(self, frs):
+        """ frs by JSON then XBRL archive (json / xbrl_archive_paths), in filingDate order within each """
+        paths = pd.DataFrame({'json_path': frs['json_key'].map(self.json_archive_paths),
+                              'xbrl_path': frs['xbrl_key'].map(self.xbrl_archive_paths)}, index=frs.index)
+        return frs.loc[paths.sort_values(by=['json_path', 'xbrl_path'], kind='stable').index]
+
+    def __process_serial__(self, frs, with_facts):
+        for idx in frs.index:
+            row_dict = frs.loc[idx].to_dict()
+            yield process_archived_fr(row_dict, self.ac_json.get_value, self.ac_xbrl.get_value, self.timestamp,
+                                      with_facts)
+
+    def __process_parallel__(self, frs, workers, batch_size, with_facts):
+        """
+        records in batch order (a batch that completes early waits for the ones before it). Batches are of
+        one XBRL archive, in JSON archive order, the archives looked up as in __process_serial__ (json /
+        xbrl_archive_paths)
+        """
+        json_paths = frs['json_key'].map(self.json_archive_paths)
+        xbrl_paths = frs['xbrl_key'].map(self.xbrl_archive_paths)
+        batches = []
+        for _, shard in frs.assign(json_path=json_paths, xbrl_path=xbrl_paths).groupby('xbrl_path', dropna=False,
+                                                                                        sort=True):
+            shard = shard.sort_values(by='json_path', kind='stable')
+            rows = shard.drop(columns=['json_path', 'xbrl_path']).to_dict('records')
+            batches += [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+        print('  %d workers, %d batches' % (workers, len(batches)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(process_fr_batch, batch, self.timestamp, with_facts,
+                                   {r['json_key']: self.json_archive_paths.get(r['json_key']) for r in batch},
+                                   {r['xbrl_key']: self.xbrl_archive_paths.get(r['xbrl_key']) for r in batch})
+                       for batch in batches]
+            for future in futures:
+                yield from future.result()
+
+    def __save_facts__(self):
+        """ the facts since the last checkpoint, as a new file of the fact store """
+        if len(self.facts) > 0:
+            name = 'facts_%d_%s_%d' % (self.year, datetime.now().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+            fact_store.write_facts(pd.concat(self.facts, axis=0), name)
+            self.facts = []
+        return
+
+    def __save_metadata__(self):
+        df = pd.DataFrame(list(self.final_metadata.values()))
+        df.sort_values(by='processing_timestamp', inplace=True)
+        df.to_csv(self.final_metadata_filename, index=False)
+        return df
 
 
     def __what_to_process__(self):
@@ -189,6 +296,7 @@ class ProcessCFFRs:
         self.dl_md_json = pd.read_csv(self.dl_md_filename_json)
         self.dl_md_json.drop(columns='timestamp', inplace=True)
         print('  loaded %s, shape: %s' % (os.path.basename(self.dl_md_filename_json), self.dl_md_json.shape))
+        self.json_archive_paths = archive_paths(self.dl_md_json, 'json_key', 'json_archive_path')
 
         ''' then consider only FRs whose json data is downloaded ------------------------------ '''
         frs2process = frs2process.loc[frs2process['json_key'].isin(self.dl_md_json['json_key'].unique())]
@@ -205,6 +313,7 @@ class ProcessCFFRs:
         self.dl_md_xbrl = pd.read_csv(self.dl_md_filename_xbrl)
         self.dl_md_xbrl.drop(columns='timestamp', inplace=True)
         print('  loaded %s, shape: %s' % (os.path.basename(self.dl_md_filename_xbrl), self.dl_md_xbrl.shape))
+        self.xbrl_archive_paths = archive_paths(self.dl_md_xbrl, 'xbrl_key', 'xbrl_archive_path')
         frs2process = frs2process.merge(self.dl_md_xbrl, on=['symbol', 'xbrl_key'], how='left')
         print('  (after adding xbrl_data info ): frs2process shape:', frs2process.shape)
         frs2process.to_csv(os.path.join(LOG_DIR, 'frs2process_2.csv'), index=False)
@@ -224,6 +333,9 @@ if __name__ == '__main__':
     arg_parser = ArgumentParser()
     arg_parser.add_argument("-y", help='Process for calendar year')
     arg_parser.add_argument("-mp", type=int, help='max_to_process (default all)')
+    arg_parser.add_argument("-w", type=int, default=1, help='worker processes (default 1)')
+    arg_parser.add_argument('-facts', action='store_true', help="Add the XBRL facts to the fact store")
+    arg_parser.add_argument('-ao', action='store_true', help="Process in archive order (default filingDate)")
     arg_parser.add_argument('-url', help="XBRL url to download & check")
     arg_parser.add_argument('-ctx', default='OneI', help="Filter for Context (only with URL)")
     arg_parser.add_argument('-v', action='store_true', help="Verbose")
@@ -241,4 +353,6 @@ if __name__ == '__main__':
         print(df.loc[df['context'] == args.ctx].to_string(index=False))
     else:
         year = datetime.today().year if args.y is None else int(args.y)
-        ProcessCFFRs(year=year, verbose=args.v).process(max_to_process=args.mp)
\ No newline at end of file
+        ProcessCFFRs(year=year, verbose=args.v).process(max_to_process=args.mp, workers=args.w,
+                                                      order='archive' if args.ao else 'filingDate',
+                                                      facts=args.facts)
\ No newline at end of file
@@ -8,28 +8,48 @@ from fin_data.env import *
 import datetime
 import os
 import glob
+import json
 import sys
-import requests
+import tempfile
 from pathlib import Path
 from calendar import monthrange, month_abbr
 from pygeneric.archiver import Archiver
+from pygeneric.datetime_utils import elapsed_time
 import pygeneric.http_utils as http_utils
+import fin_data.common.http_pool as http_pool
+import fin_data.nse_pv.trading_calendar as trading_calendar
 
 NSE_ARCHIVES_URL = 'https://archives.nseindia.com'
 OUTPUT_DIR = os.path.join(DATA_ROOT, '01_nse_pv/02_dr')
+DOWNLOAD_MANIFEST = 'download_manifest.json'
 
 ''' --------------------------------------------------------------------------------------- '''
-def get_files(sub_url, filenames, archive_full_path):
-    archive = Archiver(archive_full_path, 'w', overwrite=True, compression='zip')
+def nse_downloader():
+    return http_pool.HttpPool(headers=http_utils.HttpDownloads().request_header)
+
+def get_files(sub_url, filenames, archive_full_path, downloader=None, base_url=NSE_ARCHIVES_URL):
+    """ downloader: http_pool.HttpPool, files are fetched concurrently (default: a new nse_downloader()) """
+    pool = nse_downloader() if downloader is None else downloader
+    contents = pool.get_many([file_url(base_url, sub_url, f) for f in filenames])
+    if downloader is None:
+        pool.close()
+    save_files(filenames, contents, archive_full_path)
+
+def file_url(base_url, sub_url, f):
+    return os.path.join(base_url, sub_url, f).replace('\\', '/')
+
+def save_files(filenames, contents, archive_full_path, update=False):
+    """ update: contents are added to the archive's existing members """
+    if update and os.path.exists(archive_full_path):
+        archive = Archiver(archive_full_path, 'w', update=True, compression='zip')
+    else:
+        archive = Archiver(archive_full_path, 'w', overwrite=True, compression='zip')
     n_downloaded, total_size, last_file = 0, 0, None
-    for f in filenames:
-        # url = '%s/%s/%s' % (NSE_ARCHIVES_URL, sub_url, f)
-        url = os.path.join(NSE_ARCHIVES_URL, sub_url, f).replace('\\', '/')
-        r = requests.get(url, headers=http_utils.HttpDownloads().request_header, stream=True)
-        if r.ok:
+    for f, content in zip(filenames, contents):
+        if content is not None:
             n_downloaded += 1
-            total_size += len(r.content)
-            archive.add(f, r.content)
+            total_size += len(content)
+            archive.add(f, content)
             last_file = f
     if n_downloaded > 0:
         archive.flush()
@@ -37,7 +57,18 @@ def get_files(sub_url, filenames, archive_full_path):
     else:
         print('No files downloaded')
 
-def nse_download_daily_reports(year_str, month_str):
+def nse_download_daily_reports(year_str, month_str, downloader=None, base_url=NSE_ARCHIVES_URL,
+                               output_dir=OUTPUT_DIR, update=True):
+    """
+    all files of all reports of the month are fetched together by downloader (http_pool.HttpPool,
+    default: a new nse_downloader()), then written to one archive per report
+    update=True:  files already in the month's archives are kept & not requested again, nor are files
+                  that were not found before (kept in the month folder's download_manifest.json)
+    update=False: the month's archives & manifest are removed & everything is downloaded again
+    the index closes are fetched first: no other report is requested for days they are not found for
+    (non trading days of the trading_calendar of the downloaded index closes), days their download failed
+    for are requested again
+    """
     months_dict = {month.upper(): index for index, month in enumerate(month_abbr) if month}
     date_now = datetime.datetime.now()
     n_days = date_now.day \
@@ -45,10 +76,11 @@ def nse_download_daily_reports(year_str, month_str):
         monthrange(int(year_str), months_dict[month_str])[1]
     print('Downloading for %s-%s: n_days: %d ...' % (year_str, month_str, n_days))
 
-    dest_folder = OUTPUT_DIR + '/%s/%s' % (year_str, f'{months_dict[month_str]}'.zfill(2))
+    dest_folder = output_dir + '/%s/%s' % (year_str, f'{months_dict[month_str]}'.zfill(2))
     Path(dest_folder).mkdir(parents=True, exist_ok=True)
-    for f in glob.glob('%s/*.zip' % dest_folder):
-        os.remove(f)
+    if not update:
+        for f in glob.glob('%s/*.zip' % dest_folder) + glob.glob(os.path.join(dest_folder, DOWNLOAD_MANIFEST)):
+            os.remove(f)
 
     all_daily_reports = {
         'Cash Segment Daily Reports': [
@@ -163,29 +195,130 @@ def nse_download_daily_reports(year_str, month_str):
         ]
     }
 
-    month_dates_range = ['%s-%s-01' % (year_str, f'{months_dict[month_str]}'.zfill(2)),
-                         '%s-%s-%d' % (year_str, f'{months_dict[month_str]}'.zfill(2), n_days)]
+    month_dates = ['%s-%s-%s' % (year_str, f'{months_dict[month_str]}'.zfill(2), f'{d}'.zfill(2))
+                   for d in range(1, n_days + 1)]
+    month_dates_range = [month_dates[0], month_dates[-1]]
+    selected = {}
     for r in all_daily_reports.keys():
+        selected[r] = [x for x in all_daily_reports[r]
+                       if (x['dates'][0] is None or month_dates_range[0] >= x['dates'][0]) and
+                       (x['dates'][1] is None or month_dates_range[1] <= x['dates'][1])]
+
+    ''' update: only files neither in the archive already nor known not to exist '''
+    not_found = read_download_manifest(dest_folder) if update else {}
+    for x in [x for r in selected.keys() for x in selected[r]]:
+        skip = set(not_found.get(os.path.basename(x['archive']), []))
+        if update and os.path.exists(x['archive']):
+            skip |= set(Archiver(x['archive'], 'r').keys())
+        x['to_get'] = [f for f in x['files'] if f not in skip]
+
+    ''' the index closes first: other reports are not requested for days without one (non trading days) '''
+    pool = nse_downloader() if downloader is None else downloader
+    today = date_now.strftime('%Y-%m-%d')
+    index_closes = [x for r in selected.keys() for x in selected[r]
+                    if os.path.basename(x['archive']) == 'indices_close.zip']
+    print('\nDownloading index closes ...')
+    fetch_reports(index_closes, pool, base_url, update, not_found, month_dates, today)
+    calendar = trading_calendar.get_trading_calendar(output_dir, refresh=True)
+    non_trading = set(d for x in index_closes for d in non_trading_days(x, not_found, month_dates, calendar))
+    for r in selected.keys():
         print('\nDownloading %s ...' % r)
-        reports = all_daily_reports[r]
-        for i, r in enumerate(reports):
-            d = r['dates']
-            if (d[0] is None or month_dates_range[0] >= d[0]) and\
-                    (d[1] is None or month_dates_range[1] <= d[1]):
-                print(r['msg'], end='')
-                get_files(r['sub_url'], r['files'], r['archive'])
+        reports = [x for x in selected[r] if x not in index_closes]
+        for x in reports:
+            x['to_get'] = [f for f, d in zip(x['files'], month_dates) if f in x['to_get'] and d not in non_trading]
+        fetch_reports(reports, pool, base_url, update, not_found, month_dates, today)
+    if downloader is None:
+        pool.close()
+    save_download_manifest(dest_folder, not_found)
+
+    return
 
+def fetch_reports(reports, pool, base_url, update, not_found, month_dates, today):
+    """ to_get files of all reports fetched together, saved to their archives. 404s added to not_found """
+    urls = list(dict.fromkeys(file_url(base_url, x['sub_url'], f) for x in reports for f in x['to_get']))
+    results = dict(zip(urls, pool.fetch_many(urls)))
+    for x in reports:
+        print(x['msg'], end='')
+        x_results = [results[file_url(base_url, x['sub_url'], f)] for f in x['to_get']]
+        save_files(x['to_get'], [content for _, content in x_results], x['archive'], update=update)
+        ''' 404s are remembered, except for today (may not be published yet) '''
+        file_dates = dict(zip(x['files'], month_dates))
+        not_found.setdefault(os.path.basename(x['archive']), []).extend(
+            f for f, (status, _) in zip(x['to_get'], x_results) if status == 404 and file_dates[f] != today)
     return
 
-def get_market_open_dates(year_str, month_str):
-    archive_name = r'C:\Users\bhats\SUNILBHAT\10_data\01_nse_pv\02_dr\2024\07\indices_close.zip'
-    archive = Archiver(archive_name, 'r')
-    dates = [k.split('_')[3].split('.')[0] for k in archive.keys()]
-    dates = ['%s-%s-%s' % (d[4:], d[2:4], d[0:2]) for d in dates]
-    dates = sorted(dates)
+def non_trading_days(index_close, not_found, month_dates, calendar):
+    """
+    days of the month NSE has no index close for: not trading days of calendar (trading_calendar.TradingCalendar
+    of the downloaded index closes) & their index close not found (404, not a failed download, see fetch_reports)
+    """
+    missing = set(not_found.get(os.path.basename(index_close['archive']), []))
+    trading = calendar.is_trading_day(month_dates)
+    return [d for f, d, t in zip(index_close['files'], month_dates, trading) if not t and f in missing]
+
+def read_download_manifest(dest_folder):
+    """ {archive: [files]} known not to exist on NSE (404, non trading days mostly) for the month """
+    manifest_file = os.path.join(dest_folder, DOWNLOAD_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)['not_found']
+
+def save_download_manifest(dest_folder, not_found):
+    manifest_file = os.path.join(dest_folder, DOWNLOAD_MANIFEST)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({'not_found': {k: sorted(set(v)) for k, v in not_found.items()}}, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    return
+
+def test_me():
+    """ offline: one month of downloads from http_pool.LocalHttpServer """
+    print('fin_data.nse_pv.get_dr.test_me:')
+    elapsed_time('fin_data.nse_pv.get_dr.test_me')
+    routes = {'/content/indices/ind_close_all_%02d092022.csv' % d: b'index close %d' % d for d in [1, 2, 5]}
+    routes['/content/indices/ind_close_all_05092022.csv'] = [503] * 4 + [b'index close 5']  # fails in run 1
+    routes['/archives/equities/mto/MTO_01092022.DAT'] = [503, b'mto 1']
+    mto = '/archives/equities/mto/MTO_%02d092022.DAT'
+    index_close_5 = '/content/indices/ind_close_all_05092022.csv'
+    with tempfile.TemporaryDirectory() as output_dir, http_pool.LocalHttpServer(routes) as server:
+        def n_requests():
+            return sum(len(t) for t in server.requests.values())
+
+        pool = http_pool.HttpPool(rate=None, backoff=0.01)
+        nse_download_daily_reports('2022', 'SEP', downloader=pool, base_url=server.base_url, output_dir=output_dir)
+        archive = Archiver(os.path.join(output_dir, '2022/09/indices_close.zip'), 'r')
+        assert sorted(archive.keys()) == ['ind_close_all_%02d092022.csv' % d for d in [1, 2]], archive.keys()
+        archive = Archiver(os.path.join(output_dir, '2022/09/MTO.zip'), 'r')
+        assert archive.keys() == ['MTO_01092022.DAT'], archive.keys()
+        assert not os.path.exists(os.path.join(output_dir, '2022/09/PR.zip'))
+        ''' 3 Sep: no index close (404), a non trading day. 5 Sep: the index close failed, still requested '''
+        assert mto % 3 not in server.requests.keys() and len(server.requests[mto % 5]) == 1, 'ERROR! trading days'
+        assert len(server.requests[index_close_5]) == 4
+        n_run_1 = n_requests()
+
+        ''' again: only the failed index close is requested, then nothing is '''
+        nse_download_daily_reports('2022', 'SEP', downloader=pool, base_url=server.base_url, output_dir=output_dir)
+        assert n_requests() == n_run_1 + 1, 'ERROR! update requested again'
+        archive = Archiver(os.path.join(output_dir, '2022/09/indices_close.zip'), 'r')
+        assert len(archive.keys()) == 3 and archive.get('ind_close_all_05092022.csv') == b'index close 5'
+        nse_download_daily_reports('2022', 'SEP', downloader=pool, base_url=server.base_url, output_dir=output_dir)
+        assert n_requests() == n_run_1 + 1, 'ERROR! update requested again'
+
+        ''' without the manifest: the index closes tell the non trading days again '''
+        os.remove(os.path.join(output_dir, '2022/09', DOWNLOAD_MANIFEST))
+        nse_download_daily_reports('2022', 'SEP', downloader=pool, base_url=server.base_url, output_dir=output_dir)
+        assert mto % 3 not in server.requests.keys() and len(server.requests[mto % 5]) == 2 and \
+            len(server.requests[index_close_5]) == 5, 'ERROR! trading days'
 
-    print(dates)
-    exit()
+        ''' update=False: everything (less the failures of run 1) is requested again '''
+        n_before = n_requests()
+        nse_download_daily_reports('2022', 'SEP', downloader=pool, base_url=server.base_url, output_dir=output_dir,
+                                   update=False)
+        pool.close()
+        assert n_requests() == n_before + n_run_1 - 4, 'ERROR! full download'
+        assert len(Archiver(os.path.join(output_dir, '2022/09/indices_close.zip'), 'r').keys()) == 3
+    print('OK')
+    return True, elapsed_time('fin_data.nse_pv.get_dr.test_me')
 
 ''' --------------------------------------------------------------------------------------- '''
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+"""
+API class for NSE FO bhavcopy data (fo_bhavcopy_{IDF,IDO,STF,STO} files of process_dr.process_fo_reports)
+"""
+''' ------------------------------------------------------------------------------------------ '''
+
+from fin_data.env import *
+import os
+import glob
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+import fin_data.nse_pv.pv_store as pv_store
+from pygeneric.datetime_utils import elapsed_time
+
+FUTURES = {'index': 'IDF', 'stock': 'STF'}
+OPTIONS = {'index': 'IDO', 'stock': 'STO'}
+
+''' ------------------------------------------------------------------------------------------ '''
+class NseFOData:
+    """
+    Lookups by (symbol, date, expiry) over the FO files of all years. For every instrument type an
+    in-memory index, {(symbol, date): {expiry: [(file, row group), ...]}} & the same by (symbol, expiry)
+    then date, is built on first use from the date / symbol / expiry_date columns only. A lookup then
+    reads just those row groups (whole days, as written by process_fo_reports: one day each for options,
+    several for futures), with the rest of the predicate (date too) pushed down to parquet
+    """
+    def __init__(self, data_path=None, verbose=False):
+        self.verbose = verbose
+        self.data_path = os.path.join(DATA_ROOT, '01_nse_pv/02_dr') if data_path is None else data_path
+        self.__index__ = {}
+
+    def __files__(self, instr):
+        """ the year files & fragments (see process_dr.IngestManifest) of an instrument type """
+        file_name = 'fo_bhavcopy_%s' % instr
+        return sorted(glob.glob(os.path.join(self.data_path, f'processed/**/{file_name}.csv.parquet')) +
+                      glob.glob(os.path.join(self.data_path, f'processed/**/{file_name}.[0-9][0-9][0-9].csv.parquet')))
+
+    def index(self, instr):
+        if instr not in self.__index__.keys():
+            elapsed_time('nse_fo_index')
+            files, keys, contracts, n_row_groups = self.__files__(instr), {}, {}, 0
+            for file_idx, f in enumerate(files):
+                pf = pq.ParquetFile(f)
+                for rg in range(pf.metadata.num_row_groups):
+                    t = pf.read_row_group(rg, columns=['date', 'symbol', 'expiry_date'])
+                    t = t.group_by(['symbol', 'date', 'expiry_date']).aggregate([])
+                    dates = t.column('date').to_numpy().astype('datetime64[D]')
+                    expiries = t.column('expiry_date').to_numpy().astype('datetime64[D]')
+                    for symbol, date, expiry in zip(t.column('symbol').to_pylist(), dates, expiries):
+                        keys.setdefault((symbol, date), {}).setdefault(expiry, []).append((file_idx, rg))
+                        contracts.setdefault((symbol, expiry), {}).setdefault(date, []).append((file_idx, rg))
+                    n_row_groups += 1
+            self.__index__[instr] = {'files': files, 'keys': keys, 'contracts': contracts}
+            if self.verbose:
+                print('NseFOData.index(%s): %d files, %d row groups, %d (symbol, date) keys (%.2f sec)'
+                      % (instr, len(files), n_row_groups, len(keys), elapsed_time('nse_fo_index')))
+        return self.__index__[instr]
+
+    def __instr__(self, kind, symbol, date):
+        """ the index or stock instrument type of kind (FUTURES / OPTIONS) that has symbol on date """
+        for instr in kind.values():
+            if (symbol, np.datetime64(date, 'D')) in self.index(instr)['keys'].keys():
+                return instr
+        return None
+
+    def __read__(self, instr, locations, filters, columns=None):
+        """ rows of the (file, row group) locations (not empty) that satisfy filters {field name: value} """
+        index = self.index(instr)
+        row_groups = {}
+        for file_idx, rg in locations:
+            row_groups.setdefault(file_idx, set()).add(rg)
+
+        tables = []
+        for file_idx in sorted(row_groups.keys()):
+            fragment = ds.ParquetFileFormat().make_fragment(index['files'][file_idx], filesystem=pa.fs.LocalFileSystem(),
+                                                            row_groups=sorted(row_groups[file_idx]))
+            schema = fragment.physical_schema
+            expr = None
+            for name, value in filters.items():
+                field_type = schema.field(name).type
+                if pa.types.is_timestamp(field_type) or pa.types.is_date(field_type):
+                    value = pa.scalar(pd.Timestamp(value).to_pydatetime()).cast(field_type)
+                else:
+                    value = pa.scalar(value, type=field_type)
+                expr = (pc.field(name) == value) if expr is None else expr & (pc.field(name) == value)
+            tables.append(fragment.to_table(columns=columns, filter=expr))
+        return pv_store.table_to_pandas(tables)
+
+    ''' lookups ------------------------------------------------------------------------------ '''
+    def get_expiries(self, symbol, date, kind=OPTIONS):
+        """ expiries traded on date (sorted) """
+        instr = self.__instr__(kind, symbol, date)
+        if instr is None:
+            return []
+        expiries = self.index(instr)['keys'][(symbol, np.datetime64(date, 'D'))].keys()
+        return [str(e) for e in sorted(expiries)]
+
+    def get_option_chain(self, symbol, date, expiry=None, columns=None):
+        """ options of symbol on date for expiry (None: the nearest), sorted by strike_price / option_type """
+        instr = self.__instr__(OPTIONS, symbol, date)
+        if instr is None:
+            raise ValueError('get_option_chain: no options for %s on %s' % (symbol, date))
+        by_expiry = self.index(instr)['keys'][(symbol, np.datetime64(date, 'D'))]
+        expiry = min(by_expiry.keys()) if expiry is None else np.datetime64(expiry, 'D')
+        if expiry not in by_expiry.keys():
+            raise ValueError('get_option_chain: no %s %s options on %s' % (symbol, expiry, date))
+        df = self.__read__(instr, by_expiry[expiry], {'symbol': symbol, 'date': date, 'expiry_date': expiry},
+                           columns=with_columns(columns, ['strike_price', 'option_type']))
+        df = df.sort_values(by=['strike_price', 'option_type']).reset_index(drop=True)
+        return df if columns is None else df[columns]
+
+    def get_futures_curve(self, symbol, date, columns=None):
+        """ futures of symbol on date, all expiries, sorted by expiry_date """
+        instr = self.__instr__(FUTURES, symbol, date)
+        if instr is None:
+            raise ValueError('get_futures_curve: no futures for %s on %s' % (symbol, date))
+        by_expiry = self.index(instr)['keys'][(symbol, np.datetime64(date, 'D'))]
+        df = self.__read__(instr, [loc for locs in by_expiry.values() for loc in locs],
+                           {'symbol': symbol, 'date': date}, columns=with_columns(columns, ['expiry_date']))
+        df = df.sort_values(by='expiry_date').reset_index(drop=True)
+        return df if columns is None else df[columns]
+
+    def get_oi_series(self, symbol, expiry, strike_price=None, option_type=None, from_to=None):
+        """
+        daily close / settlement / volume / OI of one contract: a future (strike_price None) or an option
+        (strike_price & option_type, CE / PE)
+        """
+        if strike_price is not None and option_type not in ['CE', 'PE']:
+            raise ValueError('get_oi_series: option_type CE / PE needed with strike_price, not %s' % option_type)
+        kind = FUTURES if strike_price is None else OPTIONS
+        expiry = np.datetime64(expiry, 'D')
+        date_from = None if from_to is None or from_to[0] is None else np.datetime64(from_to[0], 'D')
+        date_to = None if from_to is None or from_to[1] is None else np.datetime64(from_to[1], 'D')
+
+        filters = {'symbol': symbol, 'expiry_date': expiry}
+        if strike_price is not None:
+            filters.update({'strike_price': float(strike_price), 'option_type': option_type})
+        columns = ['date', 'symbol', 'expiry_date', 'strike_price', 'option_type', 'close', 'settlement_price',
+                   'trading_volume', 'open_interest', 'change_in_oi']
+
+        dfs = []
+        for instr in kind.values():
+            by_date = self.index(instr)['contracts'].get((symbol, expiry), {})
+            locations = [loc for date, locs in by_date.items()
+                         if (date_from is None or date >= date_from) and (date_to is None or date <= date_to)
+                         for loc in locs]
+            if len(locations) > 0:
+                dfs.append(self.__read__(instr, locations, filters, columns=columns))
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(dfs, axis=0)
+        if date_from is not None:
+            df = df.loc[df['date'] >= pd.Timestamp(date_from)]
+        if date_to is not None:
+            df = df.loc[df['date'] <= pd.Timestamp(date_to)]
+        return df.sort_values(by='date').reset_index(drop=True)
+
+def with_columns(columns, sort_by):
+    """ columns to read for a lookup of columns (None: all) sorted by sort_by """
+    return None if columns is None else columns + [c for c in sort_by if c not in columns]
+
+''' ------------------------------------------------------------------------------------------ '''
+def test_me():
+    """ offline: synthetic STO (a row group per day) & STF (2 days per row group) files, 2 symbols, 2 expiries """
+    print('fin_data.nse_pv.nse_fo.test_me:', end=' ')
+    elapsed_time('fin_data.nse_pv.nse_fo.test_me')
+    dates = pd.bdate_range('2030-01-01', '2030-01-04')
+    expiries = pd.to_datetime(['2030-01-31', '2030-02-28'])
+    strikes = [90.0, 100.0, 110.0]
+
+    def fo_rows(instr, date):
+        rows = []
+        for symbol in ['AAA', 'BBB']:
+            for i, expiry in enumerate(expiries):
+                contracts = [(None, None)] if instr == 'STF' else [(k, t) for k in strikes for t in ['CE', 'PE']]
+                for strike_price, option_type in contracts:
+                    close = 100.0 + date.day + 10 * i if strike_price is None else \
+                        max(100.0 - strike_price if option_type == 'CE' else strike_price - 100.0, 0) + date.day + i
+                    rows.append({'date': date, 'instr_type': instr, 'symbol': symbol, 'ISIN': None,
+                                 'expiry_date': expiry, 'strike_price': strike_price, 'option_type': option_type,
+                                 'open': close, 'high': close, 'low': close, 'close': close, 'settlement_price': close,
+                                 'trading_volume': 10, 'open_interest': 1000 * date.day + 100 * i,
+                                 'change_in_oi': 1000, 'trading_value': 10 * close})
+        return pd.DataFrame(rows).astype({'strike_price': float})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.makedirs(os.path.join(tmp_dir, 'processed/2030'))
+        for instr in ['STO', 'STF']:
+            tables = [pa.Table.from_pandas(fo_rows(instr, d), preserve_index=False) for d in dates]
+            if instr == 'STF':
+                tables = [pa.concat_tables(tables[0:2]), pa.concat_tables(tables[2:4])]
+            with pv_store.parquet_writer(os.path.join(tmp_dir, f'processed/2030/fo_bhavcopy_{instr}.csv.parquet'),
+                                         tables[0].schema) as writer:
+                [writer.write_table(t) for t in tables]
+        fo_obj = NseFOData(data_path=tmp_dir)
+        reads = []
+        read = fo_obj.__read__
+        fo_obj.__read__ = lambda instr, locations, *args, **kwargs: \
+            reads.append((instr, sorted(set(locations)))) or read(instr, locations, *args, **kwargs)
+
+        assert fo_obj.get_expiries('AAA', '2030-01-02') == ['2030-01-31', '2030-02-28']
+        assert fo_obj.get_expiries('AAA', '2030-01-05') == [], 'not a trading day'
+        x = fo_obj.get_option_chain('AAA', '2030-01-02')  # nearest expiry
+        assert reads[-1] == ('STO', [(0, 1)]), 'ERROR! row groups read: %s' % reads
+        assert list(x['expiry_date'].unique()) == [expiries[0]] and list(x['strike_price']) == [90, 90, 100, 100, 110, 110]
+        assert list(x['option_type']) == ['CE', 'PE'] * 3 and list(x['close']) == [12, 2, 2, 2, 2, 12]
+        x = fo_obj.get_option_chain('BBB', '2030-01-04', expiry='2030-02-28', columns=['strike_price', 'close'])
+        assert list(x.columns) == ['strike_price', 'close'] and list(x['close']) == [15, 5, 5, 5, 5, 15]
+        y = fo_rows('STO', dates[3])
+        y = y.loc[(y['symbol'] == 'BBB') & (y['expiry_date'] == expiries[1])].sort_values(by=['strike_price', 'option_type'])
+        pd.testing.assert_frame_equal(fo_obj.get_option_chain('BBB', '2030-01-04', expiry='2030-02-28'),
+                                      y.reset_index(drop=True), check_dtype=False)
+
+        x = fo_obj.get_futures_curve('AAA', '2030-01-03')
+        assert reads[-1] == ('STF', [(0, 1)]), 'ERROR! row groups read: %s' % reads
+        assert list(x['expiry_date']) == list(expiries) and list(x['close']) == [103, 113] and (x['symbol'] == 'AAA').all()
+
+        x = fo_obj.get_oi_series('AAA', '2030-02-28', strike_price=110, option_type='PE', from_to=['2030-01-02', None])
+        assert reads[-1] == ('STO', [(0, 1), (0, 2), (0, 3)]), 'ERROR! row groups read: %s' % reads
+        assert list(x['date']) == list(dates[1:]) and list(x['open_interest']) == [2100, 3100, 4100]
+        assert list(x['close']) == [13, 14, 15] and (x['option_type'] == 'PE').all() and (x['strike_price'] == 110).all()
+        x = fo_obj.get_oi_series('BBB', '2030-01-31', from_to=['2030-01-01', '2030-01-02'])
+        assert reads[-1] == ('STF', [(0, 0)]), 'ERROR! row groups read: %s' % reads
+        assert list(x['close']) == [101, 102] and list(x['open_interest']) == [1000, 2000]
+        for option_type in [None, 'XX']:
+            try:
+                fo_obj.get_oi_series('AAA', '2030-01-31', strike_price=100, option_type=option_type)
+                assert False, 'ERROR! option_type %s' % option_type
+            except ValueError:
+                pass
+        assert fo_obj.get_oi_series('AAA', '2030-03-28').shape[0] == 0
+    print('OK')
+    return True, elapsed_time('fin_data.nse_pv.nse_fo.test_me')
+
+''' ------------------------------------------------------------------------------------------ '''
+if __name__ == '__main__':
+    test_me()
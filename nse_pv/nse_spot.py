@@ -7,155 +7,493 @@ from fin_data.env import *
 import os
 import sys
 import glob
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pandas.api.indexers import BaseIndexer
 from numpy import datetime_as_string
 from datetime import datetime, date, timedelta
 import fin_data.common.nse_cf_ca as nse_cf_ca
 import fin_data.common.nse_symbols as nse_symbols
+import fin_data.nse_pv.pv_store as pv_store
+import fin_data.nse_pv.trading_calendar as trading_calendar
 import pygeneric.http_utils as http_utils
 
 PATH_2 = os.path.join(DATA_ROOT, '00_common/02_nse_indices')
+CA_PRICE_COLS = ['Prev Close', 'Open', 'High', 'Low', 'Close']
+LATEST_LOOKBACK_DAYS = 10  # get_latest_closing_prices: bars of the last 10 days only
 
 ''' ------------------------------------------------------------------------------------------ '''
+class _WindowBounds(BaseIndexer):
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None, closed=None, step=None):
+        return self.start, self.end
+
+def get_52week_high_low(df, low='Low', high='High'):
+    """
+    52 week low / high (& their dates) for every row, per Symbol & Series. Window: [Date - 1 year, Date]
+    In one grouped pass: rolling min / max over per row window bounds (O(n)). To also get the date of
+    the min / max, price (to 4 decimals) & day are packed into one key, so ties go to the earliest date
+    Returns df sorted by Symbol, Series, Date
+    """
+    df = df.sort_values(by=['Symbol', 'Series', 'Date']).reset_index(drop=True)
+    n = df.shape[0]
+    if n == 0:
+        return df.assign(**{c: None for c in ['52wk_low', '52wk_low_date', '52wk_high', '52wk_high_date']})
+
+    new_group = np.zeros(n, dtype=bool)
+    new_group[0] = True
+    for k in ['Symbol', 'Series']:
+        values = df[k].values
+        new_group[1:] |= values[1:] != values[:-1]
+    group = np.cumsum(new_group)
+
+    days = df['Date'].values.astype('datetime64[D]').astype(np.int64)
+    days_1yago = (df['Date'] - pd.DateOffset(years=1)).values.astype('datetime64[D]').astype(np.int64)
+    day_key = group * 100000 + days
+    window = _WindowBounds(start=np.searchsorted(day_key, group * 100000 + days_1yago, side='left'),
+                           end=np.arange(1, n + 1))
+
+    for col, label in [(low, '52wk_low'), (high, '52wk_high')]:
+        price_key = np.round(df[col].values.astype(float) * 10000) * 100000
+        if label == '52wk_low':
+            key = pd.Series(price_key + days).rolling(window, min_periods=1).min().values
+            day = key % 100000
+        else:
+            key = pd.Series(price_key + (99999 - days)).rolling(window, min_periods=1).max().values
+            day = 99999 - key % 100000
+        found = ~np.isnan(key)
+        pos = np.searchsorted(day_key, group * 100000 + np.where(found, day, 0).astype(np.int64))
+        pos = np.minimum(pos, n - 1)
+        df[label] = np.where(found, df[col].values[pos], np.nan)
+        df[label + '_date'] = pd.Series(df['Date'].values[pos]).where(found)
+
+    return df
+
+def adjust_for_corporate_actions_all(df_raw, cfca, cols1, date_col='Date'):
+    """
+    Apply corporate actions cfca (see NseCorporateActions.get_all_cf_ca_multipliers) to cols1, for all
+    symbols in df_raw in one go: rows with date_col < Ex Date are divided by MULT. Same order & rounding
+    as the per symbol version: pass k applies the k-th action of every symbol, so the number of passes
+    is the max # of actions of any one symbol
+    """
+    cols = [c for c in cols1 if c in df_raw.columns]
+    if cfca.shape[0] == 0 or len(cols) == 0:
+        return df_raw
+
+    cfca = cfca.assign(ca_seq=cfca.groupby('Symbol').cumcount(), ex_date=pd.to_datetime(cfca['Ex Date']))
+    for _, cfca_k in cfca.groupby('ca_seq'):
+        ex_date = df_raw['Symbol'].map(dict(zip(cfca_k['Symbol'], cfca_k['ex_date'])))
+        mult    = df_raw['Symbol'].map(dict(zip(cfca_k['Symbol'], cfca_k['MULT'])))
+        to_adjust = (df_raw[date_col] < ex_date).values
+        df_raw.loc[to_adjust, cols] = round(df_raw.loc[to_adjust, cols].div(mult.values[to_adjust], axis=0), 2)
+
+    return df_raw
+
+def last_bars(df):
+    """ last row (by Date) of every (Symbol, Series), sorted by Symbol / Series """
+    df = df.sort_values(by=['Symbol', 'Series', 'Date'], kind='stable')
+    return df.drop_duplicates(subset=['Symbol', 'Series'], keep='last').reset_index(drop=True)
+
 class NseSpotPVData:
-    def __init__(self, verbose=False):
-        self.data_path = os.path.join(DATA_ROOT, '01_nse_pv/02_dr')
-
-        data_files = glob.glob(os.path.join(self.data_path, 'processed/**/cm_bhavcopy_all.csv.parquet'))
-        self.pv_data = pd.concat([pd.read_parquet(f) for f in data_files])
-        self.pv_data.sort_values(by='Date', inplace=True)
-        self.pv_data.reset_index(drop=True, inplace=True)
-        if verbose:
-            print('pv_data.shape shape:', self.pv_data.shape, end=', ')
-            print('%d symbols, %d market days' % (len(self.pv_data['Symbol'].unique()),
-                                                  len(self.pv_data['Date'].unique())))
-
-        data_files = glob.glob(os.path.join(self.data_path, 'processed/**/index_bhavcopy_all.csv.parquet'))
-        self.pv_data_index = pd.concat([pd.read_parquet(f) for f in data_files])
-        self.pv_data_index['Symbol'] = self.pv_data_index['Index Name'].apply(lambda x: x.upper())
-        self.pv_data_index.insert(0, 'Symbol', self.pv_data_index.pop('Symbol'))
-        self.pv_data_index.sort_values(by=['Symbol', 'Date'], inplace=True)
-        self.pv_data_index.reset_index(drop=True, inplace=True)
-        if verbose:
-            print('pv_data_index shape:', self.pv_data_index.shape, end=', ')
-            print('%d indices, mapped to %d symbols, %d market days' %
-                  (len(self.pv_data_index['Index Name'].unique()),
-                   len(self.pv_data_index['Symbol'].unique()),
-                   len(self.pv_data_index['Date'].unique())))
-
-        data_files = glob.glob(os.path.join(self.data_path, 'processed/**/etf_bhavcopy_all.csv.parquet'))
-        md_etf = pd.read_excel(os.path.join(CONFIG_ROOT, '03_fin_data.xlsx'), sheet_name='nse_etf')
-        self.pv_data_etf = pd.concat([pd.read_parquet(f) for f in data_files])
-        self.pv_data_etf = pd.merge(self.pv_data_etf, md_etf,
-                                    on=['Symbol', 'SECURITY', 'UNDERLYING'], how='left')
-        self.pv_data_etf.sort_values(by=['Symbol', 'Date'], inplace=True)
-        self.pv_data_etf.reset_index(drop=True, inplace=True)
-        if verbose:
-            print('pv_data_etf shape:', self.pv_data_etf.shape, end=', ')
-            print('%d etfs symbols, %d market days' %
-                  (len(self.pv_data_etf['Symbol'].unique()), len(self.pv_data_etf['Date'].unique())))
-            self.pv_data_etf.to_csv(os.path.join(LOG_DIR, 'df.csv'))
-
-        self.nse_ca_obj = nse_cf_ca.NseCorporateActions(verbose=verbose)
+    """
+    lazy=False: cm, index & etf data and corporate actions are all loaded at construction
+    lazy=True:  each dataset is loaded only on first access. get_*_pv_data calls then read only
+                the requested symbols / series / dates / columns, with pyarrow filters (so row
+                groups are pruned using parquet statistics) instead of loading full history
+    cm_layout='symbol' (lazy only): cm data is read from the symbol partitioned store written by
+                process_dr.process_cm_reports(layout='symbol'), see pv_store
+    compact=True: loaded frames are kept in compact dtypes (categorical strings, float32 / int32 where
+                lossless, see pv_store.compact_dtypes). What get_* return is in standard dtypes as before
+    mmap=True:  loaded frames come from a memory mapped Arrow IPC cache (built by the first instance,
+                rebuilt when the parquet files change), so later instances start in well under a second
+                & share physical pages. Best with compact=True (strings as categoricals are shared too)
+    """
+    def __init__(self, verbose=False, lazy=False, cm_layout='year', compact=False, mmap=False, data_path=None):
+        assert cm_layout == 'year' or (cm_layout == 'symbol' and lazy), 'Invalid cm_layout %s' % cm_layout
+        self.verbose = verbose
+        self.lazy = lazy
+        self.cm_layout = cm_layout
+        self.compact = compact
+        self.mmap = mmap
+        self.data_path = os.path.join(DATA_ROOT, '01_nse_pv/02_dr') if data_path is None else data_path
+
+        self.__pv_data__ = None
+        self.__pv_data_index__ = None
+        self.__pv_data_etf__ = None
+        self.__md_etf__ = None
+        self.__nse_ca_obj__ = None
+        self.__files__ = {}
+        self.__row_index__ = {}
+        self.__latest_bars__ = None
+
+        if not lazy:
+            _ = self.pv_data, self.pv_data_index, self.pv_data_etf, self.nse_ca_obj
 
         return
 
-    def get_52week_high_low(self, df):
-        df['1yago'] = df['Date'].apply(lambda x: datetime(x.year - 1, x.month, x.day))
-
-        def min_max(dates):
-            df_1y = df.loc[(df['Date'] >= dates[0]) & (df['Date'] <= dates[1])]
-            id_min = df_1y['Low'].idxmin()
-            id_max = df_1y['High'].idxmax()
-            return [df_1y.at[id_min, 'Low'], df_1y.at[id_min, 'Date'],
-                    df_1y.at[id_max, 'High'], df_1y.at[id_max, 'Date']]
-
-        df['min_max'] = df.apply(lambda x: min_max([x['1yago'], x['Date']]), axis=1)
-        df['52wk_low'] = df['min_max'].apply(lambda x: x[0])
-        df['52wk_low_date'] = df['min_max'].apply(lambda x: x[1])
-        df['52wk_high'] = df['min_max'].apply(lambda x: x[2])
-        df['52wk_high_date'] = df['min_max'].apply(lambda x: x[3])
-        df.drop(columns=['min_max'], inplace=True)
+    ''' datasets, loaded on first access ---------------------------------------------------- '''
+    @property
+    def pv_data(self):
+        if self.__pv_data__ is None:
+            def load():
+                df = pv_store.read_pv_parquet(self.__data_files__('cm'), compact=self.compact)
+                df.sort_values(by=['Symbol', 'Series', 'Date'], inplace=True)
+                df.reset_index(drop=True, inplace=True)
+                return df
+            df = self.__load__('cm', load)
+            self.__row_index__['cm'] = self.__build_row_index__(df, ['Symbol', 'Series'])
+            if self.verbose:
+                print('pv_data.shape shape:', df.shape, end=', ')
+                print('%d symbols, %d market days' % (len(df['Symbol'].unique()), len(df['Date'].unique())))
+            self.__pv_data__ = df
+        return self.__pv_data__
+
+    @property
+    def pv_data_index(self):
+        if self.__pv_data_index__ is None:
+            def load():
+                df = self.__prepare_index_df__(pv_store.read_pv_parquet(self.__data_files__('index')))
+                return pv_store.compact_dtypes(df) if self.compact else df
+            df = self.__load__('index', load)
+            self.__row_index__['index'] = self.__build_row_index__(df, ['Symbol'])
+            if self.verbose:
+                print('pv_data_index shape:', df.shape, end=', ')
+                print('%d indices, mapped to %d symbols, %d market days' %
+                      (len(df['Index Name'].unique()), len(df['Symbol'].unique()), len(df['Date'].unique())))
+            self.__pv_data_index__ = df
+        return self.__pv_data_index__
+
+    @property
+    def pv_data_etf(self):
+        if self.__pv_data_etf__ is None:
+            def load():
+                df = self.__prepare_etf_df__(pv_store.read_pv_parquet(self.__data_files__('etf')))
+                return pv_store.compact_dtypes(df) if self.compact else df
+            df = self.__load__('etf', load)
+            self.__row_index__['etf'] = self.__build_row_index__(df, ['Symbol'])
+            if self.verbose:
+                print('pv_data_etf shape:', df.shape, end=', ')
+                print('%d etfs symbols, %d market days' % (len(df['Symbol'].unique()), len(df['Date'].unique())))
+                df.to_csv(os.path.join(LOG_DIR, 'df.csv'))
+            self.__pv_data_etf__ = df
+        return self.__pv_data_etf__
+
+    @property
+    def nse_ca_obj(self):
+        if self.__nse_ca_obj__ is None:
+            self.__nse_ca_obj__ = nse_cf_ca.NseCorporateActions(verbose=self.verbose)
+        return self.__nse_ca_obj__
+
+    @property
+    def latest_bars(self):
+        """
+        last bar of every (Symbol, Series), corporate action adjusted as by get_pv_data: {'df': bars sorted
+        by Symbol / Series, 'rows': {Symbol: {Series: row}}, 'dates', 'raw': unadjusted bars, 'sources': file stats,
+        'symbol_changes': nse_symbols.symbol_changes_signature of the symbols}.
+        Taken from pv_data or (lazy) from the newest year's files only (& the previous year's last
+        LATEST_LOOKBACK_DAYS, early in a year), kept current by refresh()
+        """
+        if self.__latest_bars__ is None:
+            files = self.__cm_files__()
+            if not self.lazy:
+                df = self.pv_data
+                df = df.iloc[sorted(end - 1 for r in self.__row_index__['cm']['ranges'].values() for _, _, end in r)]
+                df = pv_store.standard_dtypes(df) if self.compact else df.copy()
+            else:
+                assert len(files) > 0, 'No cm data files'
+                years = sorted(files.keys())
+                df = pv_store.read_pv_parquet(files[years[-1]])
+                ''' early in a year, last bars of the previous year are in the lookback window too '''
+                lookback_from = pd.Timestamp(datetime.today().date() - timedelta(LATEST_LOOKBACK_DAYS))
+                if len(years) > 1 and df['Date'].min() > lookback_from:
+                    prev_df = pv_store.read_pv_parquet(files[years[-2]], filters=[('Date', '>=', lookback_from)])
+                    df = pd.concat([prev_df, df], axis=0)
+                df = last_bars(df)
+            self.__latest_bars__ = self.__index_latest_bars__(df, self.__file_stats__(files))
+        return self.__latest_bars__
+
+    def __load__(self, dataset, load):
+        """ load() or (mmap mode) the cached result of it, see pv_store.read_ipc_cache """
+        if not self.mmap:
+            return load()
+        sources = self.__data_files__(dataset) + \
+            ([os.path.join(CONFIG_ROOT, '03_fin_data.xlsx')] if dataset == 'etf' else [])
+        name = dataset + ('_compact' if self.compact else '')
+        df = pv_store.read_ipc_cache(name, sources)
+        if df is None:
+            if self.verbose:
+                print(f'building {name} cache', end=', ')
+            pv_store.write_ipc_cache(name, load(), sources)
+            df = pv_store.read_ipc_cache(name, sources)
+        return df
 
+    def __data_files__(self, dataset):
+        if dataset not in self.__files__.keys():
+            file_name = {'cm': 'cm_bhavcopy_all', 'index': 'index_bhavcopy_all', 'etf': 'etf_bhavcopy_all',
+                         'cm_enriched': 'cm_bhavcopy_enriched'}[dataset]
+            ''' + fragments written by process_dr.wrapper(incremental=True) '''
+            self.__files__[dataset] = \
+                sorted(glob.glob(os.path.join(self.data_path, f'processed/**/{file_name}.csv.parquet')) +
+                       glob.glob(os.path.join(self.data_path, f'processed/**/{file_name}.[0-9][0-9][0-9].csv.parquet')))
+        return self.__files__[dataset]
+
+    def __prepare_index_df__(self, df):
+        df['Symbol'] = df['Index Name'].apply(lambda x: x.upper())
+        df.insert(0, 'Symbol', df.pop('Symbol'))
+        df.sort_values(by=['Symbol', 'Date'], inplace=True)
+        df.reset_index(drop=True, inplace=True)
         return df
 
+    def __prepare_etf_df__(self, df):
+        if self.__md_etf__ is None:
+            self.__md_etf__ = pd.read_excel(os.path.join(CONFIG_ROOT, '03_fin_data.xlsx'), sheet_name='nse_etf')
+        df = pd.merge(df, self.__md_etf__, on=['Symbol', 'SECURITY', 'UNDERLYING'], how='left')
+        df.sort_values(by=['Symbol', 'Date'], inplace=True)
+        df.reset_index(drop=True, inplace=True)
+        return df
+
+    ''' row index: {Symbol: [(Series, start, end), ...]} over a frame sorted by (Symbol, [Series,] Date)
+        Date is sorted within every [start, end) range, so date bounds are found by binary search '''
+    def __build_row_index__(self, df, keys):
+        n = df.shape[0]
+        key_change = np.zeros(n, dtype=bool)
+        key_change[0:1] = True
+        for k in keys:
+            values = df[k].values
+            key_change[1:] |= values[1:] != values[:-1]
+        starts = np.flatnonzero(key_change)
+        ends   = np.append(starts[1:], n)
+
+        row_index = {}
+        series = df['Series'].values[starts] if 'Series' in keys else [None] * len(starts)
+        for symbol, ser, start, end in zip(df['Symbol'].values[starts], series, starts, ends):
+            row_index.setdefault(symbol, []).append((ser, start, end))
+        return {'ranges': row_index, 'dates': df['Date'].values}
+
+    def __lookup_rows__(self, dataset, symbols, series, date_from, date_to):
+        row_index = self.__row_index__[dataset]
+        dates = row_index['dates']
+        date_from = np.datetime64(date_from)
+        date_to   = None if date_to is None else np.datetime64(date_to)
+
+        ranges = []
+        for symbol in dict.fromkeys(symbols):
+            for ser, start, end in row_index['ranges'].get(symbol, []):
+                if series is not None and ser != series:
+                    continue
+                lo = start + np.searchsorted(dates[start:end], date_from, side='left')
+                hi = end if date_to is None else start + np.searchsorted(dates[start:end], date_to, side='right')
+                if hi > lo:
+                    ranges.append((lo, hi))
+        return sorted(ranges)
+
+    ''' select rows: from memory, or (lazy mode) straight from the parquet files ------------ '''
+    def __select__(self, dataset, symbols, series=None, from_to=None, columns=None):
+        if type(symbols) == str:
+            symbols = [symbols]
+        elif type(symbols) != list:
+            raise ValueError(f'Invalid argument symbols type {type(symbols)}')
+        date_from = datetime.strptime(from_to[0], '%Y-%m-%d')
+        date_to   = None if from_to[1] is None else datetime.strptime(from_to[1], '%Y-%m-%d')
+        key_cols  = ['Date', 'Symbol', 'Index Name', 'Series']
+
+        if not self.lazy and dataset != 'cm_enriched':
+            all_df = {'cm': self.pv_data, 'index': self.pv_data_index, 'etf': self.pv_data_etf}[dataset]
+            ranges = self.__lookup_rows__(dataset, symbols, series, date_from, date_to)
+            if len(ranges) == 1:
+                df = all_df.iloc[ranges[0][0]:ranges[0][1]]
+            else:
+                df = all_df.iloc[np.concatenate([np.arange(lo, hi) for lo, hi in ranges])] \
+                    if len(ranges) > 0 else all_df.iloc[0:0]
+            df = pv_store.standard_dtypes(df) if self.compact else df
+            df = df.copy() if self.mmap else df  # not views of the read-only cache
+            return df if columns is None else df[[c for c in df.columns if c in columns + key_cols]]
+
+        if dataset == 'cm' and self.cm_layout == 'symbol':
+            df = pv_store.read_cm_store(symbols, series=series, date_from=date_from, date_to=date_to,
+                                        columns=None if columns is None else columns + key_cols)
+            df = df.sort_values(by='Date', kind='stable').reset_index(drop=True)
+            return df
+
+        ''' index files have Index Name only (Symbol is its upper case) '''
+        symbol_field = pc.utf8_upper(pc.field('Index Name')) if dataset == 'index' else pc.field('Symbol')
+        filters = symbol_field.isin(symbols) & (pc.field('Date') >= date_from)
+        if date_to is not None:
+            filters = filters & (pc.field('Date') <= date_to)
+        if series is not None:
+            filters = filters & (pc.field('Series') == series)
+
+        files = self.__data_files__(dataset)
+        read_columns = None if columns is None else \
+            [c for c in pq.read_schema(files[0]).names if c in columns + key_cols]
+        df = pv_store.read_pv_parquet(files, columns=read_columns, filters=filters)
+
+        if dataset == 'index':
+            df = self.__prepare_index_df__(df)
+        elif dataset == 'etf':
+            df = self.__prepare_etf_df__(df)
+        else:
+            df = df.sort_values(by='Date', kind='stable')
+        df.reset_index(drop=True, inplace=True)
+        return df if columns is None else df[[c for c in df.columns if c in columns + key_cols]]
+
+    ''' latest bar table --------------------------------------------------------------------- '''
+    def __cm_files__(self):
+        """ cm parquet files of the cm_layout, as {year: [files]} """
+        if self.cm_layout == 'year':
+            files = [(int(os.path.basename(os.path.dirname(f))), f) for f in self.__data_files__('cm')]
+        else:
+            files = [(int(os.path.basename(os.path.dirname(os.path.dirname(f)))[len('year='):]), f)
+                     for f in glob.glob(os.path.join(pv_store.CM_STORE_PATH, 'year=*/bucket=*/cm_bhavcopy.parquet'))]
+        cm_files = {}
+        for year, f in sorted(files):
+            cm_files.setdefault(year, []).append(f)
+        return cm_files
+
+    def __file_stats__(self, cm_files):
+        return {f: (os.path.getsize(f), os.stat(f).st_mtime_ns) for files in cm_files.values() for f in files}
+
+    def __index_latest_bars__(self, raw_df, sources):
+        raw_df = raw_df.reset_index(drop=True)
+        df = self.adjust_for_corporate_actions_all(raw_df.copy(), CA_PRICE_COLS)
+        rows = {}
+        for row, (symbol, series) in enumerate(zip(df['Symbol'].values, df['Series'].values)):
+            rows.setdefault(symbol, {})[series] = row
+        return {'df': df, 'rows': rows, 'dates': df['Date'].values, 'raw': raw_df, 'sources': sources,
+                'symbol_changes': nse_symbols.symbol_changes_signature()}
+
+    @property
+    def calendar(self):
+        return trading_calendar.get_trading_calendar(self.data_path)
+
+    def refresh(self):
+        """
+        pick up cm / index / etf files written (e.g. by process_dr.wrapper) since construction or the last
+        refresh: the latest bar table is updated from the new or changed cm files alone (its bars renamed
+        first if the symbol changes changed since), corporate actions & the trading calendar are read again
+        & loaded datasets are dropped (not lazy: loaded again). Returns those cm files
+        """
+        latest = self.latest_bars
+        self.__files__ = {}
+        cm_files = self.__cm_files__()
+        sources = self.__file_stats__(cm_files)
+        new_files = [f for f in sources.keys() if latest['sources'].get(f) != sources[f]]
+
+        self.__pv_data__, self.__pv_data_index__, self.__pv_data_etf__ = None, None, None
+        self.__md_etf__, self.__nse_ca_obj__ = None, None
+        self.__row_index__ = {}
+        trading_calendar.get_trading_calendar(self.data_path, refresh=True)
+        raw_df = latest['raw']
+        if latest['symbol_changes'] != nse_symbols.symbol_changes_signature():
+            raw_df = last_bars(nse_symbols.apply_symbol_changes(raw_df.copy()))
+        if len(new_files) > 0:
+            raw_df = last_bars(pd.concat([raw_df, last_bars(pv_store.read_pv_parquet(new_files))], axis=0))
+        self.__latest_bars__ = self.__index_latest_bars__(raw_df, sources)
+        if not self.lazy:
+            _ = self.pv_data, self.pv_data_index, self.pv_data_etf
+        if self.verbose:
+            print('refresh: %d new / changed cm files, %d latest bars' % (len(new_files), raw_df.shape[0]))
+        return new_files
+
+    def get_52week_high_low(self, df):
+        return get_52week_high_low(df)
+
     def adjust_for_corporate_actions(self, symbol, df_raw, cols1, cols2):
         symbol_cfca = self.nse_ca_obj.get_cf_ca_multipliers(symbol)
         for idx, cfca_row in symbol_cfca.iterrows():
-            for col in cols1:
+            for col in [c for c in cols1 if c in df_raw.columns]:
                 df_raw.loc[df_raw['Date'] < cfca_row['Ex Date'], col] =\
                     round(df_raw.loc[df_raw['Date'] < cfca_row['Ex Date'], col] / cfca_row['MULT'], 2)
 
         return df_raw
 
-    def get_pv_data(self, symbols, series='EQ', from_to=None, adjust_for_ca=True, get52wkhl=True, verbose=False):
-        if type(symbols) == str:
-            df = self.pv_data.loc[self.pv_data['Symbol'] == symbols]
-        elif type(symbols) == list:
-            df = self.pv_data.loc[self.pv_data['Symbol'].isin(symbols)]
-        else:
-            raise ValueError(f'Invalid argument symbols type {type(symbols)}')
+    def adjust_for_corporate_actions_all(self, df_raw, cols1):
+        cfca = self.nse_ca_obj.get_all_cf_ca_multipliers(symbols=df_raw['Symbol'].unique())
+        return adjust_for_corporate_actions_all(df_raw, cfca, cols1)
 
-        if series is not None:
-            df = df.loc[df['Series'] == series]
+    def get_pv_data(self, symbols, series='EQ', from_to=None, adjust_for_ca=True, get52wkhl=False,
+                    columns=None, verbose=False):
+        """ get52wkhl: adds 52 week low / high columns (one more year of history is read for these) """
+        read_from_to = from_to if not get52wkhl else \
+            [(pd.Timestamp(from_to[0]) - pd.DateOffset(years=1)).strftime('%Y-%m-%d'), from_to[1]]
+        df = self.__select__('cm', symbols, series=series, from_to=read_from_to, columns=columns).copy()
 
-        if from_to[1] is None:
-            df = df.loc[df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')]
-        else:
-            df = df.loc[(df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')) &
-                        (df['Date'] <= datetime.strptime(from_to[1], '%Y-%m-%d'))]
+        if adjust_for_ca:
+            df = self.adjust_for_corporate_actions_all(df, CA_PRICE_COLS)
+            if verbose:
+                print(f'Done. {len(df["Symbol"].unique())} adjusted')
 
-        if not adjust_for_ca:
-            df.sort_values(by=['Date', 'Series', 'Symbol'], inplace=True)
-            df.reset_index(drop=True, inplace=True)
-            return df
+        if get52wkhl:
+            df = get_52week_high_low(df)
+            df = df.loc[df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')]
 
-        if type(symbols) == str:
-            df = self.adjust_for_corporate_actions(
-                symbols, df,
-                ['Prev Close', 'Open', 'High', 'Low', 'Close'],
-                ['Volume', 'Traded Value', 'No Of Trades', 'Delivery Volume']
-            )
-            df.sort_values(by=['Date', 'Series', 'Symbol'], inplace=True)
-            df.reset_index(drop=True, inplace=True)
-            return df
+        df.sort_values(by=['Date', 'Series', 'Symbol'], inplace=True)
+        df.reset_index(drop=True, inplace=True)
+        return df
 
-        """ To do: Fix performance problems + 52_wk_HL """
-        n_adj = 0
-        adjusted_dfs = []
-        for symbol in df['Symbol'].unique():
-            df1 = df.loc[df['Symbol'] == symbol].reset_index(drop=True)
-            df1 = self.adjust_for_corporate_actions(
-                symbol, df1,
-                ['Prev Close', 'Open', 'High', 'Low', 'Close'],
-                ['Volume', 'Traded Value', 'No Of Trades', 'Delivery Volume']
-            )
-            """if get52wkhl:
-                df1 = self.get_52week_high_low(df1)"""
-            adjusted_dfs.append(df1)
-            n_adj += 1
-            if verbose and n_adj % 100 == 0:
-                print(f'  {n_adj} adjusted')
-        if verbose:
-            print(f'Done. {n_adj} adjusted')
-
-        df_adj = pd.concat([x for x in adjusted_dfs])
-        df_adj.sort_values(by=['Date', 'Series', 'Symbol'], inplace=True)
-        df_adj.reset_index(drop=True, inplace=True)
-        return df_adj
+    def get_enriched_pv_data(self, symbols, series='EQ', from_to=None, columns=None):
+        """
+        cm data with the columns materialized by process_dr.process_cm_reports(enriched=True): Adj prices,
+        52 week low / high & volume averages, read straight from the files (lazy or not). Adj prices are
+        adjusted up to 'CA Asof', corporate actions after that are applied here
+        """
+        read_columns = None if columns is None else columns + ['CA Asof']
+        df = self.__select__('cm_enriched', symbols, series=series, from_to=from_to, columns=read_columns).copy()
+
+        cfca = self.nse_ca_obj.get_all_cf_ca_multipliers(symbols=df['Symbol'].unique())
+        cfca = cfca.loc[pd.to_datetime(cfca['Ex Date']) > df['CA Asof'].min()] if df.shape[0] > 0 else cfca
+        df = adjust_for_corporate_actions_all(df, cfca, ['Adj ' + c for c in CA_PRICE_COLS] +
+                                              ['52wk_low', '52wk_high'], date_col='CA Asof')
+
+        df.sort_values(by=['Date', 'Series', 'Symbol'], inplace=True)
+        df.reset_index(drop=True, inplace=True)
+        return df
 
     def get_latest_closing_prices(self, symbols, series='EQ'):
-        date_from = (datetime.today() - timedelta(10)).strftime('%Y-%m-%d')
-        df = self.get_pv_data(symbols, series=series, from_to=[date_from, None])
-        last_date = df['Date'].unique()[-1]
-        df = df.loc[df['Date'] == last_date].reset_index(drop=True)
-        return df
+        """ bars of the last date (within LATEST_LOOKBACK_DAYS) any of symbols traded on, from latest_bars alone """
+        symbols = [symbols] if type(symbols) == str else symbols
+        latest = self.latest_bars
+        rows = []
+        for symbol in dict.fromkeys(symbols):
+            symbol_rows = latest['rows'].get(symbol, {})
+            rows += list(symbol_rows.values()) if series is None else \
+                ([symbol_rows[series]] if series in symbol_rows else [])
+        rows = np.array(sorted(rows), dtype=np.int64)
+        dates = latest['dates'][rows]
+        rows = rows[dates >= np.datetime64(datetime.today().date() - timedelta(LATEST_LOOKBACK_DAYS))]
+        if len(rows) > 0:
+            rows = rows[latest['dates'][rows] == latest['dates'][rows].max()]
+        df = latest['df'].iloc[rows]
+        if series is None:
+            df = df.sort_values(by=['Series', 'Symbol'])
+        return df.reset_index(drop=True)
+
+    def __trading_window__(self, mid_points, band):
+        """
+        (from, to) days: band - 1 trading days before to band trading days after the trading day nearest
+        mid_points, see trading_calendar. NaT where the calendar does not cover these
+        """
+        mid_day = self.calendar.nearest_trading_day(mid_points)
+        from_day, to_day = self.calendar.shift(mid_day, -(np.asarray(band) - 1)), self.calendar.shift(mid_day, band)
+        known = ~np.isnat(from_day) & ~np.isnat(to_day)
+        return np.where(known, from_day, np.datetime64('NaT', 'D'))[()], \
+            np.where(known, to_day, np.datetime64('NaT', 'D'))[()]
 
     def get_avg_closing_price(self, symbol, mid_point, band=5, series='EQ', index=False, adjust_for_ca=True):
+        """
+        mean Close over band - 1 trading days before to band trading days after the trading day nearest
+        mid_point. Where the trading calendar does not cover these: the symbol's rows around its own row
+        nearest mid_point, within 3 * band calendar days
+        """
         try:
-            date1 = (datetime.strptime(mid_point, '%Y-%m-%d') - timedelta(days=3*band))
-            date2 = (datetime.strptime(mid_point, '%Y-%m-%d') + timedelta(days=3*band))
-            from_to = [date1.strftime('%Y-%m-%d'), date2.strftime('%Y-%m-%d')]
+            from_day, to_day = self.__trading_window__(mid_point, band)
+            if not np.isnat(from_day):
+                from_to = [str(from_day), str(to_day)]
+            else:
+                date1 = (datetime.strptime(mid_point, '%Y-%m-%d') - timedelta(days=3*band))
+                date2 = (datetime.strptime(mid_point, '%Y-%m-%d') + timedelta(days=3*band))
+                from_to = [date1.strftime('%Y-%m-%d'), date2.strftime('%Y-%m-%d')]
             if not index:
                 pv_df = self.get_pv_data(symbol, series=series, from_to=from_to, adjust_for_ca=adjust_for_ca)
             else:
@@ -164,15 +502,16 @@ class NseSpotPVData:
             if pv_df.shape[0] == 0:
                 raise ValueError('No PV data found')
 
-            pv_df['MP'] = mid_point
-            pv_df['MP'] = pd.to_datetime(pv_df['MP'])
-            pv_df['DD'] = abs(pv_df['MP'] - pv_df['Date'])
+            if np.isnat(from_day):
+                pv_df['MP'] = mid_point
+                pv_df['MP'] = pd.to_datetime(pv_df['MP'])
+                pv_df['DD'] = abs(pv_df['MP'] - pv_df['Date'])
 
-            xx = pv_df.sort_values(by='DD')
-            actual_mid_point = xx.reset_index(drop=True).loc[0, 'Date']
-            mid_point_idx = pv_df.loc[pv_df['Date'] == actual_mid_point].index[0]
+                xx = pv_df.sort_values(by='DD')
+                actual_mid_point = xx.reset_index(drop=True).loc[0, 'Date']
+                mid_point_idx = pv_df.loc[pv_df['Date'] == actual_mid_point].index[0]
 
-            pv_df = pv_df[mid_point_idx - (band - 1):mid_point_idx + (band + 1)]
+                pv_df = pv_df[mid_point_idx - (band - 1):mid_point_idx + (band + 1)]
 
             return [datetime_as_string(pv_df['Date'].values[0], unit='D'),
                     datetime_as_string(pv_df['Date'].values[-1], unit='D'),
@@ -180,20 +519,70 @@ class NseSpotPVData:
         except Exception as e:
             raise ValueError('get_avg_closing_price: %s %s [%s]' % (symbol, mid_point, e))
 
-    ''' get_index_pv_data -------------------------------------------------------------------- '''
-    def get_index_pv_data(self, symbols, from_to):
-        if type(symbols) == str:
-            df = self.pv_data_index.loc[self.pv_data_index['Symbol'] == symbols]
-        elif type(symbols) == list:
-            df = self.pv_data_index.loc[self.pv_data_index['Symbol'].isin(symbols)]
+    def get_avg_closing_prices(self, requests, series='EQ', index=False, adjust_for_ca=True):
+        """
+        get_avg_closing_price for every (Symbol, mid_point[, band]) row of the requests frame (band: 5 if
+        not given), in one go: one get_pv_data for all symbols & window bounds for all rows together, by
+        searchsorted (nearest day ties to the earlier day). Returns requests + From, To & Avg Close
+        (None / NaN where there is no PV data in the window)
+        """
+        req = requests.reset_index(drop=True).copy()
+        if 'band' not in req.columns:
+            req['band'] = 5
+        band = req['band'].values.astype(np.int64)
+        mid_day = pd.to_datetime(req['mid_point']).values.astype('datetime64[D]')
+        mid = mid_day.astype(np.int64)
+        from_day, to_day = self.__trading_window__(mid_day, band)
+        known = ~np.isnat(from_day)
+        from_day = np.where(known, from_day, mid_day).astype(np.int64)
+        to_day = np.where(known, to_day, mid_day).astype(np.int64)
+        symbols = list(req['Symbol'].unique())
+        from_to = [str(np.datetime64(int(np.minimum(mid - 3 * band, from_day).min()), 'D')),
+                   str(np.datetime64(int(np.maximum(mid + 3 * band, to_day).max()), 'D'))]
+        if not index:
+            pv_df = self.get_pv_data(symbols, series=series, from_to=from_to, adjust_for_ca=adjust_for_ca)
         else:
-            raise ValueError(f'Invalid argument symbols type {type(symbols)}')
+            pv_df = self.get_index_pv_data(symbols, from_to=from_to)
+
+        ''' (symbol, day) as one int64 key, pv_df sorted by it '''
+        symbol_code = {s: i for i, s in enumerate(symbols)}
+        key = pv_df['Symbol'].map(symbol_code).values.astype(np.int64) * 1000000 + \
+            pv_df['Date'].values.astype('datetime64[D]').astype(np.int64)
+        order = np.argsort(key, kind='stable')
+        pv_df, key = pv_df.iloc[order], key[order]
+        days = key % 1000000
+        req_code = req['Symbol'].map(symbol_code).values.astype(np.int64) * 1000000
+        lo = np.searchsorted(key, req_code + mid - 3 * band, side='left')
+        hi = np.searchsorted(key, req_code + mid + 3 * band, side='right')
+        found = hi > lo
+        n = len(key)
+        after  = np.searchsorted(key, req_code + mid, side='left')
+        before = after - 1
+        dist_before = np.where(before >= lo, mid - days[np.clip(before, 0, n - 1)], np.iinfo(np.int64).max)
+        dist_after  = np.where(after < hi, days[np.clip(after, 0, n - 1)] - mid, np.iinfo(np.int64).max)
+        mid_idx = np.where(dist_before <= dist_after, before, after)
+
+        start = np.maximum(lo, mid_idx - (band - 1))
+        end   = np.where(found, np.minimum(hi, mid_idx + band + 1), start)
+
+        ''' where the trading calendar covers the window: all rows in it '''
+        start = np.where(known, np.searchsorted(key, req_code + from_day, side='left'), start)
+        end   = np.where(known, np.searchsorted(key, req_code + to_day, side='right'), end)
+        found = np.where(known, end > start, found)
+        if not found.any():
+            return req.assign(**{'From': None, 'To': None, 'Avg Close': np.nan})
+
+        dates = pv_df['Date'].values
+        req['From'] = [datetime_as_string(dates[i], unit='D') if f else None for i, f in zip(start, found)]
+        req['To'] = [datetime_as_string(dates[i - 1], unit='D') if f else None for i, f in zip(end, found)]
+        ''' mean of each window's own slice, as Series.mean '''
+        close = pv_df['Close'].values
+        req['Avg Close'] = [round(np.nanmean(close[s:e]), 2) if f else np.nan for s, e, f in zip(start, end, found)]
+        return req
 
-        if from_to[1] is None:
-            df = df.loc[df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')]
-        else:
-            df = df.loc[(df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')) &
-                        (df['Date'] <= datetime.strptime(from_to[1], '%Y-%m-%d'))]
+    ''' get_index_pv_data -------------------------------------------------------------------- '''
+    def get_index_pv_data(self, symbols, from_to):
+        df = self.__select__('index', symbols, from_to=from_to)
 
         ''' messy workaround right now'''
         if from_to[0] < '2018-01-01' and type(symbols) == str:
@@ -212,20 +601,7 @@ class NseSpotPVData:
 
     ''' get_etf_pv_data -------------------------------------------------------------------- '''
     def get_etf_pv_data(self, symbols, from_to):
-        if type(symbols) == str:
-            df = self.pv_data_etf.loc[self.pv_data_etf['Symbol'] == symbols]
-        elif type(symbols) == list:
-            df = self.pv_data_etf.loc[self.pv_data_etf['Symbol'].isin(symbols)]
-        else:
-            raise ValueError(f'Invalid argument symbols type {type(symbols)}')
-
-        if from_to[1] is None:
-            df = df.loc[df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')]
-        else:
-            df = df.loc[(df['Date'] >= datetime.strptime(from_to[0], '%Y-%m-%d')) &
-                        (df['Date'] <= datetime.strptime(from_to[1], '%Y-%m-%d'))]
-
-        df.reset_index(drop=True, inplace=True)
+        df = self.__select__('etf', symbols, from_to=from_to).reset_index(drop=True)
         return df
 
 ''' ------------------------------------------------------------------------------------------ '''
@@ -1,6 +1,6 @@
 """
 NSE process daily market reports
-Usage: [year]
+Usage: [year] [incremental]
 """
 ''' --------------------------------------------------------------------------------------- '''
 
@@ -9,12 +9,22 @@ import datetime
 import os
 import sys
 import glob
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 from zipfile import ZipFile
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from pygeneric.datetime_utils import elapsed_time
+import fin_data.common.nse_cf_ca as nse_cf_ca
 import fin_data.common.nse_symbols as nse_symbols
+import fin_data.nse_pv.nse_spot as nse_spot
+import fin_data.nse_pv.pv_store as pv_store
 from pygeneric.archiver import Archiver
 
 PATH_1 = os.path.join(DATA_ROOT, '01_nse_pv/02_dr')
@@ -37,19 +47,155 @@ def remove_existing_files(file_regex, verbose=False):
     return
 
 ''' --------------------------------------------------------------------------------------- '''
-def process_index_reports(year, verbose=False):
-    elapsed_time(0)
+class IngestManifest:
+    """
+    Archive members already processed for a year, {archive (path relative to PATH_1): {member: size}},
+    & the symbol changes they were processed with, kept in processed/{year}/ingested_members.json
+    incremental=False: all members are read & the year's files are (re)written
+    incremental=True:  only members not processed yet are read & written as new parquet fragments,
+                       {name}.NNN.csv.parquet next to {name}.csv.parquet. In full if the symbol changes
+                       changed since (renames apply to the rows already written too)
+    """
+    def __init__(self, year, incremental=False):
+        self.year = year
+        self.manifest_file = os.path.join(PATH_2, f'{year}/ingested_members.json')
+        self.symbol_changes = nse_symbols.symbol_changes_signature()
+        manifest = {}
+        if incremental and os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        if incremental and 'members' not in manifest.keys():
+            print(f'WARNING! no manifest for {year}, processing in full')
+            incremental = False
+        elif incremental and manifest.get('symbol_changes') != self.symbol_changes:
+            print(f'WARNING! symbol changes changed since {year} was processed, processing in full')
+            incremental = False
+        self.incremental = incremental
+        self.members = manifest['members'] if incremental else {}
+
+    def new_members(self, archive, archive_file):
+        """ members of archive not processed yet. Sizes are from the zip's directory, nothing is read """
+        key = os.path.relpath(archive_file, PATH_1).replace('\\', '/')
+        with ZipFile(archive_file) as z:
+            zip_sizes = {i.filename: i.file_size for i in z.infolist()}
+        sizes = {f: zip_sizes[f] for f in archive.keys()}
+        done = self.members.get(key, {})
+        changed = [f for f in done.keys() if f in sizes.keys() and sizes[f] != done[f]]
+        assert len(changed) == 0, '%s: %s changed since processed, run in full' % (key, changed)
+        self.members[key] = {**done, **sizes}
+        return [f for f in sizes.keys() if f not in done.keys()]
+
+    def forget(self, archive_file, members):
+        """ members (returned by new_members) left for a later run """
+        key = os.path.relpath(archive_file, PATH_1).replace('\\', '/')
+        for f in members:
+            self.members[key].pop(f)
+        return
+
+    def output_file(self, name):
+        base_file = os.path.join(PATH_2, f'{self.year}/{name}.csv.parquet')
+        if not self.incremental or not os.path.exists(base_file):
+            return base_file
+        n_fragments = len(glob.glob(os.path.join(PATH_2, f'{self.year}/{name}.[0-9][0-9][0-9].csv.parquet')))
+        return os.path.join(PATH_2, f'{self.year}/{name}.{n_fragments + 1:03d}.csv.parquet')
+
+    def save(self):
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump({'symbol_changes': self.symbol_changes, 'members': self.members}, f, indent=1)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+        return
+
+def year_files(year, name):
+    """ the year's file & fragments (see IngestManifest) """
+    return sorted(glob.glob(os.path.join(PATH_2, f'{year}/{name}.csv.parquet')) +
+                  glob.glob(os.path.join(PATH_2, f'{year}/{name}.[0-9][0-9][0-9].csv.parquet')))
 
-    def read_index_file(bytes, index_file_name):
-        df_x = pd.read_csv(bytes)
-        dtstr = index_file_name.split('.')[0][14:]
-        df_x['Index Date'] = '%s-%s-%s' % (dtstr[4:], dtstr[2:4], dtstr[0:2])
+''' --------------------------------------------------------------------------------------- '''
+''' archive member parsers, (member bytes, member name) -> pyarrow Table. Module level, so that
+    parse_members can run them in worker processes '''
+def parse_bhavcopy(bytes, member):
+    """ zipped csv, same as pd.read_csv(compression zip, keep_default_na=False, engine='pyarrow') """
+    with ZipFile(BytesIO(bytes)) as z:
+        csv_bytes = z.read(z.namelist()[0])
+    return pa_csv.read_csv(BytesIO(csv_bytes),
+                           convert_options=pa_csv.ConvertOptions(null_values=[], strings_can_be_null=False))
+
+def parse_index_close(bytes, member):
+    df_x = pd.read_csv(BytesIO(bytes))
+    dtstr = member.split('.')[0][14:]
+    df_x['Index Date'] = '%s-%s-%s' % (dtstr[4:], dtstr[2:4], dtstr[0:2])
+    return pa.Table.from_pandas(df_x, preserve_index=False)
+
+def mto_date(member):
+    dt = member.split('\\')[-1].split('.')[0].split('_')[-1]
+    return datetime.date(year=int(dt[4:]), month=int(dt[2:4]), day=int(dt[0:2]))
+
+def parse_mto(bytes, member):
+    report_date = mto_date(member)
+    cols = ['c1', 'c2', 'Symbol', 'Series', 'Volume_MTO', 'Delivery Volume', 'Delivery Volume %']
+    df_x = pd.concat([pd.read_csv(BytesIO(bytes), skiprows=3, names=cols, header=0, keep_default_na=False),
+                      pd.DataFrame({'Date': [report_date]})], axis=1)
+    df_x.fillna(method='ffill', inplace=True)
+    return pa.Table.from_pandas(df_x, preserve_index=False)
+
+def parse_pr_etf(bytes, member):
+    """ PR member is itself a zip, with one etf file among others. None if no etf file """
+    def read_etf(etf_bytes, etf_file_name):
+        df_x = pd.read_csv(BytesIO(etf_bytes), encoding='cp1252')
+        dtstr = etf_file_name.split('.')[0][3:]
+        df_x['Date'] = f'20%s-%s-%s' % (dtstr[4:], dtstr[2:4], dtstr[0:2])
         return df_x
 
+    with ZipFile(BytesIO(bytes)) as z:
+        dfs = [read_etf(z.read(f1), f1) for f1 in z.namelist() if 'etf' in f1]
+    return pa.Table.from_pandas(pd.concat(dfs), preserve_index=False) if len(dfs) > 0 else None
+
+def archive_members(archive_files, manifest, verbose=False):
+    """ [(archive, members not processed yet)] """
+    result = []
+    for archive_file in archive_files:
+        archive = Archiver(archive_file, mode='r', compression='zip')
+        members = manifest.new_members(archive, archive_file)
+        if verbose:
+            print(f'{archive_file}: ', members)
+        result.append((archive, members))
+    return result
+
+def parse_members(parser, archive_members, workers=1):
+    """
+    parser applied to every member of [(archive, members)], serially or (workers > 1) in a process pool.
+    The tables are concatenated without copying (types unified where they differ between days, else via
+    pandas) & returned as one DataFrame, None if there are no members
+    """
+    member_bytes = [(archive.get(m), m) for archive, members in archive_members for m in members]
+    if len(member_bytes) == 0:
+        return None
+    if workers > 1 and len(member_bytes) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tables = list(pool.map(parser, *zip(*member_bytes),
+                                   chunksize=max(1, len(member_bytes) // (4 * workers))))
+    else:
+        tables = [parser(b, m) for b, m in member_bytes]
+
+    tables = [t for t in tables if t is not None]
+    if len(tables) == 0:
+        return None
+    try:
+        return pa.concat_tables(tables, promote_options='permissive').to_pandas()
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pd.concat([t.to_pandas() for t in tables], axis=0)
+
+''' --------------------------------------------------------------------------------------- '''
+def process_index_reports(year, manifest=None, workers=1, compact=False, profile=None, verbose=False):
+    elapsed_time(0)
+    manifest = IngestManifest(year) if manifest is None else manifest
+
     idx_closing_files = glob.glob(os.path.join(PATH_1, f'{year}/**/indices_close.zip'))
     print('%d index_closing files' % len(idx_closing_files), end='')
-    archives = [Archiver(f, mode='r', compression='zip') for f in idx_closing_files]
-    df = pd.concat([read_index_file(BytesIO(a.get(f)), f) for a in archives for f in a.keys()], axis=0)
+    df = parse_members(parse_index_close, archive_members(idx_closing_files, manifest, verbose), workers)
+    if df is None:
+        print(', no new index_closing files, returning')
+        return
     df = df[[col for col in df.columns if 'Unnamed' not in col]]
     df['Prev Close'] = df['Closing Index Value'] - df['Points Change']
     df.rename(columns={'Index Date': 'Date',
@@ -62,8 +208,7 @@ def process_index_reports(year, verbose=False):
     df.reset_index(drop=True, inplace=True)
     print(', df.shape:', df.shape)
 
-    df.to_parquet(os.path.join(PATH_2, f'{year}/index_bhavcopy_all.csv.parquet'),
-                  index=False, engine='pyarrow', compression='gzip')
+    pv_store.write_pv_parquet(df, manifest.output_file('index_bhavcopy_all'), compact=compact, profile=profile)
     print('time check (total time taken):', elapsed_time(0), 'seconds')
 
     days = sorted(df.loc[df['Index Name'] == 'Nifty 50']['Date'].unique().astype('datetime64[D]'))
@@ -72,8 +217,12 @@ def process_index_reports(year, verbose=False):
     return
 
 ''' --------------------------------------------------------------------------------------- '''
-def process_cm_reports(year, symbols=None, verbose=False):
+def process_cm_reports(year, symbols=None, layout='year', enriched=False, manifest=None, workers=1,
+                       compact=False, profile=None, verbose=False):
+    assert layout in ['year', 'symbol', 'both'], 'Invalid layout %s' % layout
     elapsed_time([0, 1])
+    manifest = IngestManifest(year) if manifest is None else manifest
+    assert not (enriched and manifest.incremental and layout == 'symbol'), 'incremental enriched needs year layout'
 
     common_cols_cm_bhavcopy = [
         'Date', 'Symbol', 'ISIN', 'Series', 'Open', 'High', 'Low', 'Close',
@@ -81,20 +230,11 @@ def process_cm_reports(year, symbols=None, verbose=False):
     ]
 
     ''' Step 1: Read bhavcopy files - OLD and new/v02 '''
-    def read_cm_bhavcopy_files(archive_file, verbose=False):
-        archive = Archiver(archive_file, mode='r', compression='zip')
-        if verbose:
-            print(f'{archive_file} cm_bhavcopy files: ', archive.keys())
-        df_x = pd.concat([pd.read_csv(BytesIO(archive.get(f)), compression={'method':'zip'},
-                                      keep_default_na=False, engine='pyarrow')
-                          for f in archive.keys()])
-        return df_x
-
     ''' Read OLD bhavcopy files '''
     cm_bhavcopy_files = glob.glob(os.path.join(PATH_1, f'{year}/**/cm_bhavcopy.zip'))
     print('%d OLD bhavcopy files' % len(cm_bhavcopy_files), end='')
-    if len(cm_bhavcopy_files) > 0:
-        df = pd.concat([read_cm_bhavcopy_files(f, verbose) for f in cm_bhavcopy_files], axis=0)
+    df = parse_members(parse_bhavcopy, archive_members(cm_bhavcopy_files, manifest, verbose), workers)
+    if df is not None:
         df = df[[col for col in df.columns if 'Unnamed' not in col]]
         df.rename(columns={
             'TIMESTAMP': 'Date', 'SYMBOL': 'Symbol', 'SERIES': 'Series',
@@ -111,8 +251,8 @@ def process_cm_reports(year, symbols=None, verbose=False):
     ''' Read NEW (v02) bhavcopy files '''
     cm_bhavcopy_files_v02 = glob.glob(os.path.join(PATH_1, f'{year}/**/cm_bhavcopy_v02.zip'))
     print(', %d NEW bhavcopy files' % len(cm_bhavcopy_files_v02), end='')
-    if len(cm_bhavcopy_files_v02) > 0:
-        df_v02 = pd.concat([read_cm_bhavcopy_files(f, verbose) for f in cm_bhavcopy_files_v02], axis=0)
+    df_v02 = parse_members(parse_bhavcopy, archive_members(cm_bhavcopy_files_v02, manifest, verbose), workers)
+    if df_v02 is not None:
         df_v02.rename(columns={
             'TradDt':'Date', 'TckrSymb':'Symbol', 'SctySrs':'Series',
             'OpnPric':'Open', 'HghPric':'High', 'LwPric':'Low', 'ClsPric':'Close',
@@ -126,42 +266,39 @@ def process_cm_reports(year, symbols=None, verbose=False):
     print(', df_v02.shape:', df_v02.shape)
 
     df = pd.concat([df, df_v02], axis=0).reset_index(drop=True)
-    if df.shape[0] == 0:
-        print('WARNING! No files (either OLD or NEW/v02 found, returning!')
-        return
     df['Traded Value'] = df['Traded Value'] * 100000   # TO BE CHECKED
 
     print('combined cm_bhavcopy df.shape:', df.shape)
 
-    ''' Read MTO files '''
-    def read_mto_files(archive_file, verbose=False):
-        archive = Archiver(archive_file, mode='r', compression='zip')
-        if verbose:
-            print(f'{archive_file} mto files: ', archive.keys())
-
-        def report_date(f):
-            dt = f.split('\\')[-1].split('.')[0].split('_')[-1]
-            return datetime.date(year=int(dt[4:]), month=int(dt[2:4]), day=int(dt[0:2]))
-
-        cols = ['c1', 'c2', 'Symbol', 'Series', 'Volume_MTO', 'Delivery Volume', 'Delivery Volume %']
-        df_x = pd.concat([pd.concat([pd.read_csv(BytesIO(archive.get(f)), skiprows=3, names=cols,
-                                                 header=0, keep_default_na=False),
-                                     pd.DataFrame({'Date': [report_date(f)]})],
-                                    axis=1) for f in archive.keys()], axis=0)
-        df_x.fillna(method='ffill', inplace=True)
-        return df_x
-
+    ''' Read MTO files: members of days without bhavcopy (in this run or processed before) are left for a
+        later run, members of days processed before are joined to the processed rows (update_delivery) '''
     mto_files = glob.glob(os.path.join(PATH_1, f'{year}/**/MTO.zip'))
     print('%d MTO files' % len(mto_files), end='')
-    if len(mto_files) > 0:
-        df_mto = pd.concat([read_mto_files(f, verbose) for f in mto_files], axis=0)
+    mto_members = archive_members(mto_files, manifest, verbose)
+    new_dates = set(pd.to_datetime(df['Date']).dt.date)
+    processed_dates = processed_cm_dates(year, layout) if manifest.incremental else set()
+    for mto_file, (_, members) in zip(mto_files, mto_members):
+        pending = [m for m in members if mto_date(m) not in new_dates | processed_dates]
+        manifest.forget(mto_file, pending)
+        members[:] = [m for m in members if m not in pending]
+    df_mto = parse_members(parse_mto, mto_members, workers)
+    if df_mto is not None:
         df_mto = df_mto[[col for col in df_mto.columns if 'Unnamed' not in col]]
         df_mto['Date'] = pd.to_datetime(df_mto['Date'])
         df_mto['% Delivery Volume'] = round(df_mto['Delivery Volume'] / 100, 4)
     else:
-        df_mto = pd.DataFrame()
+        df_mto = pd.DataFrame(columns=['Date', 'Symbol', 'Series', 'Delivery Volume', 'Delivery Volume %'])
+        df_mto['Date'] = pd.to_datetime(df_mto['Date'])
     print(', df_mto.shape:', df_mto.shape)
 
+    late_mto = df_mto.loc[~df_mto['Date'].dt.date.isin(new_dates)]
+    if late_mto.shape[0] > 0:
+        update_delivery(year, late_mto, layout=layout, compact=compact, profile=profile, verbose=verbose)
+        print('time check (update delivery):', elapsed_time(1), 'seconds')
+    if df.shape[0] == 0:
+        print('WARNING! No files (either OLD or NEW/v02 found, returning!')
+        return
+
     df['Date'] = pd.to_datetime(df['Date'])
 
     # 2024-07-17: removed 'Volume_MTO'
@@ -174,27 +311,31 @@ def process_cm_reports(year, symbols=None, verbose=False):
     print('time check (load files):', elapsed_time(1), 'seconds')
 
     ''' Processing symbol changes '''
-    all_symbols = sorted(df['Symbol'].unique())
-    print(len(all_symbols), 'symbols found in raw data')
-    symbols_to_process = all_symbols if symbols is None else symbols  # WHY?
-
-    ''' i think this is fishy - closely check in future '''
-    sc_df = nse_symbols.get_symbol_changes()
-    for idx, row in sc_df.iterrows():
-        df.loc[df['Symbol'] == row['Old Symbol'], 'Symbol'] = row['New Symbol']
-        symbols_to_process.append(row['New Symbol'])
-        if row['Old Symbol'] in symbols_to_process:
-            symbols_to_process.remove(row['Old Symbol'])
+    print(len(df['Symbol'].unique()), 'symbols found in raw data')
+    df = nse_symbols.apply_symbol_changes(df)
     print('time check (process symbol changes):', elapsed_time(1), 'seconds')
 
-    df = df.loc[df['Symbol'].isin(symbols_to_process)]
+    if symbols is not None:
+        df = df.loc[df['Symbol'].isin(symbols)]
     df['Date'] = pd.to_datetime(df['Date'], format="%Y-%m-%d")
     df = df.sort_values(by=['Symbol', 'Date']).reset_index(drop=False)
     print('time check (filtering):', elapsed_time(1), 'seconds')
     print('final, merged & processed df.shape:', df.shape)
 
-    df.to_parquet(os.path.join(PATH_2, f'{year}/cm_bhavcopy_all.csv.parquet'),
-                  index=False, engine='pyarrow', compression='gzip')
+    if layout in ['year', 'both']:
+        pv_store.write_pv_parquet(df, manifest.output_file('cm_bhavcopy_all'), compact=compact, profile=profile)
+    if layout in ['symbol', 'both']:
+        if manifest.incremental:
+            pv_store.append_cm_store(df, year, profile=profile, verbose=verbose)
+        else:
+            pv_store.write_cm_store(df, year, profile=profile, verbose=verbose)
+        print('time check (write symbol store):', elapsed_time(1), 'seconds')
+    if enriched:
+        ''' incremental: enriched is rebuilt for the year, but from the processed files (not the zips) '''
+        df_year = df if not manifest.incremental else \
+            pv_store.read_pv_parquet(year_files(year, 'cm_bhavcopy_all'))
+        process_cm_enriched(df_year, year, compact=compact, profile=profile, verbose=verbose)
+        print('time check (write enriched):', elapsed_time(1), 'seconds')
 
     dates_range = sorted(df['Date'].unique())
     first_date  = dates_range[0].astype('datetime64[D]')
@@ -210,31 +351,143 @@ def process_cm_reports(year, symbols=None, verbose=False):
 
     return
 
-''' --------------------------------------------------------------------------------------- '''
-# New, still wip (subject to appl use cases)
-def process_fo_reports(year, verbose=False):
-    elapsed_time([0, 1])
-
-    common_cols_fo_bhavcopy = [
-        'date', 'instr_type', 'symbol', 'ISIN', 'expiry_date', 'strike_price', 'option_type',
-        'open', 'high', 'low', 'close',
-        'settlement_price', 'trading_volume', 'open_interest', 'change_in_oi', 'trading_value'
-    ]
+def parquet_dates(f):
+    """ the dates of a processed file (its Date column only is read) """
+    return set(pd.to_datetime(pq.read_table(f, columns=['Date']).column('Date').to_pandas()).dt.date)
+
+def processed_cm_dates(year, layout='year'):
+    """ dates of the year's processed cm bhavcopy rows (year files, else the symbol store) """
+    files = year_files(year, 'cm_bhavcopy_all') if layout in ['year', 'both'] else \
+        glob.glob(os.path.join(pv_store.CM_STORE_PATH, f'year={year}', 'bucket=*', 'cm_bhavcopy.parquet'))
+    return set(d for f in files for d in parquet_dates(f))
+
+def update_delivery(year, df_mto, layout='year', compact=False, profile=None, verbose=False):
+    """
+    Delivery Volume (%) of df_mto (MTO rows of days processed by an earlier run, see process_cm_reports)
+    set in the processed rows of those days: the year files / symbol store buckets with them are rewritten
+    """
+    cols = ['Delivery Volume', 'Delivery Volume %']
+    df_mto = nse_symbols.apply_symbol_changes(df_mto[['Date', 'Symbol', 'Series'] + cols].copy())
+    df_mto = df_mto.drop_duplicates(subset=['Date', 'Symbol', 'Series'], keep='last')
+    dates = set(df_mto['Date'].dt.date)
+
+    def updated(df):
+        x = df.merge(df_mto, on=['Date', 'Symbol', 'Series'], how='left', suffixes=('', ' (MTO)'))
+        for c in cols:
+            x[c] = x[c + ' (MTO)'].where(x[c + ' (MTO)'].notna(), x[c])
+        return x.drop(columns=[c + ' (MTO)' for c in cols])
+
+    def has_dates(f):
+        return len(dates & parquet_dates(f)) > 0
+
+    n_files = 0
+    if layout in ['year', 'both']:
+        for f in [f for f in year_files(year, 'cm_bhavcopy_all') if has_dates(f)]:
+            pv_store.write_pv_parquet(updated(pv_store.read_pv_parquet(f)), f + '.tmp', compact=compact,
+                                      profile=profile)
+            os.replace(f + '.tmp', f)
+            n_files += 1
+    if layout in ['symbol', 'both']:
+        for bucket in range(pv_store.N_BUCKETS):
+            f = os.path.join(pv_store.CM_STORE_PATH, f'year={year}', f'bucket={bucket}', 'cm_bhavcopy.parquet')
+            if os.path.exists(f) and has_dates(f):
+                pv_store.write_cm_bucket(updated(pv_store.read_pv_parquet(f)), year, bucket, profile=profile)
+                n_files += 1
+    if verbose:
+        print('update_delivery: %d: %d MTO rows of %d days, %d files' % (year, df_mto.shape[0], len(dates), n_files))
+    return
 
-    def read_fo_bhavcopy_files(archive_file, verbose=False):
-        archive = Archiver(archive_file, mode='r', compression='zip')
-        if verbose:
-            print(f'{archive_file} fo_bhavcopy files: ', archive.keys())
-        df_x = pd.concat([pd.read_csv(BytesIO(archive.get(f)), compression={'method': 'zip'},
-                                      keep_default_na=False, engine='pyarrow')
-                          for f in archive.keys()])
-        return df_x
+''' --------------------------------------------------------------------------------------- '''
+def process_cm_enriched(df, year, compact=False, profile=None, verbose=False):
+    """
+    cm_bhavcopy_enriched: cm bhavcopy + Adj prices (adjusted for corporate actions up to 'CA Asof', the
+    year's last date), 52 week low / high of Adj Low / High & volume averages. Only the year's rows are
+    computed & written, the previous year's rows are read just to fill the rolling windows
+    """
+    date_from = df['Date'].min()
+    prev_files = year_files(year - 1, 'cm_bhavcopy_all')
+    if len(prev_files) > 0:
+        prev_df = pv_store.read_pv_parquet(prev_files, filters=[('Date', '>=', date_from - pd.DateOffset(years=1))])
+    else:
+        print('WARNING! no %d cm_bhavcopy_all, 52 week & volume averages only from %d' % (year - 1, year))
+        prev_df = df.iloc[0:0]
+    cols = [c for c in df.columns if c != 'index']
+    all_df = pd.concat([prev_df[[c for c in cols if c in prev_df.columns]], df[cols]], axis=0)
+
+    ca_asof = df['Date'].max()
+    cfca = nse_cf_ca.NseCorporateActions().get_all_cf_ca_multipliers(symbols=all_df['Symbol'].unique())
+    cfca = cfca.loc[cfca['Ex Date'] <= ca_asof.strftime('%Y-%m-%d')]
+    for col in nse_spot.CA_PRICE_COLS:
+        all_df['Adj ' + col] = all_df[col]
+    all_df = nse_spot.adjust_for_corporate_actions_all(all_df, cfca, ['Adj ' + c for c in nse_spot.CA_PRICE_COLS])
+
+    all_df = nse_spot.get_52week_high_low(all_df, low='Adj Low', high='Adj High')
+    group_pos = all_df.groupby(['Symbol', 'Series']).cumcount().values
+    volume_cumsum = all_df.groupby(['Symbol', 'Series'])['Volume'].cumsum().values
+    for n in [20, 50]:
+        prev_cumsum = np.where(group_pos >= n, np.roll(volume_cumsum, n), 0)
+        all_df[f'Volume {n}D Avg'] = np.round((volume_cumsum - prev_cumsum) / np.minimum(group_pos + 1, n), 2)
+
+    all_df = all_df.loc[all_df['Date'] >= date_from]
+    all_df['CA Asof'] = ca_asof
+    all_df.sort_values(by=['Symbol', 'Date'], inplace=True)
+    pv_store.write_pv_parquet(all_df, os.path.join(PATH_2, f'{year}/cm_bhavcopy_enriched.csv.parquet'),
+                              compact=compact, profile=profile)
+    if verbose:
+        print('process_cm_enriched: %d: %s, CA Asof %s' % (year, all_df.shape, ca_asof.strftime('%Y-%m-%d')))
+    return
 
-    ''' Read OLD bhavcopy files '''
-    fo_bhavcopy_files = glob.glob(os.path.join(PATH_1, f'{year}/**/fo_bhavcopy.zip'))
-    print('%d OLD bhavcopy files' % len(fo_bhavcopy_files), end='')
-    if len(fo_bhavcopy_files) > 0:
-        df = pd.concat([read_fo_bhavcopy_files(f, verbose) for f in fo_bhavcopy_files], axis=0)
+''' --------------------------------------------------------------------------------------- '''
+# New, still wip (subject to appl use cases)
+FO_COLUMNS = ['date', 'instr_type', 'symbol', 'ISIN', 'expiry_date', 'strike_price', 'option_type',
+              'open', 'high', 'low', 'close',
+              'settlement_price', 'trading_volume', 'open_interest', 'change_in_oi', 'trading_value']
+FO_SCHEMA = pa.schema([('date', pa.timestamp('ns')), ('instr_type', pa.string()), ('symbol', pa.string()),
+                       ('ISIN', pa.string()), ('expiry_date', pa.timestamp('ns')), ('strike_price', pa.float64()),
+                       ('option_type', pa.string())] +
+                      [(c, pa.float64()) for c in ['open', 'high', 'low', 'close', 'settlement_price']] +
+                      [(c, pa.int64()) for c in ['trading_volume', 'open_interest', 'change_in_oi']] +
+                      [('trading_value', pa.float64())])
+FO_NUMERIC_COLUMNS = [f.name for f in FO_SCHEMA if pa.types.is_floating(f.type) or pa.types.is_integer(f.type)]
+FUTURES_INSTR = ['IDF', 'STF']
+FO_FUTURES_ROW_GROUP_ROWS = 16384  # futures row groups: whole days, up to this many rows (unless one day is more)
+
+def fo_schema(x=None, compact=False):
+    """
+    FO_SCHEMA, compact: dates as date32 & the numeric columns in the float32 / int32 that
+    pv_store.compact_dtypes picks for the rows x (a DataFrame in FO_COLUMNS, None: no rows yet)
+    """
+    if not compact:
+        return FO_SCHEMA
+    narrow = {pa.float64(): pa.float32(), pa.int64(): pa.int32()}
+    dtypes = {} if x is None else pv_store.compact_dtypes(x[FO_NUMERIC_COLUMNS], categories=False).dtypes
+    fields = []
+    for f in FO_SCHEMA:
+        if pa.types.is_timestamp(f.type):
+            f = pa.field(f.name, pa.date32())
+        elif f.name in dtypes.keys() and narrow.get(f.type) == pa.from_numpy_dtype(dtypes[f.name]):
+            f = pa.field(f.name, narrow[f.type])
+        fields.append(f)
+    return pa.schema(fields)
+
+def fo_wider_schema(schema1, schema2):
+    """ column by column, the wider numeric type of two fo_schema """
+    return pa.schema([f2 if f1.name in FO_NUMERIC_COLUMNS and f2.type.bit_width > f1.type.bit_width else f1
+                      for f1, f2 in zip(schema1, schema2)])
+
+def fo_cast_table(table, schema):
+    """ table in schema (same or wider types), float32 to float64 rounded to 2 decimals as pv_store.standard_dtypes """
+    for i, field in enumerate(schema):
+        column = table.column(i)
+        if column.type != field.type:
+            widened = column.cast(field.type)
+            table = table.set_column(i, field, pc.round(widened, 2) if pa.types.is_float32(column.type) else widened)
+    return table
+
+def read_fo_bhavcopy(fo_bhavcopy_files, fo_bhavcopy_files_v02, manifest, workers=1, verbose=False):
+    """ new members of OLD & NEW (v02) fo bhavcopy archives as one DataFrame in FO_COLUMNS, None if none """
+    df = parse_members(parse_bhavcopy, archive_members(fo_bhavcopy_files, manifest, verbose), workers)
+    if df is not None:
         df.rename(columns={
             'TIMESTAMP':'date', 'INSTRUMENT':'instr_type', 'SYMBOL':'symbol', 'EXPIRY_DT':'expiry_date',
             'STRIKE_PR':'strike_price', 'OPTION_TYP':'option_type',
@@ -248,17 +501,11 @@ def process_fo_reports(year, verbose=False):
         it_dict = {'FUTIDX':'IDF', 'OPTIDX':'IDO', 'FUTSTK':'STF', 'OPTSTK':'STO',
                    'FUTIVX':'IDF'}
         df['instr_type'] = df['instr_type'].apply(lambda x: it_dict[x])
-        df['ISIN'] = np.nan
-        df = df[common_cols_fo_bhavcopy]
-    else:
-        df = pd.DataFrame(columns=common_cols_fo_bhavcopy)
-    print(', df.shape:', df.shape, end='')
+        df['ISIN'] = None
+        df = df[FO_COLUMNS]
 
-    ''' Read NEW (v02) bhavcopy files '''
-    fo_bhavcopy_files_v02 = glob.glob(os.path.join(PATH_1, f'{year}/**/fo_bhavcopy_v02.zip'))
-    print(', %d NEW bhavcopy files' % len(fo_bhavcopy_files_v02), end='')
-    if len(fo_bhavcopy_files_v02) > 0:
-        df_v02 = pd.concat([read_fo_bhavcopy_files(f, verbose) for f in fo_bhavcopy_files_v02], axis=0)
+    df_v02 = parse_members(parse_bhavcopy, archive_members(fo_bhavcopy_files_v02, manifest, verbose), workers)
+    if df_v02 is not None:
         df_v02.rename(columns={
             'TradDt': 'date', 'FinInstrmTp': 'instr_type', 'TckrSymb': 'symbol', 'XpryDt': 'expiry_date',
             'StrkPric': 'strike_price', 'OptnTp': 'option_type',
@@ -269,76 +516,127 @@ def process_fo_reports(year, verbose=False):
             'TtlNbOfTxsExctd':'number_of_trades'
             },
             inplace=True)
-        df_v02 = df_v02[common_cols_fo_bhavcopy]
-    else:
-        df_v02 = pd.DataFrame(columns=common_cols_fo_bhavcopy)
-    print(', df_v02.shape:', df_v02.shape)
-
-    df = pd.concat([df, df_v02], axis=0).reset_index(drop=True)
-    if df.shape[0] == 0:
-        print('WARNING! No files (either OLD or NEW/v02 found, returning!')
-        return
+        df_v02 = df_v02[FO_COLUMNS]
 
+    dfs = [x for x in [df, df_v02] if x is not None]
+    if len(dfs) == 0:
+        return None
+    df = pd.concat(dfs, axis=0).reset_index(drop=True)
     df['date'] = pd.to_datetime(df['date'])
     df['expiry_date'] = pd.to_datetime(df['expiry_date'])
     df['strike_price'] = df['strike_price'].replace('', np.nan).astype(float)
-    df.insert(0, 'date', df.pop('date'))
-
-    print('combined fo_bhavcopy df.shape:', df.shape)
-    print('time check (load files):', elapsed_time(1), 'seconds')
-
-    # NOTE: symbol changes not applied. Takes a very long time. Probably not relevant for FO
+    return nse_symbols.apply_symbol_changes(df, column='symbol')
+
+def process_fo_reports(year, manifest=None, workers=1, compact=False, profile=None, verify=False, verbose=False):
+    """
+    Streams one month at a time, so peak memory is one month of FO bhavcopy, not a year: every month's
+    rows of an instrument type are sorted & appended to its fo_bhavcopy_{instr} file through a
+    ParquetWriter (months in order, so the file is in date / symbol / expiry order). Row groups are whole
+    days: one day each for options, for futures as many days as fit in FO_FUTURES_ROW_GROUP_ROWS rows.
+    Schema: FO_SCHEMA, compact: see fo_schema. profile: codec & encoding (see pv_store), its
+    row_group_size caps the row groups, its sorting_columns are not used (the order is above)
+    verify: read every file back & check its shape (else only the row counts in the parquet footers)
+    """
+    elapsed_time([0, 1])
+    manifest = IngestManifest(year) if manifest is None else manifest
+    row_group_size = pv_store.storage_profile(profile)['row_group_size']
 
-    # pickle was the fastest but space was 5x of CSV. parquet is best of both worlds
-    for instr in ['IDF', 'IDO', 'STF', 'STO']:
-        elapsed_time(1)
-        x = df.loc[df['instr_type'] == instr].sort_values(by=['date', 'symbol', 'expiry_date'])
-        x.to_parquet(os.path.join(PATH_2, '%d/fo_bhavcopy_%s.csv.parquet' % (year, instr)),
-                     index=False, engine='pyarrow', compression='gzip')
-        print('  time check fo_bhavcopy_%s: save: %.2f' % (instr, elapsed_time(1)), 'seconds', end='')
-        print(f' (shape: {x.shape})')
-        y = pd.read_parquet(os.path.join(PATH_2, '%d/fo_bhavcopy_%s.csv.parquet' % (year, instr)))
-        print('  time check fo_bhavcopy_%s: read: %.2f' % (instr, elapsed_time(1)), 'seconds')
-        assert x.shape == y.shape
+    fo_bhavcopy_files = glob.glob(os.path.join(PATH_1, f'{year}/**/fo_bhavcopy.zip'))
+    fo_bhavcopy_files_v02 = glob.glob(os.path.join(PATH_1, f'{year}/**/fo_bhavcopy_v02.zip'))
+    print('%d OLD, %d NEW bhavcopy files' % (len(fo_bhavcopy_files), len(fo_bhavcopy_files_v02)))
+
+    writers, n_rows, pending = {}, {}, {}
+
+    def open_writer(instr, schema):
+        fo_file = manifest.output_file('fo_bhavcopy_%s' % instr)
+        writers[instr] = (fo_file, pv_store.parquet_writer(fo_file, schema, profile=profile), schema)
+
+    def widen_writer(instr, schema):
+        """ rows written so far are rewritten in schema (wider types), row group by row group """
+        fo_file, writer, _ = writers[instr]
+        writer.close()
+        os.replace(fo_file, fo_file + '.tmp')
+        writers[instr] = (fo_file, pv_store.parquet_writer(fo_file, schema, profile=profile), schema)
+        with pq.ParquetFile(fo_file + '.tmp') as pf:
+            for rg in range(pf.metadata.num_row_groups):
+                writers[instr][1].write_table(fo_cast_table(pf.read_row_group(rg), schema))
+        os.remove(fo_file + '.tmp')
+
+    def write_days(instr, tables):
+        """ tables (whole days) as one row group """
+        _, writer, schema = writers[instr]
+        writer.write_table(pa.concat_tables([fo_cast_table(t, schema) for t in tables]), row_group_size=row_group_size)
+
+    try:
+        for month_path in sorted(set(os.path.dirname(f) for f in fo_bhavcopy_files + fo_bhavcopy_files_v02)):
+            df = read_fo_bhavcopy([f for f in fo_bhavcopy_files if os.path.dirname(f) == month_path],
+                                  [f for f in fo_bhavcopy_files_v02 if os.path.dirname(f) == month_path],
+                                  manifest, workers, verbose)
+            if df is None:
+                continue
+            for instr in ['IDF', 'IDO', 'STF', 'STO']:
+                x = df.loc[df['instr_type'] == instr].sort_values(by=['date', 'symbol', 'expiry_date'], kind='stable')
+                if x.shape[0] == 0:
+                    continue
+                schema = fo_schema(x, compact)
+                if instr not in writers.keys():
+                    open_writer(instr, schema)
+                elif fo_wider_schema(writers[instr][2], schema) != writers[instr][2]:
+                    widen_writer(instr, fo_wider_schema(writers[instr][2], schema))
+                ''' whole days per row group, see nse_fo.NseFOData '''
+                table = pa.Table.from_pandas(x, schema=schema, preserve_index=False)
+                dates = x['date'].values
+                starts = np.flatnonzero(np.append(True, dates[1:] != dates[:-1]))
+                for start, end in zip(starts, np.append(starts[1:], len(dates))):
+                    day = table.slice(start, end - start)
+                    if instr in FUTURES_INSTR:
+                        if sum(t.num_rows for t in pending.get(instr, [])) + day.num_rows > FO_FUTURES_ROW_GROUP_ROWS:
+                            write_days(instr, pending.pop(instr))
+                        pending.setdefault(instr, []).append(day)
+                    else:
+                        write_days(instr, [day])
+                n_rows[instr] = n_rows.get(instr, 0) + x.shape[0]
+            print('  %s: %d rows, time check: %.2f seconds' % (month_path, df.shape[0], elapsed_time(1)))
+        for instr in list(pending.keys()):
+            write_days(instr, pending.pop(instr))
+
+        if len(writers) == 0:
+            print('WARNING! No files (either OLD or NEW/v02 found, returning!')
+            return
+        ''' as before, every instrument type has its file (unless incremental) '''
+        for instr in ['IDF', 'IDO', 'STF', 'STO']:
+            if instr not in writers.keys() and not manifest.incremental:
+                open_writer(instr, fo_schema(None, compact))
+    finally:
+        for fo_file, writer, _ in writers.values():
+            writer.close()
+
+    for instr, (fo_file, _, _) in sorted(writers.items()):
+        n = pq.ParquetFile(fo_file).metadata.num_rows
+        assert n == n_rows.get(instr, 0), '%s: %d rows written, %d in file' % (fo_file, n_rows.get(instr, 0), n)
+        if verify:
+            y = pv_store.read_pv_parquet(fo_file)
+            assert y.shape == (n, len(FO_COLUMNS)), '%s: shape %s' % (fo_file, y.shape)
+        print('  fo_bhavcopy_%s: %d rows' % (instr, n))
 
     print('time check (total time taken):', elapsed_time(0), 'seconds')
 
     return
 
 ''' --------------------------------------------------------------------------------------- '''
-def process_etf_reports(year, verbose=False):
+def process_etf_reports(year, manifest=None, workers=1, compact=False, profile=None, verbose=False):
     elapsed_time(0)
+    manifest = IngestManifest(year) if manifest is None else manifest
 
     archive_files = glob.glob(os.path.join(PATH_1, f'{year}/**/PR.zip'))
     if verbose:
         print(len(archive_files), 'archive files:')
         print(archive_files)
 
-    def read_pr_files(archive_file, verbose=False):
-        archive = Archiver(archive_file, mode='r', compression='zip')
-        if verbose:
-            etf_files = [f1 for f in archive.keys()
-                         for f1 in ZipFile(BytesIO(archive.get(f))).namelist()
-                         if 'etf' in f1]
-            print(f'{archive_file}: ', etf_files)
-
-        def read_etf(bytes, etf_file_name):
-            if verbose:
-                print(f'Reading {etf_file_name}, ', end='')
-            df_x = pd.read_csv(bytes, encoding='cp1252')
-            dtstr = etf_file_name.split('.')[0][3:]
-            df_x['Date'] = f'20%s-%s-%s' % (dtstr[4:], dtstr[2:4], dtstr[0:2])
-            if verbose:
-                print('shape:', df_x.shape)
-            return df_x
-        dfs = pd.concat([read_etf(BytesIO(ZipFile(BytesIO(archive.get(f))).read(f1)), f1)
-                         for f in archive.keys()
-                         for f1 in ZipFile(BytesIO(archive.get(f))).namelist()
-                         if 'etf' in f1
-                         ])
-        return dfs
-
-    df = pd.concat([read_pr_files(f, verbose) for f in archive_files])
+    df = parse_members(parse_pr_etf, archive_members(archive_files, manifest, verbose), workers)
+    if df is None:
+        print('No new PR files, returning')
+        return
 
     df.rename(columns={'SERIES': 'Series', 'SYMBOL': 'Symbol',
                        'OPEN PRICE': 'Open', 'HIGH PRICE': 'High',
@@ -354,8 +652,7 @@ def process_etf_reports(year, verbose=False):
     df.insert(3, 'SECURITY', df.pop('SECURITY'))
     df.insert(4, 'Series', df.pop('Series'))
 
-    df.to_parquet(os.path.join(PATH_2, f'{year}/etf_bhavcopy_all.csv.parquet'),
-                  index=False, engine='pyarrow', compression='gzip')
+    pv_store.write_pv_parquet(df, manifest.output_file('etf_bhavcopy_all'), compact=compact, profile=profile)
 
     if verbose:
         print(df.shape, df.columns)
@@ -370,58 +667,152 @@ def process_etf_reports(year, verbose=False):
     return
 
 ''' --------------------------------------------------------------------------------------- '''
-"""
-def get_52week_high_low(df):
-    df['1yago'] = df['Date'].apply(lambda x: datetime.datetime(x.year-1, x.month, x.day))
-
-    def min_max(dates):
-        df_1y = df.loc[(df['Date'] >= dates[0]) & (df['Date'] <= dates[1])]
-        id_min = df_1y['Low'].idxmin()
-        id_max = df_1y['High'].idxmax()
-        return [df_1y.at[id_min, 'Low'], df_1y.at[id_min, 'Date'],
-                df_1y.at[id_max, 'High'], df_1y.at[id_max, 'Date']]
-
-    df['min_max']        = df.apply(lambda x: min_max([x['1yago'], x['Date']]), axis=1)
-    df['52wk_low']       = df['min_max'].apply(lambda x: x[0])
-    df['52wk_low_date']  = df['min_max'].apply(lambda x: x[1])
-    df['52wk_high']      = df['min_max'].apply(lambda x: x[2])
-    df['52wk_high_date'] = df['min_max'].apply(lambda x: x[3])
-    df.drop(columns=['min_max'], inplace=True)
-
-    return
-"""
-
-def wrapper(year, verbose=False):
-    print(f'Processing daily reports for year {year}...')
+def wrapper(year, cm_layout='year', cm_enriched=False, incremental=False, workers=1, compact=False,
+            profile=None, verbose=False):
+    """
+    incremental: process only archive members not processed yet, see IngestManifest
+    workers:     processes parsing archive members, see parse_members
+    compact:     parquet outputs in compact dtypes (float32 / int32 where lossless, date32), see pv_store
+    profile:     parquet storage profile (codec, row groups, ...), see pv_store.STORAGE_PROFILES
+    """
+    print(f'Processing daily reports for year {year}{" (incremental)" if incremental else ""}...')
     os.makedirs(os.path.join(PATH_2, f'{year}'), exist_ok=True)
+    manifest = IngestManifest(year, incremental=incremental)
 
-    print('Removing existing files: ', end='')
-    remove_existing_files(f'{year}/*_bhavcopy*.csv*', verbose=verbose)
-    print('Done\n')
+    if not manifest.incremental:
+        print('Removing existing files: ', end='')
+        remove_existing_files(f'{year}/*_bhavcopy*.csv*', verbose=verbose)
+        print('Done\n')
 
     print('Processing Index Daily Reports ... Start')
-    process_index_reports(year, verbose=verbose)
+    process_index_reports(year, manifest=manifest, workers=workers, compact=compact, profile=profile,
+                          verbose=verbose)
+    manifest.save()
     print('Processing Index Daily Reports ... Done\n')
 
     print('Processing CM Daily Reports ... Start')
     symbols = None  # tst_syms
-    process_cm_reports(year, symbols=symbols, verbose=verbose)
+    process_cm_reports(year, symbols=symbols, layout=cm_layout, enriched=cm_enriched, manifest=manifest,
+                       workers=workers, compact=compact, profile=profile, verbose=verbose)
+    manifest.save()
     print('Processing CM Daily Reports ... Done\n')
 
     print('Processing FO Daily Reports ... Start')
-    process_fo_reports(year, verbose=verbose)
+    process_fo_reports(year, manifest=manifest, workers=workers, compact=compact, profile=profile,
+                       verbose=verbose)
+    manifest.save()
     print('Processing FO Daily Reports ... Done\n')
 
     print('Processing ETF Daily Reports ... Start')
-    process_etf_reports(year, verbose=verbose)
+    process_etf_reports(year, manifest=manifest, workers=workers, compact=compact, profile=profile,
+                        verbose=verbose)
+    manifest.save()
     print('Processing ETF Daily Reports ... Done\n')
 
     return
 
+def test_me():
+    """ offline: synthetic daily report archives of a year, processed (wrapper) in a temp dir """
+    global PATH_1, PATH_2
+    print('fin_data.nse_pv.process_dr.test_me:')
+    elapsed_time('fin_data.nse_pv.process_dr.test_me')
+    year, symbols = 2030, ['AAA', 'BBB', 'CCC']
+
+    def add_member(archive, member, content):
+        archive_file = os.path.join(PATH_1, f'{year}/01/{archive}')
+        os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+        with ZipFile(archive_file, 'a') as z:
+            z.writestr(member, content)
+
+    def add_bhavcopy(d):
+        df = pd.DataFrame({'TradDt': d, 'TckrSymb': symbols, 'SctySrs': 'EQ', 'ISIN': ['I1', 'I2', 'I3'],
+                           'OpnPric': 100.0, 'HghPric': 101.0, 'LwPric': 99.0, 'ClsPric': [100.0 + i for i in range(3)],
+                           'LastPric': 100.0, 'PrvsClsgPric': 100.0, 'TtlTradgVol': 1000, 'TtlTrfVal': 1.0,
+                           'TtlNbOfTxsExctd': 5})
+        zipped = BytesIO()
+        with ZipFile(zipped, 'w') as z:
+            z.writestr('bhavcopy.csv', df.to_csv(index=False))
+        add_member('cm_bhavcopy_v02.zip', 'BhavCopy_NSE_CM_0_0_0_%s_F_0000.csv.zip' % d.replace('-', ''),
+                   zipped.getvalue())
+
+    def add_mto(d):
+        mto = 'header 1\nheader 2\nheader 3\nRecord Type,Sr No,Name of Security,Series,Qty,Deliv,Pct\n' + \
+              ''.join('20,%d,%s,EQ,1000,%d,%.1f\n' % (i, x, 400 + i, 40.0 + i) for i, x in enumerate(symbols))
+        add_member('MTO.zip', 'MTO_%s%s%s.DAT' % (d[8:], d[5:7], d[0:4]), mto)
+
+    def set_symbol_changes(changes):
+        os.makedirs(nse_symbols.PATH_1, exist_ok=True)
+        pd.DataFrame(changes, columns=['Date of Change', 'Old Symbol', 'New Symbol']).to_csv(
+            os.path.join(nse_symbols.PATH_1, 'symbolchange.csv'), index=False)
+
+    def processed():
+        """ the year files (all fragments) & the symbol store, in Symbol / Date order """
+        df = pv_store.read_pv_parquet(year_files(year, 'cm_bhavcopy_all'))
+        store = pv_store.read_cm_store(sorted(set(df['Symbol'])))
+        return [x.drop(columns=['index']).sort_values(by=['Symbol', 'Date']).reset_index(drop=True)
+                for x in [df, store]]
+
+    def run(incremental=True):
+        wrapper(year, cm_layout='both', incremental=incremental)
+
+    saved = PATH_1, PATH_2, pv_store.CM_STORE_PATH, nse_symbols.PATH_1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        PATH_1, PATH_2 = tmp_dir, os.path.join(tmp_dir, 'processed')
+        pv_store.CM_STORE_PATH = os.path.join(PATH_2, 'cm_store')
+        nse_symbols.PATH_1 = os.path.join(tmp_dir, 'symbols')
+        try:
+            set_symbol_changes([])
+            [add_bhavcopy(d) for d in ['2030-01-01', '2030-01-02', '2030-01-03']]
+            [add_mto(d) for d in ['2030-01-01', '2030-01-02']]
+            run()  # no manifest yet: in full
+            assert year_files(year, 'cm_bhavcopy_all') == [os.path.join(PATH_2, f'{year}/cm_bhavcopy_all.csv.parquet')]
+
+            ''' a new day: only its member is read, written as the first fragment '''
+            add_bhavcopy('2030-01-04')
+            add_mto('2030-01-04')
+            run()
+            fragment = os.path.join(PATH_2, f'{year}/cm_bhavcopy_all.001.csv.parquet')
+            assert len(year_files(year, 'cm_bhavcopy_all')) == 2 and os.path.exists(fragment)
+            assert parquet_dates(fragment) == {datetime.date(2030, 1, 4)}, 'ERROR! fragment: %s' % parquet_dates(fragment)
+            df, store = processed()
+            assert df.shape[0] == 12 and df.loc[df['Date'] == '2030-01-03', 'Delivery Volume'].isna().all()
+
+            ''' the MTO of a processed day: its delivery is set in the processed rows, no new fragment '''
+            add_mto('2030-01-03')
+            run()
+            assert len(year_files(year, 'cm_bhavcopy_all')) == 2, 'ERROR! late MTO fragment'
+            for x in processed():
+                assert x.shape[0] == 12 and x['Delivery Volume'].notna().all(), 'ERROR! late MTO'
+                assert list(x.loc[x['Date'] == '2030-01-03', 'Delivery Volume']) == [400, 401, 402]
+
+            ''' incremental runs give what a full run gives '''
+            incremental = processed()
+            run(incremental=False)
+            assert len(year_files(year, 'cm_bhavcopy_all')) == 1
+            for x, y in zip(incremental, processed()):
+                pd.testing.assert_frame_equal(x, y, check_dtype=False)
+
+            ''' symbol changes changed: in full, the rows processed before renamed too '''
+            add_bhavcopy('2030-01-07')
+            set_symbol_changes([['2029-06-01', 'BBB', 'BBZ']])
+            run()
+            assert len(year_files(year, 'cm_bhavcopy_all')) == 1, 'ERROR! symbol changes: not in full'
+            df, store = processed()
+            assert df.shape[0] == 15 and store.shape[0] == 15
+            assert sorted(set(df['Symbol'])) == ['AAA', 'BBZ', 'CCC'] and df['Date'].nunique() == 5
+            with open(os.path.join(PATH_2, f'{year}/ingested_members.json')) as f:
+                assert json.load(f)['symbol_changes'] == nse_symbols.symbol_changes_signature()
+        finally:
+            PATH_1, PATH_2, pv_store.CM_STORE_PATH, nse_symbols.PATH_1 = saved
+
+    print('OK')
+    return True, elapsed_time('fin_data.nse_pv.process_dr.test_me')
+
 ''' --------------------------------------------------------------------------------------- '''
 if __name__ == '__main__':
     tst_syms = ['ASIANPAINT', 'BRITANNIA', 'HDFC', 'ICICIBANK', 'IRCTC', 'JUBLFOOD', 'ZYDUSLIFE']
     verbose = False
     year = datetime.date.today().year if len(sys.argv) == 1 else int(sys.argv[1])
-    wrapper(year, verbose=verbose)
+    wrapper(year, incremental=len(sys.argv) > 2 and sys.argv[2] == 'incremental',
+            workers=os.cpu_count(), verbose=verbose)
 
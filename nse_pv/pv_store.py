@@ -0,0 +1,250 @@
+"""
+Symbol partitioned store for processed CM bhavcopy (alternative to the one file per year layout)
+Layout: processed/cm_store/year=YYYY/bucket=NN/cm_bhavcopy.parquet
+        every file holds the symbols hashing to that bucket, sorted by Symbol/Series/Date,
+        one row group per symbol (so Symbol statistics prune everything else)
+Also compact dtypes for processed PV data (in memory & in parquet), parquet storage profiles (codec,
+dictionary encoding, row groups, sorting) & a memory mapped cache
+"""
+''' --------------------------------------------------------------------------------------- '''
+
+from fin_data.env import *
+import hashlib
+import json
+import os
+import shutil
+import zlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+CM_STORE_PATH = os.path.join(DATA_ROOT, '01_nse_pv/02_dr/processed/cm_store')
+N_BUCKETS = 32
+
+''' --------------------------------------------------------------------------------------- '''
+def symbol_bucket(symbol):
+    return zlib.crc32(symbol.encode('utf-8')) % N_BUCKETS
+
+def write_cm_store(df, year, profile=None, verbose=False):
+    year_path = os.path.join(CM_STORE_PATH, f'year={year}')
+    if os.path.exists(year_path):
+        shutil.rmtree(year_path)
+
+    buckets = df['Symbol'].apply(symbol_bucket)
+    for bucket in sorted(buckets.unique()):
+        write_cm_bucket(df.loc[buckets == bucket], year, bucket, profile=profile)
+    if verbose:
+        print('write_cm_store: %d: %d rows, %d buckets' % (year, df.shape[0], len(buckets.unique())))
+    return
+
+def append_cm_store(df, year, profile=None, verbose=False):
+    """ add df's rows to the year: only the buckets of df's symbols are read & rewritten """
+    buckets = df['Symbol'].apply(symbol_bucket)
+    for bucket in sorted(buckets.unique()):
+        bucket_file = os.path.join(CM_STORE_PATH, f'year={year}', f'bucket={bucket}', 'cm_bhavcopy.parquet')
+        existing = [read_pv_parquet(bucket_file)] if os.path.exists(bucket_file) else []
+        write_cm_bucket(pd.concat(existing + [df.loc[buckets == bucket]], axis=0), year, bucket, profile=profile)
+    if verbose:
+        print('append_cm_store: %d: %d rows, %d buckets' % (year, df.shape[0], len(buckets.unique())))
+    return
+
+def write_cm_bucket(df, year, bucket, profile=None):
+    """ row groups are per symbol here, the profile's row_group_size & sorting_columns are not used """
+    df = df.sort_values(by=['Symbol', 'Series', 'Date']).reset_index(drop=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    os.makedirs(os.path.join(CM_STORE_PATH, f'year={year}', f'bucket={bucket}'), exist_ok=True)
+    with parquet_writer(os.path.join(CM_STORE_PATH, f'year={year}', f'bucket={bucket}', 'cm_bhavcopy.parquet'),
+                        table.schema, profile=profile) as writer:
+        symbols = table.column('Symbol').to_numpy(zero_copy_only=False)
+        starts  = [0] + [i for i in range(1, len(symbols)) if symbols[i] != symbols[i - 1]]
+        for start, end in zip(starts, starts[1:] + [len(symbols)]):
+            writer.write_table(table.slice(start, end - start))
+    return
+
+def read_cm_store(symbols, series=None, date_from=None, date_to=None, columns=None):
+    dataset = ds.dataset(CM_STORE_PATH, format='parquet', partitioning='hive')
+
+    filters = pc.field('bucket').isin(sorted(set(symbol_bucket(s) for s in symbols))) & \
+              pc.field('Symbol').isin(symbols)
+    if series is not None:
+        filters = filters & (pc.field('Series') == series)
+    if date_from is not None:
+        filters = filters & (pc.field('year') >= date_from.year) & (pc.field('Date') >= date_from)
+    if date_to is not None:
+        filters = filters & (pc.field('year') <= date_to.year) & (pc.field('Date') <= date_to)
+
+    columns = [c for c in dataset.schema.names if c not in ['year', 'bucket'] and
+               (columns is None or c in columns)]
+    return table_to_pandas(dataset.to_table(columns=columns, filter=filters))
+
+''' storage profiles ---------------------------------------------------------------------- '''
+''' how processed files are written. Any codec can be read back, so files of different profiles mix.
+    compression_level: None is the codec's default. use_dictionary: True, False or a list of columns.
+    row_group_size: max rows per row group (None: pyarrow's default). sorting_columns: the rows are
+    sorted by these (the ones the table has) & the order is recorded in the footer '''
+STORAGE_PROFILES = {
+    'gzip':   {'compression': 'gzip', 'compression_level': None},
+    'zstd':   {'compression': 'zstd', 'compression_level': 3},
+    'zstd_9': {'compression': 'zstd', 'compression_level': 9},
+    'lz4':    {'compression': 'lz4', 'compression_level': None},
+    'snappy': {'compression': 'snappy', 'compression_level': None},
+}
+STORAGE_PROFILE = 'zstd'
+PROFILE_DEFAULTS = {'compression': 'zstd', 'compression_level': None, 'use_dictionary': True,
+                    'row_group_size': None, 'sorting_columns': None}
+
+def storage_profile(profile=None):
+    """ profile: a STORAGE_PROFILES name, a dict (over the default profile) or None (STORAGE_PROFILE) """
+    if profile is None or type(profile) == str:
+        name = STORAGE_PROFILE if profile is None else profile
+        assert name in STORAGE_PROFILES.keys(), 'Invalid storage profile %s' % name
+        return {**PROFILE_DEFAULTS, **STORAGE_PROFILES[name]}
+    return {**storage_profile(), **profile}
+
+def parquet_writer(file_name, schema, profile=None):
+    """ pq.ParquetWriter with the profile's codec & encoding (row groups are up to the caller) """
+    p = storage_profile(profile)
+    return pq.ParquetWriter(file_name, schema, compression=p['compression'],
+                            compression_level=p['compression_level'], use_dictionary=p['use_dictionary'])
+
+def write_parquet_table(table, file_name, profile=None):
+    p = storage_profile(profile)
+    sorting_columns = None
+    if p['sorting_columns'] is not None:
+        sort_by = [c for c in p['sorting_columns'] if c in table.column_names]
+        if len(sort_by) > 0:
+            table = table.take(pc.sort_indices(table, sort_keys=[(c, 'ascending') for c in sort_by]))
+            sorting_columns = pq.SortingColumn.from_ordering(table.schema, [(c, 'ascending') for c in sort_by])
+    pq.write_table(table, file_name, compression=p['compression'], compression_level=p['compression_level'],
+                   use_dictionary=p['use_dictionary'], row_group_size=p['row_group_size'],
+                   sorting_columns=sorting_columns)
+    return
+
+''' compact dtypes ------------------------------------------------------------------------ '''
+CATEGORY_COLS = ['Symbol', 'Series', 'ISIN', 'Index Name', 'SECURITY', 'UNDERLYING',
+                 'symbol', 'instr_type', 'option_type']
+
+def compact_dtypes(df, categories=True):
+    """
+    Symbol / Series / ISIN etc. as categoricals (categories sorted, so sorting is unchanged), float32
+    where every value is exact again after rounding to 2 decimals, int32 where in range
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        x = df[col]
+        if categories and col in CATEGORY_COLS and (x.dtype == object or isinstance(x.dtype, pd.CategoricalDtype)):
+            x = x.astype('category')
+            df[col] = x.cat.reorder_categories(sorted(x.cat.categories))
+        elif x.dtype == np.float64:
+            x32 = x.astype(np.float32)
+            if ((np.round(x32.astype(np.float64), 2) == x) | x.isna()).all():
+                df[col] = x32
+        elif x.dtype == np.int64 and x.shape[0] > 0 and \
+                np.iinfo(np.int32).min <= x.min() and x.max() <= np.iinfo(np.int32).max:
+            df[col] = x.astype(np.int32)
+    return df
+
+def standard_dtypes(df):
+    """ undo compact_dtypes: object strings, float64 (rounded to 2 decimals, so exact again) & int64 """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        x = df[col]
+        if isinstance(x.dtype, pd.CategoricalDtype):
+            df[col] = x.astype(object)
+        elif x.dtype == np.float32:
+            df[col] = np.round(x.astype(np.float64), 2)
+        elif x.dtype == np.int32:
+            df[col] = x.astype(np.int64)
+    return df
+
+def write_pv_parquet(df, file_name, compact=False, profile=None):
+    """
+    compact: compact_dtypes (strings are left to parquet's own dictionary encoding) & dates as date32
+    profile: see STORAGE_PROFILES
+    """
+    if not compact:
+        write_parquet_table(pa.Table.from_pandas(df, preserve_index=False), file_name, profile=profile)
+        return
+    table = pa.Table.from_pandas(compact_dtypes(df, categories=False), preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            try:
+                table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+            except pa.ArrowInvalid:
+                pass  # has a time of day
+    write_parquet_table(table, file_name, profile=profile)
+    return
+
+def table_to_pandas(tables, compact=False):
+    """
+    parquet tables (compact or not) as one DataFrame, in standard dtypes (dates as datetime64[ns]) or
+    (compact) compact_dtypes, with strings going straight to categoricals
+    """
+    def standard_table(t):
+        t = t.replace_schema_metadata(None)
+        for i, field in enumerate(t.schema):
+            if pa.types.is_date32(field.type):
+                t = t.set_column(i, field.name, t.column(i).cast(pa.timestamp('ns')))
+            elif pa.types.is_float32(field.type):
+                t = t.set_column(i, field.name, pc.round(t.column(i).cast(pa.float64()), 2))
+            elif pa.types.is_int32(field.type):
+                t = t.set_column(i, field.name, t.column(i).cast(pa.int64()))
+            elif pa.types.is_dictionary(field.type):
+                t = t.set_column(i, field.name, t.column(i).cast(field.type.value_type))
+        return t
+
+    tables = [standard_table(t) for t in ([tables] if isinstance(tables, pa.Table) else tables)]
+    table = tables[0] if len(tables) == 1 else pa.concat_tables(tables, promote_options='permissive')
+    df = table.to_pandas(strings_to_categorical=compact)
+    return compact_dtypes(df) if compact else df
+
+def read_pv_parquet(files, columns=None, filters=None, compact=False):
+    """ parquet file(s) written by write_pv_parquet (or to_parquet), see table_to_pandas """
+    files = [files] if type(files) == str else files
+    return table_to_pandas([pq.read_table(f, columns=columns, filters=filters) for f in files], compact=compact)
+
+''' memory mapped cache ------------------------------------------------------------------ '''
+''' loaded & prepared frames as uncompressed Arrow IPC (Feather v2) files: every process memory maps
+    the same file, so numeric columns & categorical codes are zero-copy & their pages are shared '''
+IPC_CACHE_PATH = os.path.join(DATA_ROOT, '01_nse_pv/02_dr/processed/ipc_cache')
+
+def sources_signature(files):
+    """ absolute path, size & mtime of every source file """
+    files = sorted(os.path.abspath(f) for f in files)
+    return json.dumps([[f, os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files])
+
+def ipc_cache_file(name, sources):
+    """ {name}.{hash of the sources' directories}.arrow: sources of other data roots have their own file """
+    dirs = sorted(set(os.path.dirname(os.path.abspath(f)) for f in sources))
+    return os.path.join(IPC_CACHE_PATH, '%s.%s.arrow' % (name, hashlib.sha1(json.dumps(dirs).encode()).hexdigest()[:12]))
+
+def read_ipc_cache(name, sources):
+    """ the cached frame (read-only, memory mapped), None if not there or sources changed since written """
+    cache_file = ipc_cache_file(name, sources)
+    if not os.path.exists(cache_file):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(cache_file, 'r')).read_all()
+    if table.schema.metadata.get(b'pv_sources') != sources_signature(sources).encode():
+        return None
+    return table.to_pandas(split_blocks=True)
+
+def write_ipc_cache(name, df, sources):
+    os.makedirs(IPC_CACHE_PATH, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'pv_sources': sources_signature(sources)})
+    cache_file = ipc_cache_file(name, sources)
+    with pa.OSFile(f'{cache_file}.{os.getpid()}.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+    return
+
+''' --------------------------------------------------------------------------------------- '''
+if __name__ == '__main__':
+    import sys
+    from datetime import datetime
+    symbols = ['ASIANPAINT'] if len(sys.argv) == 1 else sys.argv[1:]
+    print(read_cm_store(symbols, date_from=datetime(2023, 1, 1)))
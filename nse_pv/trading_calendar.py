@@ -0,0 +1,136 @@
+"""
+NSE trading calendar: the dates of the index closes (indices_close.zip members) downloaded by get_dr,
+as a sorted datetime64[D] array. Lookups are binary searches. Days outside [first_day, last_day] are
+not known to be trading days or not
+"""
+''' --------------------------------------------------------------------------------------- '''
+
+from fin_data.env import *
+import glob
+import os
+import numpy as np
+from zipfile import ZipFile
+from pygeneric.datetime_utils import elapsed_time
+
+PATH_1 = os.path.join(DATA_ROOT, '01_nse_pv/02_dr')
+
+''' --------------------------------------------------------------------------------------- '''
+def read_trading_days(data_path=PATH_1):
+    """ dates of ind_close_all_DDMMYYYY.csv members of all {data_path}/YYYY/MM/indices_close.zip """
+    days = []
+    for archive_file in glob.glob(os.path.join(data_path, '[0-9][0-9][0-9][0-9]/[0-9][0-9]/indices_close.zip')):
+        with ZipFile(archive_file) as z:
+            dts = [f.split('_')[3].split('.')[0] for f in z.namelist() if f.startswith('ind_close_all_')]
+        days += ['%s-%s-%s' % (d[4:], d[2:4], d[0:2]) for d in dts]
+    return np.unique(np.array(days, dtype='datetime64[D]'))
+
+def as_days(d):
+    """ str (YYYY-MM-DD), date, datetime, Timestamp or an array of these, as datetime64[D] """
+    d = d.values if hasattr(d, 'values') else d  # Series / Index
+    if isinstance(d, (list, tuple, np.ndarray)):
+        return np.asarray(d).astype('datetime64[D]')
+    return np.datetime64(d, 'D')
+
+class TradingCalendar:
+    """ all methods take a day or an array of days (see as_days), NaT where the answer is not known """
+    def __init__(self, data_path=PATH_1, days=None):
+        self.days = read_trading_days(data_path) if days is None else np.unique(as_days(days))
+        self.first_day = self.days[0] if len(self.days) > 0 else np.datetime64('NaT', 'D')
+        self.last_day = self.days[-1] if len(self.days) > 0 else np.datetime64('NaT', 'D')
+
+    def __at__(self, i, valid=True):
+        """ days[i], NaT where i is out of range or not valid """
+        i = np.asarray(i)
+        valid = valid & (i >= 0) & (i < len(self.days))
+        days = self.days if len(self.days) > 0 else np.array(['NaT'], dtype='datetime64[D]')
+        result = np.where(valid, days[np.clip(i, 0, len(days) - 1)], np.datetime64('NaT', 'D'))
+        return result if result.ndim > 0 else result[()]
+
+    def covers(self, d):
+        d = as_days(d)
+        return (d >= self.first_day) & (d <= self.last_day)
+
+    def is_trading_day(self, d):
+        d = as_days(d)
+        return self.__at__(np.searchsorted(self.days, d, side='left')) == d
+
+    def next_trading_day(self, d):
+        """ first trading day after d (NaT after last_day) """
+        d = as_days(d)
+        return self.__at__(np.searchsorted(self.days, d, side='right'), valid=d >= self.first_day - 1)
+
+    def previous_trading_day(self, d):
+        """ last trading day before d (NaT before first_day) """
+        d = as_days(d)
+        return self.__at__(np.searchsorted(self.days, d, side='left') - 1, valid=d <= self.last_day + 1)
+
+    def nearest_trading_day(self, d):
+        """ d if a trading day, else the closer of previous / next trading day (ties: previous) """
+        d = as_days(d)
+        after = np.searchsorted(self.days, d, side='left')
+        before = after - 1
+        after_day, before_day = self.__at__(after), self.__at__(before)
+        use_before = np.isnat(after_day) | (~np.isnat(before_day) & (d - before_day <= after_day - d))
+        result = np.where(use_before, before_day, after_day)
+        result = np.where(self.covers(d), result, np.datetime64('NaT', 'D'))
+        return result if result.ndim > 0 else result[()]
+
+    def shift(self, d, n):
+        """ the trading day n trading days after (n < 0: before) the trading day d """
+        d = as_days(d)
+        i = np.searchsorted(self.days, d, side='left')
+        return self.__at__(i + np.asarray(n), valid=self.is_trading_day(d))
+
+    def trading_days_between(self, d1, d2):
+        """ trading days in [d1, d2] (a single range) """
+        d1, d2 = as_days(d1), as_days(d2)
+        return self.days[np.searchsorted(self.days, d1, side='left'):np.searchsorted(self.days, d2, side='right')]
+
+    def n_trading_days_between(self, d1, d2):
+        """ # of trading days in [d1, d2] """
+        d1, d2 = as_days(d1), as_days(d2)
+        return np.searchsorted(self.days, d2, side='right') - np.searchsorted(self.days, d1, side='left')
+
+''' one calendar per data path, read on first use ----------------------------------------- '''
+__calendars__ = {}
+
+def get_trading_calendar(data_path=PATH_1, refresh=False):
+    if refresh or data_path not in __calendars__.keys():
+        __calendars__[data_path] = TradingCalendar(data_path)
+    return __calendars__[data_path]
+
+''' --------------------------------------------------------------------------------------- '''
+def test_me():
+    print('fin_data.nse_pv.trading_calendar.test_me:', end=' ')
+    elapsed_time('fin_data.nse_pv.trading_calendar.test_me')
+
+    cal = TradingCalendar(days=['2023-03-28', '2023-03-29', '2023-03-31', '2023-04-03', '2023-04-05'])
+    assert cal.is_trading_day('2023-03-31') and not cal.is_trading_day('2023-03-30')
+    assert cal.next_trading_day('2023-03-29') == np.datetime64('2023-03-31')
+    assert cal.next_trading_day('2023-03-30') == np.datetime64('2023-03-31')
+    assert cal.previous_trading_day('2023-04-03') == np.datetime64('2023-03-31')
+    assert np.isnat(cal.next_trading_day('2023-04-05')) and np.isnat(cal.previous_trading_day('2023-03-28'))
+    assert cal.nearest_trading_day('2023-04-01') == np.datetime64('2023-03-31')
+    assert cal.nearest_trading_day('2023-04-04') == np.datetime64('2023-04-03')  # tie
+    assert cal.shift('2023-03-29', 2) == np.datetime64('2023-04-03')
+    assert cal.shift('2023-03-31', -2) == np.datetime64('2023-03-28')
+    assert np.isnat(cal.shift('2023-03-30', 1)) and np.isnat(cal.shift('2023-04-03', 2))
+    assert list(cal.trading_days_between('2023-03-30', '2023-04-03')) == \
+        list(np.array(['2023-03-31', '2023-04-03'], dtype='datetime64[D]'))
+    assert cal.n_trading_days_between('2023-03-01', '2023-03-31') == 3
+    x = cal.nearest_trading_day(np.array(['2023-03-30', '2023-04-02', '2023-05-01'], dtype='datetime64[D]'))
+    assert list(x[:2]) == list(np.array(['2023-03-29', '2023-04-03'], dtype='datetime64[D]')) and np.isnat(x[2])
+
+    cal = get_trading_calendar()
+    if len(cal.days) > 0:
+        assert cal.days.dtype == np.dtype('datetime64[D]') and (np.diff(cal.days) > np.timedelta64(0, 'D')).all()
+        assert not cal.is_trading_day('2023-01-26'), 'Republic Day'
+
+    print('OK')
+    return True, elapsed_time('fin_data.nse_pv.trading_calendar.test_me')
+
+''' --------------------------------------------------------------------------------------- '''
+if __name__ == '__main__':
+    test_me()
+    cal = get_trading_calendar()
+    print('%d trading days, %s to %s' % (len(cal.days), cal.first_day, cal.last_day))